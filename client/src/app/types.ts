@@ -8,6 +8,7 @@ export interface Event {
   event_data?: {[key: string]: string}
   session_id?: string
   event_historical?: boolean
+  locations?: string[]
 }
 
 export interface ItemEvent extends Event {
@@ -148,18 +148,20 @@ export const apiSlice = createApi({
     getUserName: builder.query({
       query: userId => `/users/${userId}/username`,
     }),
-    getAllSessions: builder.query<IPaginatedSessions, { userId: number; page?: number; pageSize?: number; sortBy?: string; sortDir?: string }>({
-      query: ({ userId, page = 1, pageSize = 10, sortBy = "createdTimestamp", sortDir = "desc" }) => `/users/${userId}/sessions?page=${page}&page_size=${pageSize}&sort_by=${sortBy}&sort_dir=${sortDir}`,
+    getAllSessions: builder.query<IPaginatedSessions, { userId: number; page?: number; pageSize?: number; sortBy?: string; sortDir?: string; cursor?: string }>({
+      query: ({ userId, page = 1, pageSize = 10, sortBy = "createdTimestamp", sortDir = "desc", cursor }) =>
+        `/users/${userId}/sessions?page=${page}&page_size=${pageSize}&sort_by=${sortBy}&sort_dir=${sortDir}` +
+        (cursor ? `&cursor=${encodeURIComponent(cursor)}` : ""),
       providesTags: ["Sessions"],
     }),
     getSession: builder.query<ISession, string>({
       query: sessionId => `/session/${sessionId}`,
     }),
     sendLogMessage: builder.mutation({
-      query: ({ sessionId, player_id, message }) => ({
+      query: ({ sessionId, player_id, messages }) => ({
         url: `/session/${sessionId}/log`,
         method: "POST",
-        body: { player_id: player_id, message: message },
+        body: { player_id: player_id, messages: messages },
       }),
     }),
     sendForfeit: builder.mutation({
@@ -8,7 +8,7 @@ import {
 
 import { ArrowUpDown, ArrowUp, ArrowDown, MoreHorizontal } from "lucide-react"
 import { skipToken } from "@reduxjs/toolkit/query/react"
-import { useState } from "react"
+import { useEffect, useState } from "react"
 
 import { Button } from "@/components/ui/button"
 import { Input } from "@/components/ui/input"
@@ -77,6 +77,7 @@ export interface IPaginatedSessions {
   total: number
   page: number
   pageSize: number
+  nextCursor?: string | null
 }
 
 export const columns: ColumnDef<ISession>[] = [
@@ -411,9 +412,19 @@ export const MultiworldSessions = () => {
   const [sorting, setSorting] = useState<SortingState>([])
   const sortBy = sorting.length > 0 ? sorting[0].id : undefined
   const sortDir = sorting.length > 0 ? (sorting[0].desc ? "desc" : "asc") : undefined
+  // Cursors handed back by the server, keyed by sort and page, so stepping through pages avoids deep offsets
+  const [cursors, setCursors] = useState<Record<string, string>>({})
+  const sortKey = `${sortBy ?? ""}:${sortDir ?? ""}`
+  const cursor = cursors[`${sortKey}:${page}`]
   const { data, isLoading, isFetching } = useGetAllSessionsQuery(
-    user.id !== 0 ? { userId: user.id, page, pageSize: PAGE_SIZE, sortBy, sortDir } : skipToken,
+    user.id !== 0 ? { userId: user.id, page, pageSize: PAGE_SIZE, sortBy, sortDir, cursor } : skipToken,
   )
+  useEffect(() => {
+    const nextCursor = data?.nextCursor
+    if (nextCursor) {
+      setCursors(c => ({ ...c, [`${sortKey}:${page + 1}`]: nextCursor }))
+    }
+  }, [data, sortKey, page])
   if (isLoading) {
     return (
       <div className="flex flex-row items-center space-x-2 pt-5">
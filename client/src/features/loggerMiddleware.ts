@@ -4,7 +4,31 @@ import { log } from "./loggerSlice"
 
 import type { RootState } from "@/app/store"
 
+// Lines are sent in batches, at most this many per request and at least this often
+const MAX_BATCH = 100
+const FLUSH_INTERVAL_MS = 2000
+
 export const loggerMiddleware: Middleware<object, RootState> = api => {
+  let pending: string[] = []
+  let flushTimer: ReturnType<typeof setTimeout> | undefined
+
+  const flush = () => {
+    clearTimeout(flushTimer)
+    flushTimer = undefined
+    if (pending.length === 0) {
+      return
+    }
+    const state = api.getState()
+    api.dispatch(
+      apiSlice.endpoints.sendLogMessage.initiate({
+        sessionId: state.multiworld.sessionId,
+        player_id: state.multiworld.player_id,
+        messages: pending,
+      }),
+    )
+    pending = []
+  }
+
   return next => action => {
     if (!isAction(action)) {
       return next(action)
@@ -16,13 +40,12 @@ export const loggerMiddleware: Middleware<object, RootState> = api => {
       if (!originalState.logger.enabled) {
         return next(action)
       }
-      api.dispatch(
-        apiSlice.endpoints.sendLogMessage.initiate({
-          sessionId: originalState.multiworld.sessionId,
-          player_id: originalState.multiworld.player_id,
-          message: `[${new Date().toLocaleString()}] ${action.payload}`,
-        }),
-      )
+      pending.push(`[${new Date().toLocaleString()}] ${action.payload}`)
+      if (pending.length >= MAX_BATCH) {
+        flush()
+      } else if (flushTimer === undefined) {
+        flushTimer = setTimeout(flush, FLUSH_INTERVAL_MS)
+      }
     }
     return next(action)
   }
@@ -211,6 +211,13 @@ function MultiEventText(props: MultiEventTextProps) {
           [{dt}]{" "}
           <span className="font-bold">{from_player_name}</span>:{" "}
           {event_data["message"]}
+          {event.locations && (
+            <ul className="ml-8">
+              {event.locations.map((location, ix) => (
+                <li key={ix}>{location}</li>
+              ))}
+            </ul>
+          )}
         </div>
       )
       break
@@ -18,6 +18,8 @@ import {
   sendReadyResponse,
   sendUnreadyResponse,
   clearReadyCheck,
+  syncPauseState,
+  setResumeToken,
 } from "./multiworldSlice"
 import { nanoid } from "@reduxjs/toolkit"
 import { log } from "../loggerSlice"
@@ -32,6 +34,7 @@ const types_to_adjust = [
   "chat",
   "player_join",
   "player_leave",
+  "resume",
 ]
 
 export const multiworldMiddleware: Middleware<object, RootState> = api => {
@@ -93,6 +96,14 @@ export const multiworldMiddleware: Middleware<object, RootState> = api => {
             api.dispatch(setSramUpdatingOnServer(false))
             break
 
+          case "resume":
+            // Not resumed means the server's state moved on while we were away
+            if (!data.data.resumed) {
+              api.dispatch(syncPauseState(data.data.receiving_paused))
+            }
+            api.dispatch(setResumeToken(data.data.token))
+            break
+
           case "player_join":
             api.dispatch(log(`Player ${data.data.from_player} joined`))
             api.dispatch(
@@ -167,6 +178,7 @@ export const multiworldMiddleware: Middleware<object, RootState> = api => {
                   message: data.data.event_data.message,
                   user_id: data.data.event_data.user_id,
                 },
+                locations: data.data.event_data.locations,
                 id: nanoid(),
               }),
             )
@@ -397,6 +409,7 @@ export const multiworldMiddleware: Middleware<object, RootState> = api => {
         JSON.stringify({
           type: "player_info",
           ...action.payload,
+          resume_token: currentState.multiworld.resume_token,
         }),
       )
       api.dispatch(setInitComplete(true))
@@ -20,6 +20,7 @@ export interface MultiworldSliceState {
   player_id?: number
   receiving?: boolean
   receiving_paused?: boolean
+  resume_token?: string
   init_complete?: boolean
   sram_updating_on_server: boolean
   readyCheckActive: boolean
@@ -91,6 +92,9 @@ export const multiworldSlice = createSlice({
     syncPauseState: (state, action) => {
       state.receiving_paused = action.payload
     },
+    setResumeToken: (state, action) => {
+      state.resume_token = action.payload
+    },
     setPlayerInfo: (state, action) => {
       state.player_id = action.payload.player_id
       state.rom_name = action.payload.rom_name
@@ -178,6 +182,7 @@ export const {
   sendUnreadyResponse,
   clearReadyCheck,
   syncPauseState,
+  setResumeToken,
 } = multiworldSlice.actions
 
 // export const multiworldActions = multiworldSlice.actions
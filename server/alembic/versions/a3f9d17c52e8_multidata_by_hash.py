@@ -0,0 +1,54 @@
+"""Multidata by hash
+
+Revision ID: a3f9d17c52e8
+Revises: e7b1f04c9d26
+Create Date: 2026-10-19 15:02:44.913270
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3f9d17c52e8'
+down_revision: Union[str, None] = 'e7b1f04c9d26'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('multidata',
+    sa.Column('hash', sa.String(), nullable=False),
+    sa.Column('data', sa.JSON(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('clock_timestamp()'), nullable=False),
+    sa.PrimaryKeyConstraint('hash')
+    )
+    op.add_column('mwsessions', sa.Column('multidata_hash', sa.String(), nullable=True))
+    # Existing sessions don't have their uploaded file anymore, they are keyed by a hash of the stored document.
+    # Sessions made from the same upload stored the same text, so they end up sharing one row.
+    op.execute(
+        "UPDATE mwsessions SET multidata_hash = encode(sha256(convert_to(mwdata::text, 'UTF8')), 'hex') "
+        "WHERE mwdata IS NOT NULL"
+    )
+    op.execute(
+        "INSERT INTO multidata (hash, data, created_at) "
+        "SELECT DISTINCT ON (multidata_hash) multidata_hash, mwdata, created_at FROM mwsessions "
+        "WHERE multidata_hash IS NOT NULL ORDER BY multidata_hash, created_at"
+    )
+    op.create_index(op.f('ix_mwsessions_multidata_hash'), 'mwsessions', ['multidata_hash'], unique=False)
+    op.create_foreign_key(None, 'mwsessions', 'multidata', ['multidata_hash'], ['hash'])
+    op.drop_column('mwsessions', 'mwdata')
+
+
+def downgrade() -> None:
+    op.add_column('mwsessions', sa.Column('mwdata', sa.JSON(), nullable=True))
+    op.execute(
+        "UPDATE mwsessions SET mwdata = multidata.data FROM multidata "
+        "WHERE mwsessions.multidata_hash = multidata.hash"
+    )
+    op.drop_constraint('mwsessions_multidata_hash_fkey', 'mwsessions', type_='foreignkey')
+    op.drop_index(op.f('ix_mwsessions_multidata_hash'), table_name='mwsessions')
+    op.drop_column('mwsessions', 'multidata_hash')
+    op.drop_table('multidata')
@@ -0,0 +1,145 @@
+"""Partition events by session and archive finished sessions
+
+Revision ID: b83d2e6f4a17
+Revises: 5c1e0f7a9b42
+Create Date: 2026-10-19 15:02:47.390211
+
+"""
+import json
+import zlib
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b83d2e6f4a17'
+down_revision: Union[str, None] = '5c1e0f7a9b42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+EVENT_PARTITIONS = 16
+
+EVENT_COLUMNS = "id, timestamp, session_id, user_id, from_player, to_player, to_player_idx, item_id, location, event_type, frame_time, event_data"
+
+# Order of the values in each row of an archived_sessions.events blob, a zlib compressed JSON list of rows
+ARCHIVED_EVENT_FIELDS = ("id", "timestamp", "user_id", "from_player", "to_player", "to_player_idx", "item_id", "location", "event_type", "frame_time", "event_data")
+
+
+def upgrade() -> None:
+    # Keep the existing sequence (and therefore the ids clients have already seen), just widen it
+    op.execute("ALTER SEQUENCE events_id_seq OWNED BY NONE")
+    op.execute("ALTER SEQUENCE events_id_seq AS BIGINT")
+
+    op.execute(
+        """
+        CREATE TABLE events_partitioned (
+            id BIGINT NOT NULL DEFAULT nextval('events_id_seq'),
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp(),
+            session_id UUID NOT NULL CONSTRAINT events_session_id_fkey REFERENCES mwsessions (id),
+            user_id INTEGER CONSTRAINT events_user_id_fkey REFERENCES users (id),
+            from_player INTEGER NOT NULL,
+            to_player INTEGER NOT NULL,
+            to_player_idx INTEGER,
+            item_id INTEGER NOT NULL,
+            location INTEGER NOT NULL,
+            event_type eventtypes NOT NULL,
+            frame_time BIGINT,
+            event_data JSON NOT NULL
+        ) PARTITION BY HASH (session_id)
+        """
+    )
+    for remainder in range(EVENT_PARTITIONS):
+        op.execute(
+            f"CREATE TABLE events_p{remainder} PARTITION OF events_partitioned "
+            f"FOR VALUES WITH (MODULUS {EVENT_PARTITIONS}, REMAINDER {remainder})"
+        )
+
+    op.execute(
+        f"INSERT INTO events_partitioned ({EVENT_COLUMNS}) SELECT {EVENT_COLUMNS} FROM events"
+    )
+    op.drop_table('events')
+    op.rename_table('events_partitioned', 'events')
+    op.execute("ALTER SEQUENCE events_id_seq OWNED BY events.id")
+
+    # Indexes are built after the copy, and only the ones the item and session queries actually use
+    op.create_primary_key('events_pkey', 'events', ['id', 'session_id'])
+    op.create_unique_constraint('player_receive_index', 'events', ['session_id', 'to_player', 'to_player_idx'])
+    op.create_index('ix_events_session_id_timestamp', 'events', ['session_id', 'timestamp'], unique=False)
+    op.create_index('ix_events_session_id_from_player_frame_time', 'events', ['session_id', 'from_player', 'frame_time'], unique=False)
+
+    op.create_table('archived_sessions',
+    sa.Column('session_id', sa.UUID(), nullable=False),
+    sa.Column('archived_at', sa.DateTime(timezone=True), server_default=sa.text('clock_timestamp()'), nullable=False),
+    sa.Column('event_count', sa.Integer(), nullable=False),
+    sa.Column('last_event_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('events', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['session_id'], ['mwsessions.id'], ),
+    sa.PrimaryKeyConstraint('session_id')
+    )
+
+
+def restore_archived_events():
+    bind = op.get_bind()
+    insert_event = sa.text(
+        f"INSERT INTO events ({EVENT_COLUMNS}) VALUES (:id, CAST(:timestamp AS TIMESTAMPTZ), :session_id, :user_id, "
+        ":from_player, :to_player, :to_player_idx, :item_id, :location, CAST(:event_type AS eventtypes), "
+        ":frame_time, CAST(:event_data AS JSON))"
+    )
+    # One session at a time, so only one archive is decompressed at once
+    for session_id in bind.execute(sa.text("SELECT session_id FROM archived_sessions")).scalars().all():
+        blob = bind.execute(
+            sa.text("SELECT events FROM archived_sessions WHERE session_id = :session_id"), {"session_id": session_id}
+        ).scalar_one()
+        rows = [dict(zip(ARCHIVED_EVENT_FIELDS, values)) for values in json.loads(zlib.decompress(blob))]
+        for row in rows:
+            row["session_id"] = session_id
+            row["event_data"] = json.dumps(row["event_data"])
+        if rows:
+            bind.execute(insert_event, rows)
+
+
+def downgrade() -> None:
+    # The unpartitioned table has no archive, so archived sessions go back to being plain events
+    restore_archived_events()
+    op.drop_table('archived_sessions')
+
+    op.execute("ALTER SEQUENCE events_id_seq OWNED BY NONE")
+    op.execute(
+        """
+        CREATE TABLE events_unpartitioned (
+            id INTEGER NOT NULL DEFAULT nextval('events_id_seq') PRIMARY KEY,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp(),
+            session_id UUID NOT NULL CONSTRAINT events_session_id_fkey REFERENCES mwsessions (id),
+            user_id INTEGER CONSTRAINT events_user_id_fkey REFERENCES users (id),
+            from_player INTEGER NOT NULL,
+            to_player INTEGER NOT NULL,
+            to_player_idx INTEGER,
+            item_id INTEGER NOT NULL,
+            location INTEGER NOT NULL,
+            event_type eventtypes NOT NULL,
+            frame_time BIGINT,
+            event_data JSON NOT NULL
+        )
+        """
+    )
+    op.execute(
+        f"INSERT INTO events_unpartitioned ({EVENT_COLUMNS}) SELECT {EVENT_COLUMNS} FROM events"
+    )
+    op.drop_table('events')
+    op.rename_table('events_unpartitioned', 'events')
+    op.execute("ALTER SEQUENCE events_id_seq AS INTEGER")
+    op.execute("ALTER SEQUENCE events_id_seq OWNED BY events.id")
+    op.execute("ALTER INDEX events_unpartitioned_pkey RENAME TO events_pkey")
+
+    op.create_unique_constraint('player_receive_index', 'events', ['session_id', 'to_player', 'to_player_idx'])
+    op.create_index('ix_events_session_id_timestamp', 'events', ['session_id', 'timestamp'], unique=False)
+    op.create_index(op.f('ix_events_to_player_idx'), 'events', ['to_player_idx'], unique=False)
+    op.create_index(op.f('ix_events_to_player'), 'events', ['to_player'], unique=False)
+    op.create_index(op.f('ix_events_location'), 'events', ['location'], unique=False)
+    op.create_index(op.f('ix_events_item_id'), 'events', ['item_id'], unique=False)
+    op.create_index(op.f('ix_events_id'), 'events', ['id'], unique=False)
+    op.create_index(op.f('ix_events_from_player'), 'events', ['from_player'], unique=False)
+    op.create_index(op.f('ix_events_frame_time'), 'events', ['frame_time'], unique=False)
+    op.create_index(op.f('ix_events_event_type'), 'events', ['event_type'], unique=False)
@@ -0,0 +1,54 @@
+"""Session messages
+
+Revision ID: c5d82e9a1f04
+Revises: a3f9d17c52e8
+Create Date: 2026-10-19 15:41:09.527803
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c5d82e9a1f04'
+down_revision: Union[str, None] = 'a3f9d17c52e8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+MESSAGE_TYPES = "('player_join', 'failed_join', 'player_leave', 'chat', 'command', 'player_pause_receive', 'player_resume_receive', 'user_join_chat', 'player_kicked')"
+
+MESSAGE_COLUMNS = "id, timestamp, session_id, user_id, event_type, from_player, to_player, event_data"
+
+
+def upgrade() -> None:
+    # Ids come from the events sequence, so events and messages still sort together by id
+    op.execute(
+        """
+        CREATE TABLE session_messages (
+            id BIGINT NOT NULL DEFAULT nextval('events_id_seq') PRIMARY KEY,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp(),
+            session_id UUID NOT NULL CONSTRAINT session_messages_session_id_fkey REFERENCES mwsessions (id),
+            user_id INTEGER CONSTRAINT session_messages_user_id_fkey REFERENCES users (id),
+            event_type eventtypes NOT NULL,
+            from_player INTEGER NOT NULL,
+            to_player INTEGER NOT NULL,
+            event_data JSON NOT NULL
+        )
+        """
+    )
+    op.execute(
+        f"INSERT INTO session_messages ({MESSAGE_COLUMNS}) SELECT {MESSAGE_COLUMNS} FROM events "
+        f"WHERE event_type IN {MESSAGE_TYPES}"
+    )
+    op.execute(f"DELETE FROM events WHERE event_type IN {MESSAGE_TYPES}")
+    op.create_index('ix_session_messages_session_id_id', 'session_messages', ['session_id', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.execute(
+        f"INSERT INTO events ({MESSAGE_COLUMNS}, item_id, location) "
+        f"SELECT {MESSAGE_COLUMNS}, -1, -1 FROM session_messages"
+    )
+    op.drop_table('session_messages')
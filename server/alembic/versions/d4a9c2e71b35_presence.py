@@ -0,0 +1,38 @@
+"""Presence
+
+Revision ID: d4a9c2e71b35
+Revises: b83d2e6f4a17
+Create Date: 2026-10-19 13:52:31.604128
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4a9c2e71b35'
+down_revision: Union[str, None] = 'b83d2e6f4a17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Unlogged: rows only live as long as their heartbeats, so there's nothing worth writing to the WAL or keeping
+    # after a crash
+    op.create_table('presence',
+    sa.Column('session_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('player_id', sa.Integer(), nullable=False),
+    sa.Column('connection_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('worker', sa.String(), nullable=False),
+    sa.Column('heartbeat_at', sa.DateTime(timezone=True), server_default=sa.text('clock_timestamp()'), nullable=False),
+    sa.ForeignKeyConstraint(['session_id'], ['mwsessions.id'], ),
+    sa.PrimaryKeyConstraint('session_id', 'player_id'),
+    prefixes=['UNLOGGED']
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('presence')
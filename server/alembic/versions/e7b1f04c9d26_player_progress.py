@@ -0,0 +1,36 @@
+"""Player progress
+
+Revision ID: e7b1f04c9d26
+Revises: d4a9c2e71b35
+Create Date: 2026-10-19 14:20:07.318554
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7b1f04c9d26'
+down_revision: Union[str, None] = 'd4a9c2e71b35'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Not backfilled, a player's row is built from their events the first time they connect
+    op.create_table('player_progress',
+    sa.Column('session_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('player_id', sa.Integer(), nullable=False),
+    sa.Column('checked', sa.LargeBinary(), nullable=False),
+    sa.Column('receiving_paused', sa.Boolean(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['session_id'], ['mwsessions.id'], ),
+    sa.PrimaryKeyConstraint('session_id', 'player_id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('player_progress')
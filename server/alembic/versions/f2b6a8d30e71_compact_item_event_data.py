@@ -0,0 +1,66 @@
+"""Compact item event data
+
+Revision ID: f2b6a8d30e71
+Revises: c5d82e9a1f04
+Create Date: 2026-10-19 16:10:52.204518
+
+"""
+import json
+import zlib
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2b6a8d30e71'
+down_revision: Union[str, None] = 'c5d82e9a1f04'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Positions of the event type and data in each row of an archived_sessions.events blob
+ARCHIVED_EVENT_TYPE = 8
+ARCHIVED_EVENT_DATA = 10
+
+NAME_KEYS = ('item_name', 'location_name')
+
+
+def compact_archived_events():
+    bind = op.get_bind()
+    # One session at a time, so only one archive is decompressed at once
+    for session_id in bind.execute(sa.text("SELECT session_id FROM archived_sessions")).scalars().all():
+        blob = bind.execute(
+            sa.text("SELECT events FROM archived_sessions WHERE session_id = :session_id"), {"session_id": session_id}
+        ).scalar_one()
+        rows = json.loads(zlib.decompress(blob))
+        compacted = False
+        for row in rows:
+            event_data = row[ARCHIVED_EVENT_DATA]
+            if row[ARCHIVED_EVENT_TYPE] == 'new_item' and any(key in event_data for key in NAME_KEYS):
+                row[ARCHIVED_EVENT_DATA] = {key: value for key, value in event_data.items() if key not in NAME_KEYS}
+                compacted = True
+        if compacted:
+            events = zlib.compress(json.dumps(rows, separators=(",", ":")).encode(), 9)
+            bind.execute(
+                sa.text("UPDATE archived_sessions SET events = :events WHERE session_id = :session_id"),
+                {"events": events, "session_id": session_id},
+            )
+
+
+def upgrade() -> None:
+    # Item and location names are added from server.data when events are sent, the stored copies are never read
+    op.execute(
+        """
+        UPDATE events
+        SET event_data = (event_data::jsonb - 'item_name' - 'location_name')::json
+        WHERE event_type = 'new_item' AND event_data::jsonb ?| array['item_name', 'location_name']
+        """
+    )
+    # Archived sessions are read back the same way, so their events lose the names too
+    compact_archived_events()
+
+
+def downgrade() -> None:
+    # Nothing to restore, every reader fills the names in from server.data
+    pass
@@ -0,0 +1,89 @@
+import asyncio
+import datetime
+import logging
+import os
+
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+
+from . import crud, models
+from .database import SessionLocal
+from .utils import TIME_TO_IDLE, get_session_players_info_from_db, get_session_status
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_INTERVAL_MINUTES = int(os.environ.get("ARCHIVE_INTERVAL_MINUTES", 60))
+# Chat and control messages are only kept this long, items and forfeits stay in the events table or archive
+MESSAGE_RETENTION_DAYS = int(os.environ.get("MESSAGE_RETENTION_DAYS", 30))
+# Completed sessions stay live for a while so players can look over the results together
+COMPLETED_ARCHIVE_DELAY = datetime.timedelta(hours=12)
+# Only one worker should be archiving at a time
+ARCHIVE_LOCK_KEY = 0x574D4152
+
+
+def get_archive_candidates(db: Session) -> list[tuple]:
+    last_change = crud.SORT_COLUMNS["lastChangeTimestamp"]
+    cutoff = datetime.datetime.now(datetime.UTC) - COMPLETED_ARCHIVE_DELAY
+    return db.execute(
+        select(models.MWSession.id, last_change)
+        .where(~models.MWSession.archive.has())
+        .where(last_change < cutoff)
+        .order_by(models.MWSession.created_at)
+    ).all()
+
+
+def archive_finished_sessions(db: Session) -> int:
+    """Archives the events of every session that is inactive, or completed and quiet for a while."""
+    archived = 0
+    with db.get_bind().connect() as lock_conn:
+        if not lock_conn.execute(
+            text("SELECT pg_try_advisory_lock(:key)"), {"key": ARCHIVE_LOCK_KEY}
+        ).scalar():
+            return 0
+        try:
+            idle_cutoff = datetime.datetime.now(datetime.UTC) - TIME_TO_IDLE
+            for session_id, last_change in get_archive_candidates(db):
+                if last_change > idle_cutoff:
+                    session = crud.get_session(db, session_id)
+                    player_datas = get_session_players_info_from_db(db, session)
+                    if get_session_status(player_datas, last_change.timestamp()) != "completed":
+                        continue
+                if crud.archive_session_events(db, session_id):
+                    archived += 1
+        finally:
+            lock_conn.execute(
+                text("SELECT pg_advisory_unlock(:key)"), {"key": ARCHIVE_LOCK_KEY}
+            )
+    if archived:
+        logger.info(f"Archived {archived} sessions")
+    return archived
+
+
+def delete_expired_messages(db: Session) -> int:
+    if MESSAGE_RETENTION_DAYS <= 0:
+        return 0
+    cutoff = datetime.datetime.now(datetime.UTC) - datetime.timedelta(days=MESSAGE_RETENTION_DAYS)
+    deleted = crud.delete_session_messages_before(db, cutoff)
+    if deleted:
+        logger.info(f"Deleted {deleted} session messages older than {MESSAGE_RETENTION_DAYS} days")
+    return deleted
+
+
+def _run_archive():
+    db = SessionLocal()
+    try:
+        delete_expired_messages(db)
+        return archive_finished_sessions(db)
+    finally:
+        db.close()
+
+
+async def archive_loop():
+    if ARCHIVE_INTERVAL_MINUTES <= 0:
+        return
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL_MINUTES * 60)
+        try:
+            await asyncio.to_thread(_run_archive)
+        except Exception as e:
+            logger.error(f"Error archiving sessions: {e}")
@@ -1,23 +1,24 @@
+import base64
+import codecs
 import datetime
+import heapq
+import itertools
 import json
 import logging
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import Iterator
 from sqlalchemy.orm import Session
 from sqlalchemy.dialects.postgresql import insert as postgres_upsert
-from sqlalchemy import func, or_, desc, asc, select
+from sqlalchemy import func, or_, desc, asc, delete, insert, select, tuple_, union, update
 
 from . import models, schemas
 
 logger = logging.getLogger(__name__)
 
 
-def add_log_entry(db: Session, log_entry: schemas.LogEntryCreate):
-    db_log_entry = models.Log(**log_entry.model_dump())
-    db.add(db_log_entry)
-    db.commit()
-    db.refresh(db_log_entry)
-    return db_log_entry
-
-
 def create_user(db: Session, user: schemas.UserCreate):
     db_user = models.User(**user.model_dump())
     db.add(db_user)
@@ -282,6 +283,7 @@ def add_owner_to_session(db: Session, session_id: str, user_id: int):
     logger.debug(f"Adding user {db_user.id} to session {db_session.id}")
     db_session.owners.append(db_user)
     db.commit()
+    invalidate_session_counts()
     db.refresh(db_session)
     db.refresh(db_user)
     logger.debug(
@@ -301,6 +303,7 @@ def add_user_to_session(
     db_user.sessions.append(assoc)
     db_session.users.append(assoc)
     db.commit()
+    invalidate_session_counts()
     db.refresh(db_user)
     db.refresh(db_session)
 
@@ -320,19 +323,27 @@ def get_sessions(db: Session, skip: int = 0, limit: int = 0, game_id: int = 1):
     return all_sessions.offset(skip).limit(limit).all()
 
 
+def _user_session_ids(user_id: int):
+    """Ids of sessions a user owns, has joined, or that are owned by one of their bots."""
+    owned = select(models.OwnedSessions.session_id).where(
+        models.OwnedSessions.user_id == user_id
+    )
+    joined = select(models.UserSessions.session_id).where(
+        models.UserSessions.user_id == user_id
+    )
+    bot_owned = (
+        select(models.OwnedSessions.session_id)
+        .join(models.User, models.User.id == models.OwnedSessions.user_id)
+        .where(models.User.bot_owner_id == user_id)
+    )
+    return union(owned, joined, bot_owned).subquery()
+
+
 def _user_sessions_query(db: Session, user_id: int):
     """Base query for sessions a user owns or has joined."""
-    user = db.query(models.User).filter(models.User.id == user_id).first()
-    bot_ids = [bot.id for bot in user.bots] if user and user.bots else []
-
-    return db.query(models.MWSession).outerjoin(
-        models.UserSessions, models.MWSession.id == models.UserSessions.session_id
-    ).outerjoin(models.User, models.User.id == models.UserSessions.user_id).filter(
-        or_(
-            models.MWSession.owners.any(models.User.id == user_id),
-            models.UserSessions.user_id == user_id,
-            models.MWSession.owners.any(models.User.id.in_(bot_ids))
-        )
+    session_ids = _user_session_ids(user_id)
+    return db.query(models.MWSession).filter(
+        models.MWSession.id.in_(select(session_ids.c.session_id))
     )
 
 
@@ -346,33 +357,148 @@ def get_user_sessions(db: Session, user_id: int, skip: int = 0, limit: int = 0):
 SORT_COLUMNS = {
     "createdTimestamp": models.MWSession.created_at,
     "race": models.MWSession.tournament,
-    "lastChangeTimestamp": (
-        select(func.coalesce(func.max(models.Event.timestamp), models.MWSession.created_at))
-        .where(models.Event.session_id == models.MWSession.id)
+    "lastChangeTimestamp": func.coalesce(
+        # greatest() skips NULLs, a session with only messages or only events still has a last change
+        func.greatest(
+            select(func.max(models.Event.timestamp))
+            .where(models.Event.session_id == models.MWSession.id)
+            .correlate(models.MWSession)
+            .scalar_subquery(),
+            select(func.max(models.SessionMessage.timestamp))
+            .where(models.SessionMessage.session_id == models.MWSession.id)
+            .correlate(models.MWSession)
+            .scalar_subquery(),
+        ),
+        select(models.ArchivedSession.last_event_at)
+        .where(models.ArchivedSession.session_id == models.MWSession.id)
         .correlate(models.MWSession)
-        .scalar_subquery()
+        .scalar_subquery(),
+        models.MWSession.created_at,
     ),
 }
 
+# Totals only drive the page count on the dashboard, so they are allowed to lag
+SESSION_COUNT_TTL = 30
+SESSION_COUNTS = 1000
+# Ordered by expiry, every entry lives SESSION_COUNT_TTL from when it was stored
+_session_count_cache: OrderedDict[tuple, tuple[float, int]] = OrderedDict()
+
+
+def _cached_session_count(key: tuple, count_query) -> int:
+    now = time.monotonic()
+    cached = _session_count_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+    total = count_query()
+    _session_count_cache[key] = (now + SESSION_COUNT_TTL, total)
+    _session_count_cache.move_to_end(key)
+    while len(_session_count_cache) > SESSION_COUNTS or next(iter(_session_count_cache.values()))[0] <= now:
+        _session_count_cache.popitem(last=False)
+    return total
+
+
+def invalidate_session_counts():
+    _session_count_cache.clear()
+
+
+def encode_session_cursor(sort_by: str, sort_dir: str, value, session_id) -> str:
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    raw = json.dumps([sort_by, sort_dir, value, str(session_id)])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_session_cursor(cursor: str, sort_by: str, sort_dir: str):
+    """Returns the (sort value, session id) a page should continue after, or None if the cursor doesn't apply."""
+    try:
+        c_sort_by, c_sort_dir, value, session_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode())
+        )
+        if c_sort_by != sort_by or c_sort_dir != sort_dir:
+            return None
+        if sort_by == "race":
+            value = bool(value)
+        else:
+            value = datetime.datetime.fromisoformat(value)
+        return value, uuid.UUID(session_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def _keyset_page(
+    q,
+    limit: int,
+    skip: int = 0,
+    sort_by: str = "createdTimestamp",
+    sort_dir: str = "desc",
+    cursor: str | None = None,
+):
+    """
+    Orders by the sort column with the session id as a tie breaker. When a cursor from the previous page is given
+    the page starts directly after it instead of using OFFSET, so deep pages cost the same as the first one.
+    """
+    if sort_by not in SORT_COLUMNS:
+        sort_by = "createdTimestamp"
+    col = SORT_COLUMNS[sort_by]
+    key = tuple_(col, models.MWSession.id)
+
+    after = decode_session_cursor(cursor, sort_by, sort_dir) if cursor else None
+    if after:
+        q = q.filter(key < tuple_(*after) if sort_dir == "desc" else key > tuple_(*after))
+        skip = 0
+
+    if sort_dir == "desc":
+        q = q.order_by(desc(col), desc(models.MWSession.id))
+    else:
+        q = q.order_by(asc(col), asc(models.MWSession.id))
 
-def _apply_sort(q, sort_by: str = "createdTimestamp", sort_dir: str = "desc"):
-    col = SORT_COLUMNS.get(sort_by, models.MWSession.created_at)
-    order = desc(col) if sort_dir == "desc" else asc(col)
-    return q.order_by(order)
+    rows = q.add_columns(col).offset(skip).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_session, last_value = rows[-1]
+        next_cursor = encode_session_cursor(sort_by, sort_dir, last_value, last_session.id)
+    return [x[0] for x in rows], next_cursor
 
 
-def get_sessions_paginated(db: Session, skip: int = 0, limit: int = 10, game_id: int = 1, sort_by: str = "createdTimestamp", sort_dir: str = "desc"):
+def get_sessions_paginated(
+    db: Session,
+    skip: int = 0,
+    limit: int = 10,
+    game_id: int = 1,
+    sort_by: str = "createdTimestamp",
+    sort_dir: str = "desc",
+    cursor: str | None = None,
+):
     q = db.query(models.MWSession).filter(models.MWSession.game_id == game_id)
-    total = q.count()
-    items = _apply_sort(q, sort_by, sort_dir).offset(skip).limit(limit).all()
-    return items, total
+    total = _cached_session_count(
+        ("game", game_id),
+        lambda: db.query(func.count(models.MWSession.id))
+        .filter(models.MWSession.game_id == game_id)
+        .scalar(),
+    )
+    items, next_cursor = _keyset_page(q, limit, skip, sort_by, sort_dir, cursor)
+    return items, total, next_cursor
 
 
-def get_user_sessions_paginated(db: Session, user_id: int, skip: int = 0, limit: int = 10, sort_by: str = "createdTimestamp", sort_dir: str = "desc"):
+def get_user_sessions_paginated(
+    db: Session,
+    user_id: int,
+    skip: int = 0,
+    limit: int = 10,
+    sort_by: str = "createdTimestamp",
+    sort_dir: str = "desc",
+    cursor: str | None = None,
+):
     q = _user_sessions_query(db, user_id)
-    total = q.count()
-    items = _apply_sort(q, sort_by, sort_dir).offset(skip).limit(limit).all()
-    return items, total
+    total = _cached_session_count(
+        ("user", user_id),
+        lambda: db.execute(
+            select(func.count()).select_from(_user_session_ids(user_id))
+        ).scalar(),
+    )
+    items, next_cursor = _keyset_page(q, limit, skip, sort_by, sort_dir, cursor)
+    return items, total, next_cursor
 
 
 def get_user_session_links(db: Session, session_id: str):
@@ -383,6 +509,18 @@ def get_user_session_links(db: Session, session_id: str):
     )
 
 
+def get_session_player_users(db: Session, session_id: str) -> dict[int, models.User]:
+    """The user linked to each player of the session, in one query."""
+    return dict(
+        db.execute(
+            select(models.UserSessions.player_id, models.User)
+            .join(models.User, models.User.id == models.UserSessions.user_id)
+            .where(models.UserSessions.session_id == session_id)
+            .order_by(models.UserSessions.id)
+        ).all()
+    )
+
+
 def create_user_session_link(
     db: Session, user_id: int, session_id: str, player_id: str
 ):
@@ -399,6 +537,7 @@ def create_user_session_link(
     )
     db.add(db_user_session)
     db.commit()
+    invalidate_session_counts()
     db.refresh(db_user_session)
     return db_user_session
 
@@ -412,94 +551,284 @@ def get_last_event(db: Session, session_id: str):
     )
 
 
-def get_events(db: Session, skip: int = 0, limit: int = 0, session_id: str = None):
-    if limit <= 0:
-        if session_id:
-            return (
-                db.query(models.Event)
-                .filter(models.Event.session_id == session_id)
-                .offset(skip)
-                .all()
-            )
-        return db.query(models.Event).offset(skip).all()
-    if session_id:
-        return (
-            db.query(models.Event)
-            .filter(models.Event.session_id == session_id)
-            .offset(skip)
-            .limit(limit)
-            .all()
+def get_last_message_timestamp(db: Session, session_id: str) -> datetime.datetime | None:
+    return db.scalar(
+        select(func.max(models.SessionMessage.timestamp)).where(
+            models.SessionMessage.session_id == session_id
         )
-    return db.query(models.Event).offset(skip).limit(limit).all()
+    )
 
 
-def get_events_for_player(
-    db: Session, session_id: str, player_id: int, skip: int = 0, limit: int = 0
-) -> list[models.Event]:
-    if limit <= 0:
-        return (
-            db.query(models.Event)
-            .filter(models.Event.session_id == session_id)
-            .filter(models.Event.to_player == player_id)
-            .offset(skip)
-            .all()
-        )
+def get_last_event_timestamp(db: Session, session_id: str) -> datetime.datetime | None:
+    """Time of the session's last event or message."""
+    last_event = get_last_event(db, session_id)
+    if last_event:
+        last_change = last_event.timestamp
+    else:
+        archived = get_archived_session(db, session_id)
+        last_change = archived.last_event_at if archived else None
+    last_message = get_last_message_timestamp(db, session_id)
+    if last_change is None or (last_message is not None and last_message > last_change):
+        return last_message
+    return last_change
+
+
+def get_session_messages(db: Session, session_id: str) -> list[models.SessionMessage]:
+    return (
+        db.query(models.SessionMessage)
+        .filter(models.SessionMessage.session_id == session_id)
+        .order_by(models.SessionMessage.id)
+        .all()
+    )
+
+
+def get_events(db: Session, skip: int = 0, limit: int = 0, session_id: str = None):
+    """A session's events and messages in the order they happened, or every event without a session."""
+    if not session_id:
+        query = db.query(models.Event).offset(skip)
+        return query.all() if limit <= 0 else query.limit(limit).all()
+    archived = get_archived_session(db, session_id)
+    # Anything written after the session was archived is still in the events table
+    events = itertools.chain(
+        get_archived_events(archived) if archived else (),
+        db.query(models.Event).filter(models.Event.session_id == session_id).order_by(models.Event.id),
+    )
+    # Ids of both come from the events sequence
+    all_events = heapq.merge(events, get_session_messages(db, session_id), key=lambda x: x.id)
+    return list(itertools.islice(all_events, skip, None if limit <= 0 else skip + limit))
+
+
+ARCHIVE_RESTORE_BATCH = 1000
+ARCHIVE_READ_SIZE = 64 * 1024
+
+ARCHIVED_EVENT_FIELDS = (
+    "id",
+    "timestamp",
+    "user_id",
+    "from_player",
+    "to_player",
+    "to_player_idx",
+    "item_id",
+    "location",
+    "event_type",
+    "frame_time",
+    "event_data",
+)
+
+
+def get_archived_session(db: Session, session_id: str) -> models.ArchivedSession | None:
     return (
+        db.query(models.ArchivedSession)
+        .filter(models.ArchivedSession.session_id == session_id)
+        .first()
+    )
+
+
+def event_to_archive_row(event: models.Event) -> list:
+    return [
+        event.id,
+        event.timestamp.isoformat(),
+        event.user_id,
+        event.from_player,
+        event.to_player,
+        event.to_player_idx,
+        event.item_id,
+        event.location,
+        event.event_type.name,
+        event.frame_time,
+        event.event_data,
+    ]
+
+
+def archive_row_to_event_fields(values: list, session_id) -> dict:
+    row = dict(zip(ARCHIVED_EVENT_FIELDS, values))
+    row["session_id"] = session_id
+    row["timestamp"] = datetime.datetime.fromisoformat(row["timestamp"])
+    row["event_type"] = models.EventTypes[row["event_type"]]
+    return row
+
+
+MESSAGE_FIELDS = {
+    "id",
+    "timestamp",
+    "session_id",
+    "user_id",
+    "event_type",
+    "from_player",
+    "to_player",
+    "event_data",
+}
+
+
+def insert_event_rows(db: Session, rows: list[dict]):
+    """
+    Bulk inserts event fields as read back from an archive or export, messages into session_messages. Bulk, so the
+    after_insert listeners don't broadcast them.
+    """
+    events = [row for row in rows if row["event_type"] not in models.MESSAGE_EVENT_TYPES]
+    messages = [
+        {key: value for key, value in row.items() if key in MESSAGE_FIELDS}
+        for row in rows
+        if row["event_type"] in models.MESSAGE_EVENT_TYPES
+    ]
+    if events:
+        db.execute(insert(models.Event), events)
+    if messages:
+        db.execute(insert(models.SessionMessage), messages)
+
+
+def delete_session_messages_before(db: Session, cutoff: datetime.datetime) -> int:
+    deleted = db.execute(
+        delete(models.SessionMessage).where(models.SessionMessage.timestamp < cutoff)
+    ).rowcount
+    db.commit()
+    return deleted
+
+
+def _archive_text(blob: bytes) -> Iterator[str]:
+    decompressor = zlib.decompressobj()
+    text = codecs.getincrementaldecoder("utf-8")()
+    for start in range(0, len(blob), ARCHIVE_READ_SIZE):
+        yield text.decode(decompressor.decompress(blob[start : start + ARCHIVE_READ_SIZE]))
+    yield text.decode(decompressor.flush(), final=True)
+
+
+def _archive_values(blob: bytes) -> Iterator[list]:
+    """
+    The rows of an archive's JSON list, decompressed and parsed a chunk at a time so only the row being read and
+    the rest of its chunk are held. Each row is a list itself, so one cut off at the end of a chunk fails to parse
+    and is read again once the next chunk is added.
+    """
+    decoder = json.JSONDecoder()
+    pending = ""
+    opened = False
+    for chunk in _archive_text(blob):
+        pending += chunk
+        pos = 0
+        while True:
+            while pos < len(pending) and pending[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(pending) or pending[pos] == "]":
+                break
+            if not opened:
+                if pending[pos] != "[":
+                    raise ValueError("Archived events aren't a JSON list")
+                opened = True
+                pos += 1
+                continue
+            try:
+                values, pos = decoder.raw_decode(pending, pos)
+            except json.JSONDecodeError:
+                break
+            yield values
+        pending = pending[pos:]
+    if pending.strip() != "]":
+        raise ValueError("Archived events are cut off")
+
+
+def _archived_event_rows(archived: models.ArchivedSession) -> Iterator[dict]:
+    for values in _archive_values(archived.events):
+        yield archive_row_to_event_fields(values, archived.session_id)
+
+
+def get_archived_events(archived: models.ArchivedSession) -> Iterator[models.Event]:
+    """Archived events as transient Event objects, built one at a time. They are never added to the db session."""
+    for row in _archived_event_rows(archived):
+        yield models.Event(**row)
+
+
+def archive_session_events(db: Session, session_id: str) -> models.ArchivedSession | None:
+    """Moves all events of a session into a single compressed archived_sessions row."""
+    # Locking the session row blocks new events (their FK check needs a share lock on it) until we're done
+    db.execute(
+        select(models.MWSession.id)
+        .where(models.MWSession.id == session_id)
+        .with_for_update()
+    )
+    if get_archived_session(db, session_id):
+        db.rollback()
+        return None
+
+    events = (
         db.query(models.Event)
         .filter(models.Event.session_id == session_id)
-        .filter(models.Event.to_player == player_id)
-        .offset(skip)
-        .limit(limit)
+        .order_by(models.Event.id)
         .all()
     )
+    rows = [event_to_archive_row(event) for event in events]
+    archived = models.ArchivedSession(
+        session_id=session_id,
+        event_count=len(events),
+        last_event_at=max((x.timestamp for x in events), default=None),
+        events=zlib.compress(json.dumps(rows, separators=(",", ":")).encode(), 9),
+    )
+    db.add(archived)
+    db.query(models.Event).filter(models.Event.session_id == session_id).delete(
+        synchronize_session=False
+    )
+    db.commit()
+    return archived
 
 
-def get_events_after_frametime(
-    db: Session,
-    session_id: str,
-    player_id: int,
-    frame_time: int,
-    skip: int = 0,
-    limit: int = 0,
+def restore_archived_session(db: Session, session_id: str) -> bool:
+    """Moves archived events back into the events table, used before anything writes to the session again."""
+    archived = get_archived_session(db, session_id)
+    if not archived:
+        return False
+    rows = _archived_event_rows(archived)
+    restored = 0
+    # Archives made before messages had their own table have them mixed in
+    while batch := list(itertools.islice(rows, ARCHIVE_RESTORE_BATCH)):
+        insert_event_rows(db, batch)
+        restored += len(batch)
+    logger.info(f"Restored {restored} archived events for session {session_id}")
+    db.delete(archived)
+    db.commit()
+    return True
+
+
+def get_events_for_player(
+    db: Session, session_id: str, player_id: int, skip: int = 0, limit: int = 0
 ) -> list[models.Event]:
     if limit <= 0:
         return (
             db.query(models.Event)
             .filter(models.Event.session_id == session_id)
-            .filter(models.Event.from_player == player_id)
-            .filter(models.Event.frame_time >= frame_time)
+            .filter(models.Event.to_player == player_id)
             .offset(skip)
             .all()
         )
     return (
         db.query(models.Event)
         .filter(models.Event.session_id == session_id)
-        .filter(models.Event.from_player == player_id)
-        .filter(models.Event.frame_time >= frame_time)
+        .filter(models.Event.to_player == player_id)
         .offset(skip)
         .limit(limit)
         .all()
     )
 
 
-def update_events_frametime(
-    db: Session,
-    session_id: str,
-    player_id: int,
-    events: list[schemas.EventCreate],
-    frame_time: int,
-):
-    for event in events:
-        db_event = (
-            db.query(models.Event)
-            .filter(models.Event.session_id == session_id)
-            .filter(models.Event.from_player == player_id)
-            .filter(models.Event.id == event.id)
-            .first()
+def clear_events_frametime_after(
+    db: Session, session_id: str, player_id: int, frame_time: int
+) -> list[int]:
+    """
+    Clears the frame time of every event the player created at or after frame_time, for when their game went
+    back in time (save scum or reset), in one statement. Returns the locations of the cleared events.
+    """
+    locations = (
+        db.execute(
+            update(models.Event)
+            .where(models.Event.session_id == session_id)
+            .where(models.Event.from_player == player_id)
+            .where(models.Event.frame_time >= frame_time)
+            .values(frame_time=None)
+            .returning(models.Event.location)
         )
-        db_event.frame_time = frame_time
+        .scalars()
+        .all()
+    )
     db.commit()
-    return True
+    return locations
 
 
 def get_items_for_player_from_others(
@@ -569,6 +898,25 @@ def create_game(db: Session, game: schemas.GameCreate):
     return db_game
 
 
+def store_multidata(db: Session, multidata_hash: str, data: dict):
+    """Stores the multidata document unless a document with the same hash already is. Doesn't commit."""
+    stored = db.scalar(
+        select(models.Multidata.hash).where(models.Multidata.hash == multidata_hash)
+    )
+    if stored:
+        return
+    if db.get_bind().dialect.name == "postgresql":
+        # The same file may be uploaded twice at once
+        db.execute(
+            postgres_upsert(models.Multidata)
+            .values(hash=multidata_hash, data=data)
+            .on_conflict_do_nothing()
+        )
+    else:
+        db.add(models.Multidata(hash=multidata_hash, data=data))
+        db.flush()
+
+
 def create_session(
     db: Session,
     session: schemas.MWSessionCreate,
@@ -586,11 +934,22 @@ def create_session(
 
     db.add(db_session)
     db.commit()
+    invalidate_session_counts()
     db.refresh(db_session)
     return db_session
 
 
+def _message_from(event: schemas.EventCreate) -> models.SessionMessage:
+    return models.SessionMessage(**event.model_dump(include=MESSAGE_FIELDS))
+
+
 def create_event(db: Session, event: schemas.EventCreate):
+    if event.event_type in models.MESSAGE_EVENT_TYPES:
+        db_message = _message_from(event)
+        db.add(db_message)
+        db.commit()
+        db.refresh(db_message)
+        return db_message
     db_event = models.Event(**event.model_dump())
     # If this is a new item, find the last item sent to the player from other players and increment the to_player_idx by 1
     if db_event.event_type == models.EventTypes.new_item:
@@ -664,6 +1023,40 @@ def create_forfeit_events(
     return True
 
 
+def create_kick_events(
+    db: Session,
+    session_id: str,
+    kicked_by: int,
+    player_id: int,
+    player_name: str,
+    connected: bool,
+) -> models.SessionMessage:
+    """
+    Adds the player_kicked message, and a player_leave for the player if they are connected, and flushes them.
+    The transaction is left open for the caller to commit, so both rows land together.
+    """
+    kicked = models.SessionMessage(
+        session_id=session_id,
+        event_type=models.EventTypes.player_kicked,
+        from_player=kicked_by,
+        to_player=player_id,
+        event_data={"player_id": player_id},
+    )
+    db.add(kicked)
+    if connected:
+        db.add(
+            models.SessionMessage(
+                session_id=session_id,
+                event_type=models.EventTypes.player_leave,
+                from_player=player_id,
+                to_player=-1,
+                event_data={"player_id": player_id, "player_name": player_name},
+            )
+        )
+    db.flush()
+    return kicked
+
+
 def create_sramstore(db: Session, sramstore: schemas.SRAMStoreCreate):
     db_sramstore = models.SRAMStore(**sramstore.model_dump())
     db.add(db_sramstore)
@@ -713,36 +1106,176 @@ def get_sramstore(db: Session, session_id: str, player_id: int):
     )
 
 
-def get_player_connection_events(db: Session, session_id: str, player_id: int):
-    return (
-        db.query(models.Event)
-        .filter(models.Event.session_id == session_id)
-        .filter(models.Event.from_player == player_id)
-        .filter(
-            or_(
-                models.Event.event_type == models.EventTypes.player_join,
-                models.Event.event_type == models.EventTypes.player_leave,
+def get_sramstores(db: Session, session_id: str) -> dict[int, models.SRAMStore]:
+    """Every stored SRAM of the session by player, in one query."""
+    return {
+        x.player: x
+        for x in db.query(models.SRAMStore).filter(models.SRAMStore.session_id == session_id)
+    }
+
+
+def claim_presence(
+    db: Session,
+    session_id: uuid.UUID,
+    player_id: int,
+    connection_id: uuid.UUID,
+    worker: str,
+    expire_seconds: float,
+) -> bool:
+    """Records the connection as the player's, unless another one has a heartbeat newer than expire_seconds."""
+    stmt = postgres_upsert(models.Presence).values(
+        session_id=session_id,
+        player_id=player_id,
+        connection_id=connection_id,
+        worker=worker,
+        heartbeat_at=func.clock_timestamp(),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.Presence.session_id, models.Presence.player_id],
+        set_={
+            "connection_id": stmt.excluded.connection_id,
+            "worker": stmt.excluded.worker,
+            "heartbeat_at": stmt.excluded.heartbeat_at,
+        },
+        where=models.Presence.heartbeat_at
+        < func.clock_timestamp() - datetime.timedelta(seconds=expire_seconds),
+    ).returning(models.Presence.connection_id)
+    claimed = db.execute(stmt).first() is not None
+    db.commit()
+    return claimed
+
+
+def delete_presence(db: Session, connection_id: uuid.UUID):
+    db.execute(delete(models.Presence).where(models.Presence.connection_id == connection_id))
+    db.commit()
+
+
+def refresh_presence(db: Session, connection_ids: list[uuid.UUID], expire_seconds: float):
+    """Heartbeats the given connections and removes every row that has expired, whichever worker it was from."""
+    if connection_ids:
+        db.execute(
+            update(models.Presence)
+            .where(models.Presence.connection_id.in_(connection_ids))
+            .values(heartbeat_at=func.clock_timestamp())
+        )
+    db.execute(
+        delete(models.Presence).where(
+            models.Presence.heartbeat_at
+            < func.clock_timestamp() - datetime.timedelta(seconds=expire_seconds)
+        )
+    )
+    db.commit()
+
+
+def get_present_players(db: Session, session_id: uuid.UUID, expire_seconds: float) -> set[int]:
+    return set(
+        db.execute(
+            select(models.Presence.player_id)
+            .where(models.Presence.session_id == session_id)
+            .where(
+                models.Presence.heartbeat_at
+                >= func.clock_timestamp() - datetime.timedelta(seconds=expire_seconds)
             )
         )
-        # .all()
-        .order_by(models.Event.timestamp.desc())
+        .scalars()
         .all()
-        # .first()
     )
 
 
 def is_player_receiving_paused(db: Session, session_id: str, player_id: int) -> bool:
     latest = (
-        db.query(models.Event)
-        .filter(models.Event.session_id == session_id)
-        .filter(models.Event.from_player == player_id)
+        db.query(models.SessionMessage)
+        .filter(models.SessionMessage.session_id == session_id)
+        .filter(models.SessionMessage.from_player == player_id)
         .filter(
             or_(
-                models.Event.event_type == models.EventTypes.player_pause_receive,
-                models.Event.event_type == models.EventTypes.player_resume_receive,
+                models.SessionMessage.event_type == models.EventTypes.player_pause_receive,
+                models.SessionMessage.event_type == models.EventTypes.player_resume_receive,
             )
         )
-        .order_by(models.Event.timestamp.desc())
+        .order_by(models.SessionMessage.id.desc())
         .first()
     )
     return latest is not None and latest.event_type == models.EventTypes.player_pause_receive
+
+
+def get_players_receiving_paused_from_messages(db: Session, session_id: str) -> dict[int, bool]:
+    """is_player_receiving_paused for every player that paused or resumed, in one query."""
+    last_ids = (
+        select(func.max(models.SessionMessage.id).label("id"))
+        .where(models.SessionMessage.session_id == session_id)
+        .where(
+            models.SessionMessage.event_type.in_(
+                [models.EventTypes.player_pause_receive, models.EventTypes.player_resume_receive]
+            )
+        )
+        .group_by(models.SessionMessage.from_player)
+        .subquery()
+    )
+    latest = db.execute(
+        select(models.SessionMessage.from_player, models.SessionMessage.event_type).join(
+            last_ids, models.SessionMessage.id == last_ids.c.id
+        )
+    ).all()
+    return {
+        player_id: event_type == models.EventTypes.player_pause_receive
+        for player_id, event_type in latest
+    }
+
+
+def get_player_progress(db: Session, session_id: uuid.UUID, player_id: int) -> models.PlayerProgress | None:
+    return db.execute(
+        select(models.PlayerProgress)
+        .where(models.PlayerProgress.session_id == session_id)
+        .where(models.PlayerProgress.player_id == player_id)
+        .execution_options(populate_existing=True)
+    ).scalar_one_or_none()
+
+
+def update_player_progress(
+    db: Session,
+    session_id: uuid.UUID,
+    player_id: int,
+    checked: int = 0,
+    receiving_paused: bool | None = None,
+) -> models.PlayerProgress:
+    """
+    Adds the checked location bits to the player's progress and sets what else is given, creating the row if it is
+    missing. The row is locked while it is merged, so writes from several workers don't lose each other's checks.
+    """
+    db.execute(
+        postgres_upsert(models.PlayerProgress)
+        .values(
+            session_id=session_id,
+            player_id=player_id,
+            checked=b"",
+            receiving_paused=False,
+            version=0,
+        )
+        .on_conflict_do_nothing()
+    )
+    progress = db.execute(
+        select(models.PlayerProgress)
+        .where(models.PlayerProgress.session_id == session_id)
+        .where(models.PlayerProgress.player_id == player_id)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    ).scalar_one()
+    checked |= int.from_bytes(progress.checked, "little")
+    progress.checked = checked.to_bytes((checked.bit_length() + 7) // 8, "little")
+    if receiving_paused is not None:
+        progress.receiving_paused = receiving_paused
+    progress.version += 1
+    db.commit()
+    return progress
+
+
+def get_players_receiving_paused(db: Session, session_id: uuid.UUID) -> dict[int, bool]:
+    """Receiving paused state of every player with a progress row, for players_info."""
+    return dict(
+        db.execute(
+            select(models.PlayerProgress.player_id, models.PlayerProgress.receiving_paused).where(
+                models.PlayerProgress.session_id == session_id
+            )
+        ).all()
+    )
@@ -10,24 +10,41 @@ with open("./server/data/webmulti_lookup_id_to_name.json", "r") as f:
 with open("./server/data/webmulti_item_table.json", "r") as f:
     item_table = json.load(f)
 
+lookup_id_to_name['0'] = "Admin Send"
+lookup_name_to_id = {v: k for k, v in lookup_id_to_name.items()}
+item_table_reversed = {v: k for k, v in item_table.items()}
+
+# Int-keyed tables for the per-event paths, so they don't format or parse ids. Item ids are small, item tables are
+# tuples indexed by id. Location ids go up into the hundreds of millions, so locations are dicts keyed by int.
+item_name_by_id = tuple(
+    item_table.get(str(item_id)) for item_id in range(max(map(int, item_table)) + 1)
+)
+# Items that share a name are all sent with the one id item_table_reversed has for it
+item_send_id = tuple(
+    None if name is None else int(item_table_reversed[name]) for name in item_name_by_id
+)
+location_name_by_id = {int(k): v for k, v in lookup_id_to_name.items()}
+location_id_by_name = {k: int(v) for k, v in lookup_name_to_id.items()}
+
+# What the SRAM decoder reads, with location ids instead of names
 location_info_by_room = defaultdict(lambda: defaultdict(list))
 location_info_reversed = defaultdict(dict)
 location_info_by_ow_screen = defaultdict(lambda: defaultdict(list))
+location_masks = defaultdict(list)
 
 for kind, kind_data in location_info.items():
     if kind in ["base", "pots", "sprites", "misc"]:
         for name, (room, mask) in kind_data.items():
-            location_info_by_room[kind][room].append((name, mask))
+            location_info_by_room[kind][room].append((location_id_by_name[name], mask))
     elif kind in ["overworld", "npcs", "shops"]:
         for name, mask in kind_data.items():
-            location_info_reversed[kind][mask] = name
+            location_info_reversed[kind][mask] = location_id_by_name[name]
     elif kind in ["bonk_prizes"]:
         for name, (screen, mask) in kind_data.items():
-            location_info_by_ow_screen[kind][screen].append((name, mask))
-    
-lookup_id_to_name['0'] = "Admin Send"
-lookup_name_to_id = {v: k for k, v in lookup_id_to_name.items()}
-item_table_reversed = {v: k for k, v in item_table.items()}
+            location_info_by_ow_screen[kind][screen].append((location_id_by_name[name], mask))
+    if kind in ["npcs", "bosses"]:
+        for name, mask in kind_data.items():
+            location_masks[kind].append((location_id_by_name[name], mask))
 
 DUNGEON_IDS = {
     0: "HC" ,
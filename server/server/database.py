@@ -1,11 +1,32 @@
+import os
+import time
+
 from sqlalchemy import create_engine
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from server import metrics
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+
 
 # SQLALCHEMY_DATABASE_URL = "sqlite:////data/sql_app.db"
-SQLALCHEMY_DATABASE_URL = "postgresql://postgres:postgres@db/postgres"
+SQLALCHEMY_DATABASE_URL = os.environ.get("DB_URI", "postgresql://postgres:postgres@db/postgres")
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, pool_size=100, max_overflow=50)
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, pool_size=100, max_overflow=50, poolclass=TimedQueuePool
+)
+metrics.DB_POOL_CHECKED_OUT.function = lambda: engine.pool.checkedout()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
\ No newline at end of file
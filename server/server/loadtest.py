@@ -0,0 +1,365 @@
+"""
+Synthetic load for sizing workers: creates a session from generated multidata and connects hundreds of simulated
+players over WebSockets, each streaming SRAM at the client's poll rate and checking locations over the run.
+
+    python -m server.loadtest --url http://localhost:8000 --api-key <bot api key> --players 200
+
+Session creation needs a bot API key, the simulated players join as a single guest user. Reported are end to end
+item delivery latency (SRAM with the check sent -> receiver's new_items frame), update throughput and error counts.
+With --server-pid the CPU use of the server processes is sampled (Linux only), with --db-uri the number of
+database connections in use, which is the workers' pool usage as the database sees it.
+
+After the run the session's players info is fetched, and if the server has QUERY_STATS_HEADERS set its statement
+count is held to PLAYERS_INFO_QUERY_BUDGET, so an N+1 query over the players fails the run.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import zlib
+from collections import Counter
+
+import httpx
+import websockets
+from sqlalchemy import create_engine, text
+
+from . import query_stats
+from .data import data as loc_data
+
+logger = logging.getLogger(__name__)
+
+SRAM_SIZES = {
+    "game_mode": 0x1,
+    "coords": 0x4,
+    "dungeon_id": 0x1,
+    "lw_dw": 0x1,
+    "base": 0x256,
+    "overworld": 0x82,
+    "inventory": 0x1BD,
+    "misc": 0x4,
+    "npcs": 0x2,
+    "total_time": 0x3,
+    "goal_complete": 0x1,
+    "multiinfo": 0x4,
+    "pots": 0x250,
+    "sprites": 0x250,
+    "shops": 0x29,
+    "prizes": 0x2,
+}
+FRAMES_PER_SECOND = 60
+DRAIN_SECONDS = 5
+PLAYERS_INFO_QUERY_BUDGET = 8
+
+
+def checkable_locations() -> list[tuple[int, int, int]]:
+    """(location id, room, mask) for underworld chests, which only need one bit in the base SRAM block to check."""
+    locations = []
+    for room, room_locations in loc_data.location_info_by_room["base"].items():
+        if room * 2 + 1 >= SRAM_SIZES["base"]:
+            continue
+        for loc_id, mask in room_locations:
+            locations.append((loc_id, room, mask))
+    return locations
+
+
+def generate_multidata(players: int, locations: list[tuple[int, int, int]], rng: random.Random) -> dict:
+    # Only items whose name maps back to the same id, so resent items keep their id
+    items = [
+        int(item_id)
+        for item_id, name in loc_data.item_table.items()
+        if loc_data.item_table_reversed[name] == item_id
+    ]
+    return {
+        "names": [[f"Load {player}" for player in range(1, players + 1)]],
+        "roms": [[1, player, rom_name(player)] for player in range(1, players + 1)],
+        "locations": [
+            [[loc_id, player], [rng.choice(items), rng.randint(1, players)]]
+            for player in range(1, players + 1)
+            for loc_id, _, _ in locations
+        ],
+    }
+
+
+def rom_name(player: int) -> list[int]:
+    return [ord(c) for c in f"LOADTEST{player:06d}".ljust(21)]
+
+
+class Stats:
+    def __init__(self):
+        self.checked = {}  # (from player, location) -> time the SRAM with the check was sent
+        self.expected = {}  # (from player, location) -> receiving player
+        self.latencies = []
+        self.updates_sent = 0
+        self.items_received = 0
+        self.errors = Counter()
+        self.cpu_samples = []
+        self.db_samples = []
+
+
+class LoadPlayer:
+    def __init__(self, player_id, multidata, locations, args, stats, rng):
+        self.player_id = player_id
+        self.args = args
+        self.stats = stats
+        self.sram = {k: [0] * v for k, v in SRAM_SIZES.items()}
+        self.sram["game_mode"] = [0x09]
+        self.frames = 0
+        self.received_idx = set()
+        self.multiinfo = 0
+
+        receivers = {
+            tuple(location): tuple(item)
+            for location, item in (tuple(x) for x in multidata["locations"])
+            if location[1] == player_id
+        }
+        checks = rng.sample(locations, min(args.checks, len(locations)))
+        check_times = sorted(rng.uniform(0, args.duration) for _ in checks)
+        self.schedule = [
+            (at, loc_id, room, mask, receivers[(loc_id, player_id)][1])
+            for at, (loc_id, room, mask) in zip(check_times, checks)
+        ]
+
+    async def run(self, ws_url: str, user_id: int, session_token: str, start_at: float):
+        try:
+            async with websockets.connect(ws_url, max_size=None) as ws:
+                await self.handshake(ws, user_id, session_token)
+                receiver = asyncio.create_task(self.receive(ws))
+                try:
+                    await self.send_updates(ws, start_at)
+                    # Give the last checks time to arrive before disconnecting
+                    await asyncio.sleep(DRAIN_SECONDS)
+                finally:
+                    receiver.cancel()
+        except websockets.ConnectionClosed as e:
+            self.stats.errors[f"closed {e.code}"] += 1
+        except (OSError, asyncio.TimeoutError, websockets.InvalidHandshake) as e:
+            self.stats.errors[type(e).__name__] += 1
+
+    async def handshake(self, ws, user_id: int, session_token: str):
+        while json.loads(await ws.recv())["type"] != "player_info_request":
+            pass
+        await ws.send(
+            json.dumps(
+                {
+                    "type": "player_info",
+                    "player_id": self.player_id,
+                    "rom_name": "".join(chr(c) for c in rom_name(self.player_id)),
+                    "user_id": user_id,
+                    "session_token": session_token,
+                }
+            )
+        )
+
+    async def send_updates(self, ws, start_at: float):
+        while True:
+            elapsed = time.time() - start_at
+            if elapsed > self.args.duration:
+                return
+            just_checked = []
+            while self.schedule and self.schedule[0][0] <= elapsed:
+                _, loc_id, room, mask, receiver = self.schedule.pop(0)
+                self.sram["base"][room * 2] |= mask & 0xFF
+                self.sram["base"][room * 2 + 1] |= mask >> 8
+                just_checked.append((loc_id, receiver))
+
+            self.frames += int(self.args.interval * FRAMES_PER_SECOND)
+            self.sram["total_time"] = [
+                self.frames & 0xFF,
+                (self.frames >> 8) & 0xFF,
+                (self.frames >> 16) & 0xFF,
+            ]
+            self.sram["multiinfo"] = [self.multiinfo >> 8, self.multiinfo & 0xFF, 0, 0]
+
+            # Recorded before sending, the receiving socket may see the item before send() returns
+            sent_at = time.time()
+            for loc_id, receiver in just_checked:
+                self.stats.checked[(self.player_id, loc_id)] = sent_at
+                self.stats.expected[(self.player_id, loc_id)] = receiver
+            await ws.send(json.dumps({"type": "update_memory", "data": self.sram}))
+            self.stats.updates_sent += 1
+
+            await asyncio.sleep(self.args.interval)
+
+    async def receive(self, ws):
+        async for raw in ws:
+            message = json.loads(raw)
+            if message["type"] != "new_items":
+                continue
+            now = time.time()
+            for item in message["data"]:
+                if item["to_player"] != self.player_id:
+                    continue
+                self.stats.items_received += 1
+                if "event_idx" in item:
+                    self.received_idx.add(item["event_idx"][0] << 8 | item["event_idx"][1])
+                    # Like the game, only count items received in order
+                    while self.multiinfo + 1 in self.received_idx:
+                        self.multiinfo += 1
+                sent_at = self.stats.checked.pop((item["from_player"], item["location"]), None)
+                if sent_at is not None:
+                    self.stats.latencies.append(now - sent_at)
+
+
+def _process_cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime, fields 14 and 15 of the full line
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _db_connections(engine) -> tuple[int, int]:
+    """(active, open) connections to the server's database, not counting this one."""
+    with engine.connect() as conn:
+        return tuple(
+            conn.execute(
+                text(
+                    "SELECT count(*) FILTER (WHERE state = 'active'), count(*) FROM pg_stat_activity "
+                    "WHERE datname = current_database() AND pid != pg_backend_pid()"
+                )
+            ).one()
+        )
+
+
+async def sample_server(args, stats: Stats, stop: asyncio.Event):
+    engine = create_engine(args.db_uri, pool_size=1) if args.db_uri else None
+    last_cpu, last_time = None, time.time()
+    while not stop.is_set():
+        if args.server_pid:
+            try:
+                cpu = sum(_process_cpu_seconds(pid) for pid in args.server_pid)
+                now = time.time()
+                if last_cpu is not None:
+                    stats.cpu_samples.append((cpu - last_cpu) / (now - last_time) * 100)
+                last_cpu, last_time = cpu, now
+            except OSError:
+                stats.errors["cpu sample"] += 1
+        if engine:
+            stats.db_samples.append(await asyncio.to_thread(_db_connections, engine))
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=1.0)
+        except asyncio.TimeoutError:
+            pass
+    if engine:
+        engine.dispose()
+
+
+def create_session(client: httpx.Client, api_key: str, multidata: dict) -> str:
+    blob = zlib.compress(json.dumps(multidata).encode())
+    response = client.post(
+        "/multidata",
+        files={"file": ("multidata", blob)},
+        headers={"Authorization": f"Bearer {api_key}"},
+    )
+    response.raise_for_status()
+    return response.json()["mw_session"]
+
+
+def check_players_info_queries(client: httpx.Client, session_id: str):
+    response = client.get(f"/session/{session_id}/players/info")
+    response.raise_for_status()
+    if "X-Query-Count" not in response.headers:
+        print("Players info query count not checked, the server doesn't have QUERY_STATS_HEADERS set")
+        return
+    query_stats.assert_response_queries(response, PLAYERS_INFO_QUERY_BUDGET)
+    print(f"Players info: {response.headers['X-Query-Count']} SQL statements for {len(response.json())} players")
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def print_report(stats: Stats, elapsed: float):
+    print(f"Sent {stats.updates_sent} updates in {elapsed:.1f}s ({stats.updates_sent / elapsed:.1f}/s)")
+    print(
+        f"Checked {len(stats.expected)} locations, {len(stats.latencies)} delivered, "
+        f"{len(stats.checked)} never delivered, {stats.items_received} items received in total"
+    )
+    if stats.latencies:
+        print(
+            "Delivery latency ms: "
+            + ", ".join(
+                f"{name} {_percentile(stats.latencies, pct) * 1000:.0f}"
+                for name, pct in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))
+            )
+        )
+    if stats.cpu_samples:
+        print(
+            f"Server CPU %: mean {sum(stats.cpu_samples) / len(stats.cpu_samples):.0f}, "
+            f"max {max(stats.cpu_samples):.0f}"
+        )
+    if stats.db_samples:
+        print(
+            f"DB connections: active max {max(a for a, _ in stats.db_samples)}, "
+            f"open max {max(t for _, t in stats.db_samples)}"
+        )
+    print(f"Errors: {dict(stats.errors) or 'none'}")
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    locations = checkable_locations()
+    multidata = generate_multidata(args.players, locations, rng)
+
+    with httpx.Client(base_url=args.url, timeout=60) as client:
+        session_id = create_session(client, args.api_key, multidata)
+        client.post("/users/auth", params={"auth_only": False}).raise_for_status()
+        user_id = int(client.cookies["user_id"])
+        session_token = client.cookies["session_token"]
+        cookies = dict(client.cookies)
+    print(f"Created session {session_id} with {args.players} players")
+
+    ws_url = args.url.replace("http", "ws", 1).rstrip("/") + f"/ws/{session_id}"
+    stats = Stats()
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_server(args, stats, stop))
+
+    players = [
+        LoadPlayer(player_id, multidata, locations, args, stats, rng)
+        for player_id in range(1, args.players + 1)
+    ]
+    started = time.time()
+
+    async def start_player(player: LoadPlayer, delay: float):
+        await asyncio.sleep(delay)
+        await player.run(ws_url, user_id, session_token, started + args.ramp)
+
+    await asyncio.gather(
+        *(
+            start_player(player, args.ramp * ix / len(players))
+            for ix, player in enumerate(players)
+        )
+    )
+    stop.set()
+    await sampler
+    print_report(stats, time.time() - started)
+    with httpx.Client(base_url=args.url, cookies=cookies, timeout=60) as client:
+        check_players_info_queries(client, session_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate WebSocket players against a server")
+    parser.add_argument("--url", default="http://localhost:8000", help="Server base URL")
+    parser.add_argument("--api-key", required=True, help="Bot API key used to create the session")
+    parser.add_argument("--players", type=int, default=100)
+    parser.add_argument("--checks", type=int, default=60, help="Locations each player checks")
+    parser.add_argument("--duration", type=float, default=300, help="Seconds of play after ramp up")
+    parser.add_argument("--ramp", type=float, default=30, help="Seconds over which players connect")
+    parser.add_argument("--interval", type=float, default=1.0, help="SRAM poll interval of the client")
+    parser.add_argument("--server-pid", type=int, action="append", help="Server process to sample CPU of")
+    parser.add_argument("--db-uri", help="Server database, to sample connections in use")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Client log lines, buffered and written in batches.
+
+Clients log every hiccup they see, so writing each line on its own would have them competing with item delivery for
+database connections. Lines are queued in this worker and the flush() task writes them with one multi-row insert
+once FLUSH_SIZE are waiting or FLUSH_SECONDS have passed, whichever is first. Each line keeps the time it arrived.
+
+With LIMIT lines waiting, new ones are refused and the client is told to try again later instead of the buffer
+growing while the database is behind. Lines still waiting when the worker stops are written on shutdown.
+
+Sessions are looked up once and then remembered, sessions aren't deleted so a known one stays valid.
+"""
+
+import asyncio
+import datetime
+import logging
+import os
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+from . import metrics, models
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SIZE = int(os.environ.get("LOG_BUFFER_FLUSH_SIZE", 200))
+FLUSH_SECONDS = float(os.environ.get("LOG_BUFFER_FLUSH_SECONDS", 2))
+LIMIT = int(os.environ.get("LOG_BUFFER_LIMIT", 5000))
+MAX_BATCH = 100
+KNOWN_SESSIONS = 10000
+
+_rows: list[dict] = []
+_wakeup: asyncio.Event | None = None
+_known_sessions: OrderedDict[uuid.UUID, None] = OrderedDict()
+
+
+async def session_exists(db: Session, session_id: uuid.UUID) -> bool:
+    if session_id in _known_sessions:
+        _known_sessions.move_to_end(session_id)
+        return True
+    found = await asyncio.to_thread(
+        db.scalar, select(models.MWSession.id).where(models.MWSession.id == session_id)
+    )
+    if found is None:
+        return False
+    _known_sessions[session_id] = None
+    if len(_known_sessions) > KNOWN_SESSIONS:
+        _known_sessions.popitem(last=False)
+    return True
+
+
+def add(session_id: uuid.UUID, player_id: int | None, messages: list[str]) -> bool:
+    """Queues the lines, or refuses all of them and returns False if the buffer is full. Call on the event loop."""
+    if len(_rows) + len(messages) > LIMIT:
+        metrics.LOG_LINES.inc(len(messages), result="refused")
+        return False
+    now = datetime.datetime.now(datetime.UTC)
+    _rows.extend(
+        {"session_id": session_id, "player_id": player_id, "content": message, "timestamp": now}
+        for message in messages
+    )
+    metrics.LOG_LINES.inc(len(messages), result="queued")
+    if len(_rows) >= FLUSH_SIZE and _wakeup is not None:
+        _wakeup.set()
+    return True
+
+
+def _write(rows: list[dict]):
+    db = SessionLocal()
+    try:
+        db.execute(insert(models.Log), rows)
+        db.commit()
+    finally:
+        db.close()
+
+
+async def drain():
+    """Writes the lines that are waiting."""
+    global _rows
+    rows, _rows = _rows, []
+    if not rows:
+        return
+    try:
+        await asyncio.to_thread(_write, rows)
+    except Exception:
+        logger.exception("Failed to write %s log lines", len(rows))
+        metrics.LOG_LINES.inc(len(rows), result="failed")
+
+
+async def flush():
+    """The worker's flush task. Lines still waiting when it is cancelled are left for drain()."""
+    global _wakeup
+    _wakeup = asyncio.Event()
+    while True:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        await drain()
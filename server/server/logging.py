@@ -1,3 +1,27 @@
+import atexit
+import logging
+import logging.config
+import logging.handlers
+import os
+import queue
+import time
+from collections import OrderedDict
+
+# Root level, and per logger overrides as comma separated name=LEVEL pairs, e.g. "server.ws.ws=DEBUG,httpx=WARNING"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+
+
+def _logger_levels(spec: str) -> dict:
+    loggers = {}
+    for entry in spec.split(","):
+        if "=" not in entry:
+            continue
+        name, level = entry.split("=", 1)
+        loggers[name.strip()] = {"level": level.strip().upper()}
+    return loggers
+
+
 logging_config = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -13,8 +37,75 @@ logging_config = {
             "stream": "ext://sys.stdout",
         },
     },
+    "loggers": _logger_levels(LOG_LEVELS),
     "root": {
         "handlers": ["console"],
-        "level": "DEBUG",
+        "level": LOG_LEVEL,
     },
-}
\ No newline at end of file
+}
+
+_listener = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues records as they are instead of formatting them first, so the message and any traceback are formatted
+    by the listener's handlers on its thread. The queue never leaves the process, so nothing needs to be pickled;
+    arguments are formatted as they are when the listener gets to the record.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def configure_logging():
+    """
+    Applies logging_config, then moves the root handlers behind a queue so the event loop only ever enqueues
+    records and the writes to stdout happen on the listener's thread. Safe to call more than once.
+    """
+    global _listener
+    if _listener:
+        return
+    logging.config.dictConfig(logging_config)
+
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    for handler in handlers:
+        root.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    root.addHandler(DeferredQueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+LOG_EVERY_KEYS = 10000
+# (logger name, key) -> [when it was last logged, lines suppressed since], least recently logged first
+_log_every: OrderedDict[tuple, list] = OrderedDict()
+
+
+def log_every(logger: logging.Logger, level: int, key, interval: float, msg: str, *args):
+    """
+    Logs msg at most once every interval seconds per (logger, key), for lines that would otherwise be written on
+    every poll. The next line that gets through says how many were dropped in between.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    now = time.monotonic()
+    log_key = (logger.name, key)
+    state = _log_every.get(log_key)
+    if state is not None and now - state[0] < interval:
+        state[1] += 1
+        return
+    dropped = state[1] if state is not None else 0
+    _log_every[log_key] = [now, 0]
+    _log_every.move_to_end(log_key)
+    if len(_log_every) > LOG_EVERY_KEYS:
+        _log_every.popitem(last=False)
+    if dropped:
+        msg += " (%d similar suppressed)"
+        args += (dropped,)
+    logger.log(level, msg, *args)
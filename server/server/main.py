@@ -1,11 +1,14 @@
+import asyncio
 from collections import defaultdict
 import datetime
 import json
 import logging
+import math
 import os
 import secrets
+import threading
 import time
-import zlib
+import uuid
 from urllib.parse import urlparse
 
 import httpx
@@ -25,18 +28,31 @@ from fastapi import (
     Response,
     File,
     Form,
+    UploadFile,
 )
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from typing import Annotated
-from server.utils import get_session_players_info_from_db, user_allowed_in_session
-from starlette import status
+from server.utils import get_session_players_info_from_db, get_session_status, user_allowed_in_session
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.sessions import SessionMiddleware
 from sqlalchemy.orm import Session
 
-from server import crud, models, schemas
-from server.ws import ws
-from server.data import data as loc_data
-from server.logging import logging_config
+from server import (
+    archive,
+    crud,
+    log_buffer,
+    metrics,
+    models,
+    multidata,
+    profiler,
+    query_stats,
+    schemas,
+    session_export,
+    watchdog,
+)
+from server.ws import memory, presence, ws
+from server.logging import configure_logging
+from server.database import SessionLocal
 from server.dependencies import get_db
 
 
@@ -50,8 +66,20 @@ async def lifespan(app_: FastAPI):
     logger.info("Starting up...")
     logger.info("run alembic upgrade head...")
     run_migrations()
+    archive_task = asyncio.create_task(archive.archive_loop())
+    watchdog_task = asyncio.create_task(watchdog.lag_monitor())
+    presence_task = asyncio.create_task(presence.listen())
+    heartbeat_task = asyncio.create_task(presence.heartbeat())
+    log_task = asyncio.create_task(log_buffer.flush())
     yield
     logger.info("Shutting down...")
+    archive_task.cancel()
+    watchdog_task.cancel()
+    presence_task.cancel()
+    heartbeat_task.cancel()
+    log_task.cancel()
+    await log_buffer.drain()
+    multidata.shutdown()
 
 
 app = FastAPI(
@@ -65,12 +93,13 @@ app = FastAPI(
 app.add_middleware(
     SessionMiddleware, secret_key=os.environ.get("FASTAPI_SESSION_SECRET")
 )
+app.add_middleware(query_stats.QueryStatsMiddleware)
 
 app.include_router(ws.router)
 
 
 logger = logging.getLogger(__name__)
-logging.config.dictConfig(logging_config)
+configure_logging()
 
 oauth = OAuth()
 oauth.register(
@@ -91,6 +120,10 @@ SESSION_EXPIRE_DAYS = max(
 )  # Minimum 2 days
 
 
+# Bearer token Prometheus scrapes /metrics with, the endpoint is off when it isn't set
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+
 async def valid_content_length(content_length: int = Header(..., lt=ONE_MB * 10)):
     return content_length
 
@@ -489,21 +522,13 @@ def get_session_info(
     db: Annotated[Session, Depends(get_db)], session: schemas.MWSession, user_id: int
 ):
     player_datas = get_session_players_info_from_db(db, session)
-    last_event = crud.get_last_event(db, session.id)
-    if last_event:
-        last_updated = last_event.timestamp.timestamp()
+    last_event_timestamp = crud.get_last_event_timestamp(db, session.id)
+    if last_event_timestamp:
+        last_updated = last_event_timestamp.timestamp()
     else:
         last_updated = session.created_at.timestamp()
-        
-    TIME_TO_IDLE = datetime.timedelta(days=2)
 
-    tot_complete = all([x.goalCompleted for x in player_datas])
-    if tot_complete:
-        status = "completed"
-    elif last_updated <= (datetime.datetime.now() - TIME_TO_IDLE).timestamp():
-        status = "inactive"
-    else:
-        status = "active"
+    status = get_session_status(player_datas, last_updated)
 
     owners_info = [
         (x.username if x.username else f"Guest#{x.id:06}", x.id) for x in session.owners
@@ -546,6 +571,7 @@ def get_user_sessions(
     page_size: int = 10,
     sort_by: str = "createdTimestamp",
     sort_dir: str = "desc",
+    cursor: str | None = None,
 ):
     user, token = user_info
     if not user:
@@ -564,10 +590,11 @@ def get_user_sessions(
     if sort_dir not in ("asc", "desc"):
         sort_dir = "desc"
 
+    # The cursor from the previous page takes precedence over the offset when it matches the requested sort
     if user.is_superuser:
-        all_sessions, total = crud.get_sessions_paginated(db, skip=skip, limit=page_size, sort_by=sort_by, sort_dir=sort_dir)
+        all_sessions, total, next_cursor = crud.get_sessions_paginated(db, skip=skip, limit=page_size, sort_by=sort_by, sort_dir=sort_dir, cursor=cursor)
     else:
-        all_sessions, total = crud.get_user_sessions_paginated(db, user.id, skip=skip, limit=page_size, sort_by=sort_by, sort_dir=sort_dir)
+        all_sessions, total, next_cursor = crud.get_user_sessions_paginated(db, user.id, skip=skip, limit=page_size, sort_by=sort_by, sort_dir=sort_dir, cursor=cursor)
 
     sessions = []
     for session in all_sessions:
@@ -577,24 +604,18 @@ def get_user_sessions(
         total=total,
         page=page,
         pageSize=page_size,
+        nextCursor=next_cursor,
     )
 
 
-def is_multidata_valid(multidata: dict) -> bool:
-    if not multidata:
-        return False
-    if "names" not in multidata:
-        return False
-    if "locations" not in multidata:
-        return False
-    if "roms" not in multidata:
-        return False
-    return True
-
+def _check_can_create_sessions(user: models.User | None):
+    if not user or (not user.discord_id and not user.bot):
+        raise HTTPException(status_code=401, detail="Unauthorized")
 
 
-def _process_multidata_bytes(
-    file_bytes: bytes,
+def _create_session_from_multidata(
+    multidata_hash: str,
+    parsed_data: dict,
     db: Session,
     user: models.User,
     game: str = "z3",
@@ -604,31 +625,13 @@ def _process_multidata_bytes(
     allowed_users: str = "",
     password: str = "",
 ):
-    """Shared logic for creating a session from raw multidata bytes."""
+    """Shared logic for creating a session from parsed multidata."""
     db_game = crud.get_game(db, game)
 
-    if not user or (not user.discord_id and not user.bot):
-        raise HTTPException(status_code=401, detail="Unauthorized")
-
     if not db_game:
         db_game = crud.create_game(db, schemas.GameCreate(title=game))
         logger.error(f"Game does not exist, creating it: {game}")
 
-    try:
-        decompressor = zlib.decompressobj()
-        decompressed = decompressor.decompress(file_bytes, MAX_MULTIDATA_SIZE + 1)
-        if decompressor.unconsumed_tail:
-            raise HTTPException(
-                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-                detail="Decompressed multidata exceeds size limit",
-            )
-        parsed_data = json.loads(decompressed.decode("utf-8"))
-    except zlib.error:
-        raise HTTPException(status_code=400, detail="Invalid compressed data")
-
-    if not is_multidata_valid(parsed_data):
-        raise HTTPException(status_code=400, detail="Invalid multidata")
-
     flags = json.loads(flags_str)
 
     if tournament:
@@ -655,12 +658,13 @@ def _process_multidata_bytes(
             except:
                 raise HTTPException(status_code=404, detail=f"User {x} not found!")
 
+    crud.store_multidata(db, multidata_hash, parsed_data)
     session = crud.create_session(
         db,
         schemas.MWSessionCreate(
             game_id=db_game.id,
             is_active=True,
-            mwdata=parsed_data,
+            multidata_hash=multidata_hash,
             session_password=password if password else None,
             tournament=tournament,
             flags=final_flags,
@@ -691,12 +695,9 @@ def _process_multidata_bytes(
         return {"error": "Failed to create session"}
 
 
-MAX_MULTIDATA_SIZE = 10 * 1024 * 1024  # 10 MB
-
-
 @app.post("/multidata")
-def create_multi_session(
-    file: Annotated[bytes, File()],
+async def create_multi_session(
+    file: Annotated[UploadFile, File()],
     db: Annotated[Session, Depends(get_db)],
     file_size: Annotated[int, Depends(valid_content_length)],
     game: Annotated[str, Form()] = "z3",
@@ -707,19 +708,20 @@ def create_multi_session(
     password: Annotated[str, Form()] = "",
     user_info: Annotated[tuple[models.User, str], Depends(verify_session_token)] = None,
 ):
-    if len(file) > file_size:
-        raise HTTPException(
-            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Too large"
-        )
-
     user, _ = user_info
-    return _process_multidata_bytes(
-        file, db, user, game, tournament, flags, admins, allowed_users, password
+    _check_can_create_sessions(user)
+    try:
+        multidata_hash, parsed_data = await multidata.parse_in_worker(await multidata.read_upload(file, file_size))
+    except multidata.InvalidMultidata as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return await run_in_threadpool(
+        _create_session_from_multidata,
+        multidata_hash, parsed_data, db, user, game, tournament, flags, admins, allowed_users, password,
     )
 
 
 @app.post("/multidata_url")
-def create_multi_session_from_url(
+async def create_multi_session_from_url(
     url: Annotated[str, Body()],
     db: Annotated[Session, Depends(get_db)],
     game: Annotated[str, Body()] = "z3",
@@ -738,11 +740,12 @@ def create_multi_session_from_url(
         raise HTTPException(status_code=400, detail="Invalid URL")
 
     user, _ = user_info
+    _check_can_create_sessions(user)
 
     try:
-        with httpx.Client(timeout=30, max_redirects=5) as client:
-            response = client.get(url)
-            response.raise_for_status()
+        multidata_hash, parsed_data = await multidata.parse_in_worker(await multidata.download(url))
+    except multidata.InvalidMultidata as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
     except httpx.HTTPStatusError as e:
         raise HTTPException(
             status_code=400,
@@ -753,14 +756,9 @@ def create_multi_session_from_url(
             status_code=400, detail="Failed to fetch multidata from URL"
         )
 
-    if len(response.content) > MAX_MULTIDATA_SIZE:
-        raise HTTPException(
-            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-            detail="Remote file too large",
-        )
-
-    return _process_multidata_bytes(
-        response.content, db, user, game, tournament, flags, admins, allowed_users, password
+    return await run_in_threadpool(
+        _create_session_from_multidata,
+        multidata_hash, parsed_data, db, user, game, tournament, flags, admins, allowed_users, password,
     )
 
 
@@ -780,16 +778,47 @@ def get_session_events(
     all_events = crud.get_events(db, session_id=mw_session_id)
     for event in all_events:
         if event.event_type == models.EventTypes.new_item:
-            if event.event_data == None:
-                event.event_data = {}
-            event.event_data["item_name"] = loc_data.item_table[str(event.item_id)]
-            event.event_data["location_name"] = loc_data.lookup_id_to_name[
-                str(event.location)
-            ]
+            event.event_data = {
+                **(event.event_data or {}),
+                **memory.item_names(event.item_id, event.location),
+            }
         event.event_data["timestamp"] = int(time.mktime(event.timestamp.timetuple()))
     return all_events
 
 
+@app.get("/session/{mw_session_id}/export")
+def export_session(
+    mw_session_id: str,
+    db: Annotated[Session, Depends(get_db)],
+    user_info: Annotated[tuple[models.User, str], Depends(verify_session_token)],
+):
+    session = crud.get_session(db, mw_session_id)
+    user, token = user_info
+
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if user.id not in [x.id for x in session.owners] and not user.is_superuser:
+        raise HTTPException(status_code=403, detail="Unauthorized")
+
+    def stream_export():
+        # The request's db session is closed before the response body is sent, so the stream needs its own
+        export_db = SessionLocal()
+        try:
+            yield from session_export.iter_session_export(
+                export_db, crud.get_session(export_db, mw_session_id)
+            )
+        finally:
+            export_db.close()
+
+    return StreamingResponse(
+        stream_export(),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{session.id}.wmsx"'},
+    )
+
+
 @app.get("/session/{mw_session_id}/players")
 def get_session_players(
     mw_session_id: str, db: Annotated[Session, Depends(get_db)]
@@ -809,6 +838,70 @@ def get_session_players(
     return final_names
 
 
+@app.get("/metrics")
+def get_metrics(authorization: Annotated[str | None, Header()] = None):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not authorization or not secrets.compare_digest(
+        authorization, f"Bearer {METRICS_TOKEN}"
+    ):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/debug/tasks")
+async def get_debug_tasks(
+    user_info: Annotated[tuple[models.User, str], Depends(verify_session_token)],
+):
+    """Event loop lag, recent stalls and the stack of every task in this worker, grouped by session."""
+    user, token = user_info
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if not user.is_superuser:
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    return {
+        "pid": os.getpid(),
+        "lag": watchdog.lag_percentiles(),
+        "stalls": list(watchdog.recent_stalls),
+        "sessions": watchdog.task_stacks(),
+    }
+
+
+@app.get("/debug/profile")
+async def get_debug_profile(
+    user_info: Annotated[tuple[models.User, str], Depends(verify_session_token)],
+    seconds: float = 10,
+    hz: int = 100,
+    all_threads: bool = False,
+):
+    """
+    Samples this worker for up to a minute and returns collapsed stacks, tagged by ws session and message type.
+    By default only the event loop thread is sampled; all_threads adds the threadpool running sync endpoints.
+    """
+    user, token = user_info
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if not user.is_superuser:
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    if seconds <= 0 or hz <= 0:
+        raise HTTPException(status_code=400, detail="seconds and hz must be positive")
+
+    threads = {threading.get_ident(): "loop"}
+    if all_threads:
+        threads.update({t.ident: t.name for t in threading.enumerate() if t.ident not in threads})
+    try:
+        stacks = await asyncio.to_thread(profiler.profile, seconds, hz, threads)
+    except profiler.ProfilerBusy:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    return Response(
+        profiler.render(stacks),
+        media_type="text/plain",
+        headers={
+            "Content-Disposition": f'attachment; filename="profile-{os.getpid()}.folded"'
+        },
+    )
+
+
 @app.get("/session/{mw_session_id}/players/info")
 def get_session_players_info(
     mw_session_id: str,
@@ -825,7 +918,8 @@ def get_session_players_info(
     if not allowed:
         raise HTTPException(status_code=403, detail="Authorized users only")
         
-    player_datas = get_session_players_info_from_db(db, session)
+    with metrics.PLAYERS_INFO_SECONDS.time():
+        player_datas = get_session_players_info_from_db(db, session)
     
     return player_datas
 
@@ -850,6 +944,7 @@ def admin_send_event(
     if session.session_password != None:
         if send_data["password"] != session.session_password:
             return {"error": "Invalid password"}
+    crud.restore_archived_session(db, session.id)
     if send_data["event_type"] == "send_single":
         new_event = crud.create_event(
             db,
@@ -860,11 +955,7 @@ def admin_send_event(
                 to_player=send_data["to_players"],
                 item_id=send_data["item_id"],
                 location=0,
-                event_data={
-                    "item_name": loc_data.item_table[str(send_data["item_id"])],
-                    "location_name": loc_data.lookup_id_to_name["0"],
-                    "reason": "admin_send",
-                },
+                event_data={"reason": "admin_send"},
             ),
         )
     elif send_data["event_type"] == "send_multi":
@@ -878,11 +969,7 @@ def admin_send_event(
                     to_player=player,
                     item_id=send_data["item_id"],
                     location=0,
-                    event_data={
-                        "item_name": loc_data.item_table[str(send_data["item_id"])],
-                        "location_name": loc_data.lookup_id_to_name["0"],
-                        "reason": "admin_send",
-                    },
+                    event_data={"reason": "admin_send"},
                 ),
             )
     return new_event
@@ -893,24 +980,30 @@ def admin_send_event(
 @app.post("/session/{mw_session_id}/log")
 async def log_event(
     mw_session_id: str,
-    send_data: dict,
+    send_data: schemas.LogBatch,
     db: Annotated[Session, Depends(get_db)],
 ) -> dict:
-    session = crud.get_session(db, mw_session_id)
-    if not session:
+    try:
+        session_id = uuid.UUID(mw_session_id)
+    except ValueError:
+        return {"error": "Session not found"}
+    if not await log_buffer.session_exists(db, session_id):
         return {"error": "Session not found"}
 
-    new_entry = schemas.LogEntryCreate(
-        session_id=session.id,
-        player_id=send_data["player_id"],
-        content=send_data["message"],
-    )
-
-    log_entry = crud.add_log_entry(db, new_entry)
-
-    if not log_entry:
-        return {"error": "Failed to log message"}
-    return {"log_id": log_entry.id}
+    messages = list(send_data.messages)
+    if send_data.message is not None:
+        messages.append(send_data.message)
+    if len(messages) > log_buffer.MAX_BATCH:
+        raise HTTPException(
+            status_code=413, detail=f"At most {log_buffer.MAX_BATCH} lines per request"
+        )
+    if not log_buffer.add(session_id, send_data.player_id, messages):
+        raise HTTPException(
+            status_code=503,
+            detail="Too many log lines waiting, try again later",
+            headers={"Retry-After": str(math.ceil(log_buffer.FLUSH_SECONDS))},
+        )
+    return {"logged": len(messages)}
 
 
 @app.post("/session/{mw_session_id}/player_forfeit")
@@ -925,6 +1018,7 @@ async def player_forfeit(
 
     if not session.flags["forfeit"]:
         return {"error": "Forfeit not enabled"}
+    crud.restore_archived_session(db, session.id)
     # TODO: Maybe add some security here.
     # Potentially a unique code generated per player when the session is made?
     player_id = send_data["player_id"]
@@ -953,11 +1047,7 @@ async def player_forfeit(
             to_player=item_info[1],
             item_id=item_info[0],
             location=location,
-            event_data={
-                "reason": "forfeit",
-                "item_name": loc_data.item_table[str(item_info[0])],
-                "location_name": loc_data.lookup_id_to_name[str(location)],
-            },
+            event_data={"reason": "forfeit"},
         )
         for location, item_info in all_player_items.items()
     ]
@@ -965,6 +1055,11 @@ async def player_forfeit(
     success = crud.create_forfeit_events(db, session.id, ff_events)
     if not success:
         return {"error": "Failed to create forfeit events"}
+    # Without a progress row the player's next connect builds it from the events, forfeit included
+    if crud.get_player_progress(db, session.id, player_id) is not None:
+        checks = memory.CheckedLocations(session.multidata_document, player_id)
+        checks.checked = (1 << len(checks.locations)) - 1
+        crud.update_player_progress(db, session.id, player_id, checks.checked)
     new_event = crud.create_event(
         db,
         schemas.EventCreate(
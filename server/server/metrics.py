@@ -0,0 +1,286 @@
+"""
+Process local metrics, served in the Prometheus text format on /metrics.
+
+Every worker keeps its own values, so with several uvicorn workers each one has to be scraped (or the values
+summed) to see the whole server.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+REGISTRY: list["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labels)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join(
+            [
+                f"# HELP {self.name} {self.documentation}",
+                f"# TYPE {self.name} {self.kind}",
+                *self._samples(),
+            ]
+        )
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}_total{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        function: Callable[[], float] | None = None,
+    ):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+        self.function = function
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def remove(self, **labels):
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    def _samples(self) -> list[str]:
+        if self.function:
+            return [f"{self.name} {_format_value(self.function())}"]
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # labels -> [bucket counts..., sum]
+        self._values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for ix, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[ix] += 1
+                    break
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        samples = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                samples.append(
+                    f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}"
+                )
+            samples.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(counts[-1])}")
+            samples.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return samples
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+WS_MESSAGE_TYPES = (
+    "update_memory",
+    "chat",
+    "ping",
+    "control",
+    "pause_receiving",
+    "resume_receiving",
+    "ready_response",
+    "unready_response",
+)
+
+WS_MESSAGE_SECONDS = Histogram(
+    "webmulti_ws_message_seconds",
+    "Time spent handling one WebSocket message, by message type",
+    ("type",),
+)
+SRAM_STAGE_SECONDS = Histogram(
+    "webmulti_sram_stage_seconds",
+    "Time spent in each stage of processing an SRAM update",
+    ("stage",),
+)
+EVENT_FANOUT_SECONDS = Histogram(
+    "webmulti_event_fanout_seconds",
+    "Time from an event being inserted to it being sent on a socket",
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "webmulti_db_pool_wait_seconds",
+    "Time spent waiting to check a connection out of the database pool",
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "webmulti_db_pool_checked_out",
+    "Database connections currently checked out of the pool",
+)
+WS_CONNECTED_SOCKETS = Gauge(
+    "webmulti_ws_connected_sockets",
+    "Connected WebSockets, by session",
+    ("session",),
+)
+PLAYERS_INFO_SECONDS = Histogram(
+    "webmulti_players_info_seconds",
+    "Time spent building the /players/info response",
+)
+EVENT_LOOP_LAG_SECONDS = Histogram(
+    "webmulti_event_loop_lag_seconds",
+    "How late the event loop ran a timer that was due, sampled every 250ms",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+SLOW_CALLBACKS = Counter(
+    "webmulti_slow_callbacks",
+    "Times the event loop was blocked longer than WATCHDOG_SLOW_SECONDS, by the session it was working for",
+    ("session",),
+)
+QUERIES_PER_REQUEST = Histogram(
+    "webmulti_queries_per_request",
+    "SQL statements run for one HTTP request or WebSocket message, by route or message type",
+    ("handler",),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 500),
+)
+DB_SECONDS_PER_REQUEST = Histogram(
+    "webmulti_db_seconds_per_request",
+    "Time spent in SQL statements for one HTTP request or WebSocket message, by route or message type",
+    ("handler",),
+)
+WS_SEND_QUEUE_DEPTH = Histogram(
+    "webmulti_ws_send_queue_depth",
+    "Frames waiting in a socket's send queue, sampled each time one is queued",
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+WS_SEND_QUEUE_DROPPED = Counter(
+    "webmulti_ws_send_queue_dropped",
+    "Frames that were never sent: coalesced into a newer one, dropped for a socket that is behind, or discarded "
+    "when a socket was closed for falling too far behind",
+    ("reason",),
+)
+SRAM_UPDATES_COALESCED = Counter(
+    "webmulti_sram_updates_coalesced",
+    "update_memory messages not processed because a newer one from the same player was already waiting",
+)
+LOG_LINES = Counter(
+    "webmulti_log_lines",
+    "Client log lines by what happened to them: queued for writing, refused because the buffer was full, or lost "
+    "to a failed write",
+    ("result",),
+)
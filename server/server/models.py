@@ -10,15 +10,17 @@ from sqlalchemy import (
     Enum,
     JSON,
     DateTime,
+    LargeBinary,
 )
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.sql import func
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.schema import Index, UniqueConstraint
 import uuid
 import enum
 
 from .database import Base
+from .multidata import Document, cached_document
 from typing import List, Optional
 
 
@@ -37,6 +39,26 @@ class EventTypes(enum.Enum):
     player_kicked = 12
 
 
+# Chat and control traffic, stored as SessionMessages instead of in the events item ledger
+MESSAGE_EVENT_TYPES = frozenset(
+    {
+        EventTypes.player_join,
+        EventTypes.failed_join,
+        EventTypes.player_leave,
+        EventTypes.chat,
+        EventTypes.command,
+        EventTypes.player_pause_receive,
+        EventTypes.player_resume_receive,
+        EventTypes.user_join_chat,
+        EventTypes.player_kicked,
+    }
+)
+
+
+# Arrays are stored as JSON on SQLite, which server.replay can run against
+StringArray = ARRAY(String).with_variant(JSON(), "sqlite")
+
+
 base_flags = {
     "chat": True,
     "pauseRecieving": True,
@@ -69,7 +91,7 @@ class User(Base):
     # Base required fields
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     session_tokens: Mapped[Optional[List[str]]] = mapped_column(
-        ARRAY(String), nullable=True
+        StringArray, nullable=True
     )
     created_at: Mapped[datetime.datetime] = mapped_column(
         DateTime(timezone=True),
@@ -122,7 +144,7 @@ class User(Base):
     )
 
     bot_owner_id: Mapped[Optional[int]] = mapped_column(
-        Integer, ForeignKey("users.id"), nullable=True
+        Integer, ForeignKey("users.id"), index=True, nullable=True
     )
     bot_owner: Mapped[Optional["User"]] = relationship(
         "User", back_populates="bots", foreign_keys=[bot_owner_id], remote_side=[id]
@@ -178,10 +200,14 @@ class MWSession(Base):
 
     # Array of discord user ids
     allowed_users: Mapped[Optional[List[str]]] = mapped_column(
-        ARRAY(String), nullable=True
+        StringArray, nullable=True
     )
     flags: Mapped[dict] = mapped_column(JSON, default=base_flags)
-    mwdata: Mapped[dict] = mapped_column(JSON)
+    multidata_hash: Mapped[Optional[str]] = mapped_column(
+        String, ForeignKey("multidata.hash"), nullable=True, index=True
+    )
+    # Only read when the document isn't in the multidata cache yet, use mwdata
+    multidata: Mapped[Optional["Multidata"]] = relationship("Multidata")
 
     game: Mapped["Game"] = relationship("Game", back_populates="mwsessions")
     logs: Mapped[List["Log"]] = relationship("Log", back_populates="session")
@@ -190,15 +216,46 @@ class MWSession(Base):
         "SRAMStore", back_populates="session"
     )
     users: Mapped[List["UserSessions"]] = relationship(back_populates="session")
+    archive: Mapped[Optional["ArchivedSession"]] = relationship(
+        back_populates="session"
+    )
+    __table_args__ = (
+        Index("ix_mwsessions_game_id_created_at", "game_id", "created_at", "id"),
+    )
+
+    @property
+    def multidata_document(self) -> Optional[Document]:
+        if self.multidata_hash is None:
+            return None
+        return cached_document(self.multidata_hash, lambda: self.multidata.data)
+
+    @property
+    def mwdata(self) -> Optional[dict]:
+        document = self.multidata_document
+        return document.data if document else None
+
+
+class Multidata(Base):
+    """A multidata document, stored once under the sha256 of its decompressed file however many sessions use it."""
+
+    __tablename__ = "multidata"
+
+    hash: Mapped[str] = mapped_column(String, primary_key=True)
+    data: Mapped[dict] = mapped_column(JSON)
+    created_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=datetime.datetime.now,
+        server_default=func.clock_timestamp(),
+    )
 
 
 class UserSessions(Base):
     __tablename__ = "user_sessions"
     id: Mapped[int] = mapped_column(primary_key=True, index=True, autoincrement=True)
 
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
     session_id: Mapped[uuid.UUID] = mapped_column(
-        ForeignKey("mwsessions.id"))
+        ForeignKey("mwsessions.id"), index=True)
 
     player_id: Mapped[int] = mapped_column(Integer)
 
@@ -231,28 +288,27 @@ class Game(Base):
 class Event(Base):
     __tablename__ = "events"
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    # The table is hash partitioned on session_id, so the database primary key is (id, session_id)
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
     timestamp: Mapped[datetime.datetime] = mapped_column(
         DateTime(timezone=True),
         default=datetime.datetime.now,
         server_default=func.clock_timestamp(),
     )
     session_id: Mapped[uuid.UUID] = mapped_column(
-        UUID(as_uuid=True), ForeignKey("mwsessions.id")
+        UUID(as_uuid=True), ForeignKey("mwsessions.id"), primary_key=True
     )
     user_id: Mapped[Optional[int]] = mapped_column(
         Integer, ForeignKey("users.id"), nullable=True
     )
 
-    from_player: Mapped[int] = mapped_column(Integer, index=True)
-    to_player: Mapped[int] = mapped_column(Integer, index=True)
-    to_player_idx: Mapped[Optional[int]] = mapped_column(
-        Integer, index=True, nullable=True
-    )
-    item_id: Mapped[int] = mapped_column(Integer, index=True)
-    location: Mapped[int] = mapped_column(Integer, index=True)
-    event_type: Mapped[EventTypes] = mapped_column(Enum(EventTypes), index=True)
-    frame_time: Mapped[Optional[int]] = mapped_column(BigInteger, index=True, nullable=True)
+    from_player: Mapped[int] = mapped_column(Integer)
+    to_player: Mapped[int] = mapped_column(Integer)
+    to_player_idx: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    item_id: Mapped[int] = mapped_column(Integer)
+    location: Mapped[int] = mapped_column(Integer)
+    event_type: Mapped[EventTypes] = mapped_column(Enum(EventTypes))
+    frame_time: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
     event_data: Mapped[dict] = mapped_column(JSON)
 
     session: Mapped["MWSession"] = relationship("MWSession", back_populates="events")
@@ -261,7 +317,75 @@ class Event(Base):
         UniqueConstraint(
             "session_id", "to_player", "to_player_idx", name="player_receive_index"
         ),
+        Index("ix_events_session_id_timestamp", "session_id", "timestamp"),
+        Index(
+            "ix_events_session_id_from_player_frame_time",
+            "session_id",
+            "from_player",
+            "frame_time",
+        ),
+        {"postgresql_partition_by": "HASH (session_id)"},
+    )
+
+
+class SessionMessage(Base):
+    """
+    Chat and control traffic of a session: chat lines, joins, leaves, pause toggles and kicks. Kept out of the
+    events table so the item ledger and its indexes only hold what has to be durable, and deleted after
+    archive.MESSAGE_RETENTION_DAYS. Handled like an Event everywhere, ids come from the events sequence so the two
+    sort together.
+    """
+
+    __tablename__ = "session_messages"
+
+    id: Mapped[int] = mapped_column(
+        BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True
+    )
+    timestamp: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=datetime.datetime.now,
+        server_default=func.clock_timestamp(),
+    )
+    session_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("mwsessions.id")
+    )
+    user_id: Mapped[Optional[int]] = mapped_column(
+        Integer, ForeignKey("users.id"), nullable=True
+    )
+    event_type: Mapped[EventTypes] = mapped_column(Enum(EventTypes))
+    from_player: Mapped[int] = mapped_column(Integer)
+    to_player: Mapped[int] = mapped_column(Integer)
+    event_data: Mapped[dict] = mapped_column(JSON)
+
+    # Never stored, messages don't carry an item
+    to_player_idx = None
+    item_id = -1
+    location = -1
+    frame_time = None
+
+    __table_args__ = (Index("ix_session_messages_session_id_id", "session_id", "id"),)
+
+
+class ArchivedSession(Base):
+    """Events of a finished session, moved out of the events table as one compressed blob."""
+
+    __tablename__ = "archived_sessions"
+
+    session_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("mwsessions.id"), primary_key=True
+    )
+    archived_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=datetime.datetime.now,
+        server_default=func.clock_timestamp(),
+    )
+    event_count: Mapped[int] = mapped_column(Integer)
+    last_event_at: Mapped[Optional[datetime.datetime]] = mapped_column(
+        DateTime(timezone=True), nullable=True
     )
+    events: Mapped[bytes] = mapped_column(LargeBinary, deferred=True)
+
+    session: Mapped["MWSession"] = relationship("MWSession", back_populates="archive")
 
 
 class SRAMStore(Base):
@@ -287,3 +411,43 @@ class SRAMStore(Base):
         "MWSession", back_populates="sramstores"
     )
     user: Mapped["User"] = relationship("User", back_populates="sramstores")
+
+
+class PlayerProgress(Base):
+    """
+    What a player's socket needs to pick up where it left off, kept up to date as it changes so a reconnect reads
+    this one row instead of all of the player's events. version goes up with every change and is handed to the
+    client as its resume token.
+    """
+
+    __tablename__ = "player_progress"
+
+    session_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("mwsessions.id"), primary_key=True
+    )
+    player_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # Bitset over the player's own locations in the multidata, in the order of ws.memory.CheckedLocations
+    checked: Mapped[bytes] = mapped_column(LargeBinary, default=b"")
+    receiving_paused: Mapped[bool] = mapped_column(Boolean, default=False)
+    version: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class Presence(Base):
+    """
+    A player socket that is connected right now, for sharing presence between workers. Rows are kept alive by their
+    worker's heartbeats and count as gone once heartbeat_at is older than presence.EXPIRE_SECONDS.
+    """
+
+    __tablename__ = "presence"
+
+    session_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("mwsessions.id"), primary_key=True
+    )
+    player_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    connection_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True))
+    worker: Mapped[str] = mapped_column(String)
+    heartbeat_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=datetime.datetime.now,
+        server_default=func.clock_timestamp(),
+    )
@@ -0,0 +1,215 @@
+"""
+Reading uploaded multidata files.
+
+Decompressing and parsing a big multidata file takes long enough to hold up everything else on a worker, so it
+runs in a pool of separate processes and the API only waits on it. Uploads and downloads are read in chunks and
+given up on as soon as they pass MAX_SIZE, the same limit applies to the decompressed file.
+
+Only the names, locations and roms the server uses are kept, checked to be ints and strings in the expected
+shape. Everything else in the file is dropped before it is stored.
+
+Tournament rooms and re-rolls upload the same file many times, so it is stored once under the sha256 of its
+decompressed bytes and sessions refer to it by that hash. Parsed documents are cached per hash in each worker,
+along with lookups compiled from them, so every session made from the same file shares one copy.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, TypeVar
+
+import httpx
+from fastapi import UploadFile
+
+logger = logging.getLogger(__name__)
+
+MAX_SIZE = 10 * 1024 * 1024  # 10 MB
+CHUNK_SIZE = 64 * 1024
+WORKERS = int(os.environ.get("MULTIDATA_WORKERS", 2))
+DOWNLOAD_TIMEOUT = 30
+CACHE_SIZE = int(os.environ.get("MULTIDATA_CACHE_SIZE", 64))
+
+T = TypeVar("T")
+
+
+class InvalidMultidata(Exception):
+    def __init__(self, detail: str, status_code: int = 400):
+        # Both in args so the exception survives the trip back from the worker process
+        super().__init__(detail, status_code)
+        self.detail = detail
+        self.status_code = status_code
+
+
+async def read_upload(file: UploadFile, limit: int) -> bytes:
+    data = bytearray()
+    while chunk := await file.read(CHUNK_SIZE):
+        data += chunk
+        if len(data) > limit:
+            raise InvalidMultidata("Too large", 413)
+    return bytes(data)
+
+
+async def download(url: str) -> bytes:
+    async with httpx.AsyncClient(timeout=DOWNLOAD_TIMEOUT, max_redirects=5) as client:
+        async with client.stream("GET", url) as response:
+            response.raise_for_status()
+            if int(response.headers.get("content-length") or 0) > MAX_SIZE:
+                raise InvalidMultidata("Remote file too large", 413)
+            data = bytearray()
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                data += chunk
+                if len(data) > MAX_SIZE:
+                    raise InvalidMultidata("Remote file too large", 413)
+    return bytes(data)
+
+
+def _decompress(data: bytes) -> bytes:
+    decompressor = zlib.decompressobj()
+    decompressed = bytearray()
+    view = memoryview(data)
+    for start in range(0, len(view), CHUNK_SIZE):
+        decompressed += decompressor.decompress(
+            view[start : start + CHUNK_SIZE], MAX_SIZE + 1 - len(decompressed)
+        )
+        if len(decompressed) > MAX_SIZE or decompressor.unconsumed_tail:
+            raise InvalidMultidata("Decompressed multidata exceeds size limit", 413)
+    decompressed += decompressor.flush()
+    if len(decompressed) > MAX_SIZE:
+        raise InvalidMultidata("Decompressed multidata exceeds size limit", 413)
+    return bytes(decompressed)
+
+
+def _int(value) -> int:
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise TypeError(value)
+    return value
+
+
+def _str(value) -> str:
+    if not isinstance(value, str):
+        raise TypeError(value)
+    return value
+
+
+def _normalize(document) -> dict:
+    if not isinstance(document, dict) or not all(
+        key in document for key in ("names", "locations", "roms")
+    ):
+        raise InvalidMultidata("Invalid multidata")
+    try:
+        return {
+            # One list of player names per team
+            "names": [[_str(name) for name in team] for team in document["names"]],
+            # [[location id, player], [item id, item player]]
+            "locations": [
+                [[_int(location[0][0]), _int(location[0][1])], [_int(location[1][0]), _int(location[1][1])]]
+                for location in document["locations"]
+            ],
+            # [team, player, rom name bytes]
+            "roms": [[_int(rom[0]), _int(rom[1]), [_int(b) for b in rom[2]]] for rom in document["roms"]],
+        }
+    except (TypeError, IndexError, KeyError):
+        raise InvalidMultidata("Invalid multidata")
+
+
+def parse(data: bytes) -> tuple[str, dict]:
+    """
+    Decompresses, parses and normalizes a multidata file, returns its hash and the document. Runs in a worker
+    process.
+    """
+    try:
+        decompressed = _decompress(data)
+    except zlib.error:
+        raise InvalidMultidata("Invalid compressed data")
+    try:
+        document = json.loads(decompressed)
+    except ValueError:
+        raise InvalidMultidata("Invalid multidata")
+    return hashlib.sha256(decompressed).hexdigest(), _normalize(document)
+
+
+def document_hash(document: dict) -> str:
+    """Hash for a document whose file isn't around anymore, like one read back from a session export."""
+    return hashlib.sha256(
+        json.dumps(document, separators=(",", ":"), sort_keys=True).encode()
+    ).hexdigest()
+
+
+_pool: ProcessPoolExecutor | None = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Spawned, a fork of a worker with running threads and open database connections isn't safe to use
+        _pool = ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+async def parse_in_worker(data: bytes) -> tuple[str, dict]:
+    global _pool
+    pool = _get_pool()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, parse, data)
+    except BrokenProcessPool:
+        logger.exception("Multidata worker died, starting a new pool")
+        if _pool is pool:
+            _pool = None
+        raise
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+class Document:
+    """
+    A stored multidata document and the lookups compiled from it, shared by every session made from the same file.
+    Neither may be changed by the code using them.
+    """
+
+    def __init__(self, data: dict):
+        self.data = data
+        self._compiled: dict = {}
+
+    def compiled(self, key, compile: Callable[[dict], T]) -> T:
+        """The lookup stored under key, compiled from the document the first time it is asked for."""
+        try:
+            return self._compiled[key]
+        except KeyError:
+            # Threads asking at the same time may each compile it, they get the same result anyway
+            return self._compiled.setdefault(key, compile(self.data))
+
+
+_documents: OrderedDict[str, Document] = OrderedDict()
+_documents_lock = threading.Lock()
+
+
+def cached_document(multidata_hash: str, load: Callable[[], dict]) -> Document:
+    """
+    The document for the hash from the cache, load reads it from the database if it isn't cached. The
+    CACHE_SIZE least recently used documents are kept.
+    """
+    with _documents_lock:
+        document = _documents.get(multidata_hash)
+        if document is not None:
+            _documents.move_to_end(multidata_hash)
+            return document
+    loaded = Document(load())
+    with _documents_lock:
+        document = _documents.setdefault(multidata_hash, loaded)
+        _documents.move_to_end(multidata_hash)
+        while len(_documents) > CACHE_SIZE:
+            _documents.popitem(last=False)
+    return document
@@ -0,0 +1,75 @@
+"""
+Sampling profiler for a running worker, producing collapsed stacks for flamegraph.pl or speedscope.
+
+A thread looks at the event loop thread's stack a fixed number of times a second, so nothing is traced and the
+cost is one stack walk per sample. Each stack is prefixed with the ws session and message type it was running
+for, taken from the socket handler's locals, so a flamegraph splits into one tower per session.
+"""
+
+import threading
+import time
+from collections import Counter
+
+from server.watchdog import thread_frames
+
+MAX_SECONDS = 60
+MAX_HZ = 500
+
+_running = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _frame_name(frame) -> str:
+    return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}"
+
+
+def _tags(frames) -> list[str]:
+    for frame in frames:
+        if frame.f_code.co_name == "websocket_endpoint" and "mw_session_id" in frame.f_locals:
+            message_type = frame.f_locals.get("message_type") or "events"
+            return [f"session {frame.f_locals['mw_session_id']}", f"message {message_type}"]
+    return ["session none"]
+
+
+def collapse(frames) -> str:
+    """One collapsed stack line for a stack given innermost frame first."""
+    names = [_frame_name(frame) for frame in reversed(frames)]
+    return ";".join(_tags(frames) + names).replace(" ", "_")
+
+
+def profile(seconds: float, hz: int, thread_ids: dict[int, str]) -> Counter:
+    """
+    Samples the given threads (id -> name) for seconds at hz and returns collapsed stack -> sample count. When
+    more than one thread is sampled, stacks are prefixed with the thread name. Only one profile runs at a time.
+    """
+    if not _running.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        seconds = min(seconds, MAX_SECONDS)
+        interval = 1 / min(hz, MAX_HZ)
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        next_sample = time.monotonic()
+        while next_sample < deadline:
+            for thread_id, thread_name in thread_ids.items():
+                if thread_id == threading.get_ident():
+                    continue
+                frames = thread_frames(thread_id)
+                if not frames:
+                    continue
+                stack = collapse(frames)
+                if len(thread_ids) > 1:
+                    stack = f"thread_{thread_name};{stack}"
+                stacks[stack] += 1
+            next_sample += interval
+            time.sleep(max(0.0, next_sample - time.monotonic()))
+        return stacks
+    finally:
+        _running.release()
+
+
+def render(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
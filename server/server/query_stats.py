@@ -0,0 +1,128 @@
+"""
+SQL statement counting per HTTP request and per WebSocket message, to keep N+1 query patterns from coming back.
+
+Every statement run on any engine while a QueryStats is active is counted against it, together with the time
+spent in the database. Per request totals go to metrics; with QUERY_STATS_HEADERS set they are also returned as
+X-Query-Count and X-Query-Time response headers. Tests can put a budget on a block of code or an endpoint:
+
+    with query_stats.assert_max_queries(3):
+        crud.get_user_sessions(db, user_id)
+
+    query_stats.assert_response_queries(client.get(...), 5)  # needs QUERY_STATS_HEADERS
+
+server.loadtest checks the players info endpoint this way at the end of each run.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from server import metrics
+
+HEADERS = os.environ.get("QUERY_STATS_HEADERS", "").lower() in ("1", "true", "yes")
+MAX_RECORDED_STATEMENTS = 50
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements: list[str] = []
+
+
+_current: ContextVar[QueryStats | None] = ContextVar("query_stats", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is None or not conn.info.get("query_start"):
+        return
+    stats.count += 1
+    stats.seconds += time.perf_counter() - conn.info["query_start"].pop()
+    if len(stats.statements) < MAX_RECORDED_STATEMENTS:
+        stats.statements.append(statement)
+
+
+def start() -> tuple[QueryStats, Token]:
+    stats = QueryStats()
+    return stats, _current.set(stats)
+
+
+def finish(token: Token):
+    _current.reset(token)
+
+
+def observe(handler: str, stats: QueryStats):
+    metrics.QUERIES_PER_REQUEST.observe(stats.count, handler=handler)
+    metrics.DB_SECONDS_PER_REQUEST.observe(stats.seconds, handler=handler)
+
+
+@contextmanager
+def track():
+    stats, token = start()
+    try:
+        yield stats
+    finally:
+        finish(token)
+
+
+def _budget_error(count: int, limit: int, statements: list[str]) -> AssertionError:
+    return AssertionError(
+        f"{count} SQL statements, budget is {limit}:\n" + "\n".join(statements)
+    )
+
+
+@contextmanager
+def assert_max_queries(limit: int):
+    with track() as stats:
+        yield stats
+    if stats.count > limit:
+        raise _budget_error(stats.count, limit, stats.statements)
+
+
+def assert_response_queries(response, limit: int):
+    count = int(response.headers["X-Query-Count"])
+    if count > limit:
+        raise _budget_error(count, limit, [])
+
+
+class QueryStatsMiddleware:
+    """Tracks the statements of each HTTP request, labelled by route template so ids don't become labels."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats, token = start()
+
+        async def send_with_headers(message: Message):
+            if message["type"] == "http.response.start" and HEADERS:
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (b"x-query-count", str(stats.count).encode()),
+                    (b"x-query-time", f"{stats.seconds * 1000:.2f}ms".encode()),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            finish(token)
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            observe(f"{scope['method']} {path}", stats)
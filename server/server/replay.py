@@ -0,0 +1,252 @@
+"""
+Offline replay of recorded SRAM updates through the update_memory pipeline, for measuring and regression testing
+the SRAM -> item path without live players.
+
+A replay needs a session export (see server.session_export) for the multidata and a recording directory made by
+running the server with SRAM_RECORD_DIR set, which holds one <player id>.jsonl file per player. The recorded
+updates of all players are merged by time and run through server.ws.memory against a fresh copy of the session,
+with a number of broadcast subscribers standing in for connected sockets.
+
+    python -m server.replay <export file> <recording dir> [--db-uri sqlite://] [--listeners 8]
+        [--expected events.json] [--save events.json]
+
+The default database is an in-memory SQLite. Pass a scratch Postgres URI to measure the real thing; the replayed
+session is imported with a new id, so it never collides with existing data.
+"""
+
+import argparse
+import difflib
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+
+from sqlalchemy import create_engine, event as listen_event
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from . import models, session_export
+from .ws import broadcast, memory
+
+logger = logging.getLogger(__name__)
+
+
+def _sqlite_engine(db_uri: str):
+    engine = create_engine(
+        db_uri, connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    # SQLite can't autoincrement a composite primary key, so event ids are handed out here instead
+    models.Event.__table__.c.id.autoincrement = False
+    models.Base.metadata.create_all(engine)
+    event_ids = itertools.count(1)
+
+    def assign_event_id(mapper, connection, target):
+        if target.id is None:
+            target.id = next(event_ids)
+
+    listen_event.listen(models.Event, "before_insert", assign_event_id)
+    return engine
+
+
+def load_recording(directory: str) -> dict[int, list[dict]]:
+    recording = {}
+    for file_name in os.listdir(directory):
+        player, ext = os.path.splitext(file_name)
+        if ext != ".jsonl" or not player.isdigit():
+            continue
+        with open(os.path.join(directory, file_name)) as f:
+            recording[int(player)] = [json.loads(line) for line in f if line.strip()]
+    return recording
+
+
+def _merged_updates(recording: dict[int, list[dict]]):
+    """(time, player id, sram) for every recorded update, in the order the server received them."""
+    return heapq.merge(
+        *(
+            [(update["t"], player, update["data"]) for update in updates]
+            for player, updates in recording.items()
+        ),
+        key=lambda x: (x[0], x[1]),
+    )
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def item_events(db: Session, session_id) -> list[list]:
+    """The item events of a session in a comparable form, in creation order."""
+    events = (
+        db.query(models.Event)
+        .filter(models.Event.session_id == session_id)
+        .filter(models.Event.event_type == models.EventTypes.new_item)
+        .order_by(models.Event.id)
+        .all()
+    )
+    return [
+        [
+            event.from_player,
+            event.to_player,
+            event.item_id,
+            event.location,
+            event.to_player_idx,
+            event.frame_time,
+        ]
+        for event in events
+    ]
+
+
+def replay(
+    db: Session, export_file: str, recording: dict[int, list[dict]], listeners: int = 8
+) -> dict:
+    with open(export_file, "rb") as f:
+        session = session_export.import_session(db, f, new_id=True, with_progress=False)
+    player_names = session.mwdata["names"][0]
+    multidata_locs = memory.location_lookup(session.multidata_document)
+    checked_locations = {player: {} for player in recording}
+
+    fanout = {"events": 0, "seconds": 0.0}
+
+    # Times the whole fan-out of each stored event, building its message included, in place of broadcast's listener
+    def timed_after_insert(mapper, connection, target_event):
+        start = time.perf_counter()
+        broadcast._after_insert(mapper, connection, target_event)
+        fanout["events"] += 1
+        fanout["seconds"] += time.perf_counter() - start
+
+    def make_listener():
+        # Does what a socket's deliver does with an event before it is sent
+        def deliver(frame, target_event):
+            frame.text
+
+        return deliver
+
+    socket_listeners = [make_listener() for _ in range(listeners)]
+    for listener in socket_listeners:
+        broadcast.subscribe(session.id, listener)
+    for model in (models.Event, models.SessionMessage):
+        listen_event.remove(model, "after_insert", broadcast._after_insert)
+        listen_event.listen(model, "after_insert", timed_after_insert)
+
+    stage_times = {stage: [] for stage in memory.STAGES}
+    update_times = []
+    resent = 0
+    try:
+        started = time.perf_counter()
+        for _, player, sram_data in _merged_updates(recording):
+            timings = {}
+            update_start = time.perf_counter()
+            _, to_player_events = memory.process_memory_update(
+                db,
+                session,
+                player,
+                player_names[player - 1],
+                sram_data,
+                multidata_locs,
+                checked_locations[player],
+                timings,
+            )
+            update_times.append(time.perf_counter() - update_start)
+            for stage, seconds in timings.items():
+                stage_times[stage].append(seconds)
+            resent += len(to_player_events)
+        elapsed = time.perf_counter() - started
+    finally:
+        for model in (models.Event, models.SessionMessage):
+            listen_event.remove(model, "after_insert", timed_after_insert)
+            listen_event.listen(model, "after_insert", broadcast._after_insert)
+        for listener in socket_listeners:
+            broadcast.unsubscribe(session.id, listener)
+
+    return {
+        "session_id": session.id,
+        "updates": len(update_times),
+        "elapsed": elapsed,
+        "update_times": update_times,
+        "stage_times": stage_times,
+        "fanout": fanout,
+        "listeners": listeners,
+        "resent": resent,
+        "events": item_events(db, session.id),
+    }
+
+
+def print_report(result: dict):
+    updates = result["updates"]
+    elapsed = result["elapsed"]
+    print(f"Replayed {updates} updates in {elapsed:.2f}s ({updates / max(elapsed, 1e-9):.1f} updates/s)")
+    print(f"Created {len(result['events'])} item events, resent {result['resent']}")
+    print(f"{'stage':<12}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    rows = [("total", result["update_times"])] + list(result["stage_times"].items())
+    for stage, times in rows:
+        mean = sum(times) / len(times) if times else 0.0
+        print(
+            f"{stage:<12}{mean * 1000:>10.3f}{_percentile(times, 0.5) * 1000:>10.3f}"
+            f"{_percentile(times, 0.95) * 1000:>10.3f}{max(times, default=0.0) * 1000:>10.3f}"
+        )
+    fanout = result["fanout"]
+    if fanout["events"]:
+        print(
+            f"Fan-out: {fanout['events']} events to {result['listeners']} listeners, "
+            f"{fanout['seconds'] * 1000:.1f}ms total, {fanout['seconds'] / fanout['events'] * 1e6:.1f}us per event"
+        )
+
+
+def diff_events(expected: list[list], actual: list[list]) -> list[str]:
+    return list(
+        difflib.unified_diff(
+            [json.dumps(e) for e in expected],
+            [json.dumps(e) for e in actual],
+            "expected",
+            "replay",
+            lineterm="",
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded SRAM updates offline")
+    parser.add_argument("export_file")
+    parser.add_argument("recording_dir")
+    parser.add_argument("--db-uri", default="sqlite://")
+    parser.add_argument("--listeners", type=int, default=8, help="Simulated sockets per event")
+    parser.add_argument("--expected", help="Item events from an earlier run to compare against")
+    parser.add_argument("--save", help="Write the item events of this run to a file")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    if args.db_uri.startswith("sqlite"):
+        engine = _sqlite_engine(args.db_uri)
+    else:
+        engine = create_engine(args.db_uri)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    db.expire_on_commit = False
+
+    try:
+        result = replay(db, args.export_file, load_recording(args.recording_dir), args.listeners)
+    finally:
+        db.close()
+
+    print_report(result)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result["events"], f)
+    if args.expected:
+        with open(args.expected) as f:
+            diff = diff_events(json.load(f), result["events"])
+        if diff:
+            print("\n".join(diff))
+            raise SystemExit(1)
+        print("Item events match the expected run")
+
+
+if __name__ == "__main__":
+    main()
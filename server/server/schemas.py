@@ -12,8 +12,12 @@ class LogBase(BaseModel):
     player_id: int | None = None
     content: str
 
-class LogEntryCreate(LogBase):
-    pass
+
+class LogBatch(BaseModel):
+    player_id: int | None = None
+    messages: List[str] = []
+    # A single line, as sent by older clients
+    message: str | None = None
 
 
 class LogEntry(LogBase):
@@ -144,19 +148,20 @@ class Event(EventBase):
 
 class MWSessionBase(BaseModel):
     is_active: bool
-    mwdata: dict | None = None
     flags: dict | None = None
     allowed_users: List[str] | None = []
 
 
 class MWSessionCreate(MWSessionBase):
     game_id: int
+    multidata_hash: str
     session_password: str | None = None
     tournament: bool = False
 
 
 class MWSession(MWSessionBase):
     id: uuid.UUID
+    mwdata: dict | None = None
     created_at: datetime.datetime
     game: Game
 
@@ -245,4 +250,5 @@ class PaginatedSessions(BaseModel):
     items: List[MWSessionInfo]
     total: int
     page: int
-    pageSize: int
\ No newline at end of file
+    pageSize: int
+    nextCursor: str | None = None
\ No newline at end of file
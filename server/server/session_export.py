@@ -0,0 +1,265 @@
+"""
+Compact export format for a whole session, used for archival and for loading real sessions into a fresh database.
+
+The file is a zstd stream of length prefixed records, each one a record type byte, a little endian u32 payload
+length and a compact JSON payload. Placements and events are written in chunks, so exporting or importing a
+session only ever holds one chunk of events in memory.
+
+    python -m server.session_export export <session_id> <file>
+    python -m server.session_export import <file> [--owner <user_id>] [--new-id]
+"""
+
+import argparse
+import datetime
+import heapq
+import json
+import logging
+import struct
+import uuid
+from typing import BinaryIO, Iterator
+
+import zstandard
+from sqlalchemy.orm import Session
+
+from . import crud, models, multidata
+
+logger = logging.getLogger(__name__)
+
+EXPORT_MAGIC = b"WMSX"
+EXPORT_VERSION = 1
+
+RECORD_END = 0
+RECORD_SESSION = 1
+RECORD_MWDATA = 2
+RECORD_PLACEMENTS = 3
+RECORD_EVENTS = 4
+RECORD_SRAM = 5
+
+RECORD_HEADER = struct.Struct("<BI")
+CHUNK_SIZE = 1000
+
+
+class ExportFormatError(Exception):
+    pass
+
+
+def _record(record_type: int, payload=None) -> bytes:
+    data = b"" if payload is None else json.dumps(payload, separators=(",", ":")).encode()
+    return RECORD_HEADER.pack(record_type, len(data)) + data
+
+
+def _session_events(db: Session, session_id: uuid.UUID) -> Iterator[models.Event]:
+    archived = crud.get_archived_session(db, session_id)
+    if archived:
+        yield from crud.get_archived_events(archived)
+    events = (
+        db.query(models.Event)
+        .filter(models.Event.session_id == session_id)
+        .order_by(models.Event.id)
+        .execution_options(stream_results=True)
+        .yield_per(CHUNK_SIZE)
+    )
+    messages = (
+        db.query(models.SessionMessage)
+        .filter(models.SessionMessage.session_id == session_id)
+        .order_by(models.SessionMessage.id)
+        .execution_options(stream_results=True)
+        .yield_per(CHUNK_SIZE)
+    )
+    # Messages are written to the export as events, in the order they happened
+    yield from heapq.merge(events, messages, key=lambda x: x.id)
+
+
+def iter_session_records(db: Session, session: models.MWSession) -> Iterator[bytes]:
+    """Uncompressed records for a session, in file order."""
+    yield _record(
+        RECORD_SESSION,
+        {
+            "version": EXPORT_VERSION,
+            "id": str(session.id),
+            "game": session.game.title,
+            "created_at": session.created_at.isoformat(),
+            "is_active": session.is_active,
+            "tournament": session.tournament,
+            "session_password": session.session_password,
+            "allowed_users": session.allowed_users,
+            "flags": session.flags,
+            "multidata_hash": session.multidata_hash,
+        },
+    )
+
+    mwdata = session.mwdata
+    yield _record(RECORD_MWDATA, {k: v for k, v in mwdata.items() if k != "locations"})
+    locations = mwdata["locations"]
+    for ix in range(0, len(locations), CHUNK_SIZE):
+        yield _record(RECORD_PLACEMENTS, locations[ix : ix + CHUNK_SIZE])
+
+    chunk = []
+    for event in _session_events(db, session.id):
+        chunk.append(crud.event_to_archive_row(event))
+        if len(chunk) >= CHUNK_SIZE:
+            yield _record(RECORD_EVENTS, chunk)
+            chunk = []
+    if chunk:
+        yield _record(RECORD_EVENTS, chunk)
+
+    for player in range(1, len(mwdata["names"][0]) + 1):
+        sramstore = crud.get_sramstore(db, session.id, player)
+        if sramstore:
+            yield _record(RECORD_SRAM, {"player": player, "sram": sramstore.sram})
+
+    yield _record(RECORD_END)
+
+
+def iter_session_export(db: Session, session: models.MWSession) -> Iterator[bytes]:
+    """The compressed export file, as chunks suitable for a streaming response."""
+    compressor = zstandard.ZstdCompressor(level=10).compressobj()
+    yield EXPORT_MAGIC + bytes([EXPORT_VERSION])
+    for record in iter_session_records(db, session):
+        compressed = compressor.compress(record)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_session(db: Session, session: models.MWSession, out: BinaryIO) -> None:
+    for chunk in iter_session_export(db, session):
+        out.write(chunk)
+
+
+def _read_exact(reader, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = reader.read(size - len(data))
+        if not chunk:
+            raise ExportFormatError("Unexpected end of export file")
+        data += chunk
+    return data
+
+
+def iter_export_records(source: BinaryIO) -> Iterator[tuple[int, object]]:
+    header = source.read(len(EXPORT_MAGIC) + 1)
+    if header[: len(EXPORT_MAGIC)] != EXPORT_MAGIC:
+        raise ExportFormatError("Not a session export file")
+    if header[-1] != EXPORT_VERSION:
+        raise ExportFormatError(f"Unsupported export version: {header[-1]}")
+
+    reader = zstandard.ZstdDecompressor().stream_reader(source)
+    while True:
+        record_type, size = RECORD_HEADER.unpack(_read_exact(reader, RECORD_HEADER.size))
+        if record_type == RECORD_END:
+            return
+        yield record_type, json.loads(_read_exact(reader, size))
+
+
+def import_session(
+    db: Session,
+    source: BinaryIO,
+    owner_id: int | None = None,
+    new_id: bool = False,
+    with_progress: bool = True,
+) -> models.MWSession:
+    """
+    Loads an export into the database. Event ids are reassigned by the database and user references dropped,
+    so an export can be loaded next to existing data or into an empty database. Without progress only the
+    session and multidata are loaded, as if nobody had joined yet.
+    """
+    records = iter_export_records(source)
+
+    record_type, session_info = next(records, (RECORD_END, None))
+    if record_type != RECORD_SESSION:
+        raise ExportFormatError("Export doesn't start with a session record")
+    record_type, mwdata = next(records, (RECORD_END, None))
+    if record_type != RECORD_MWDATA:
+        raise ExportFormatError("Export is missing the multidata record")
+    mwdata["locations"] = []
+
+    # The multidata is stored as one document, so all placements need to be read before the session row exists
+    record_type, payload = next(records, (RECORD_END, None))
+    while record_type == RECORD_PLACEMENTS:
+        mwdata["locations"].extend(payload)
+        record_type, payload = next(records, (RECORD_END, None))
+
+    db_game = crud.get_game(db, session_info["game"])
+    if not db_game:
+        db_game = models.Game(title=session_info["game"])
+        db.add(db_game)
+        db.flush()
+
+    # Exports made before multidata was stored by hash don't have one
+    multidata_hash = session_info.get("multidata_hash") or multidata.document_hash(mwdata)
+    crud.store_multidata(db, multidata_hash, mwdata)
+
+    session = models.MWSession(
+        id=uuid.uuid4() if new_id else uuid.UUID(session_info["id"]),
+        game_id=db_game.id,
+        created_at=datetime.datetime.fromisoformat(session_info["created_at"]),
+        is_active=session_info["is_active"],
+        tournament=session_info["tournament"],
+        session_password=session_info["session_password"],
+        allowed_users=session_info["allowed_users"],
+        flags=session_info["flags"],
+        multidata_hash=multidata_hash,
+    )
+    if owner_id:
+        session.owners.append(crud.get_user(db, owner_id))
+    db.add(session)
+    db.flush()
+
+    event_count = 0
+    while record_type != RECORD_END and with_progress:
+        if record_type == RECORD_EVENTS:
+            rows = []
+            for values in payload:
+                row = crud.archive_row_to_event_fields(values, session.id)
+                del row["id"]
+                row["user_id"] = None
+                rows.append(row)
+            crud.insert_event_rows(db, rows)
+            event_count += len(rows)
+        elif record_type == RECORD_SRAM:
+            db.add(
+                models.SRAMStore(
+                    session_id=session.id, player=payload["player"], sram=payload["sram"]
+                )
+            )
+        record_type, payload = next(records, (RECORD_END, None))
+
+    db.commit()
+    crud.invalidate_session_counts()
+    logger.info(f"Imported session {session.id} with {event_count} events")
+    return session
+
+
+def main():
+    from .database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Export or import a multiworld session")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export")
+    export_parser.add_argument("session_id")
+    export_parser.add_argument("file")
+    import_parser = commands.add_parser("import")
+    import_parser.add_argument("file")
+    import_parser.add_argument("--owner", type=int, default=None)
+    import_parser.add_argument("--new-id", action="store_true")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.command == "export":
+            session = crud.get_session(db, args.session_id)
+            if not session:
+                raise SystemExit(f"Session {args.session_id} not found")
+            with open(args.file, "wb") as f:
+                export_session(db, session, f)
+        else:
+            with open(args.file, "rb") as f:
+                session = import_session(db, f, owner_id=args.owner, new_id=args.new_id)
+            print(session.id)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
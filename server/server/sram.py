@@ -21,7 +21,8 @@ def sram_diff(new_sram: dict, old_sram: dict) -> dict:
     }
 
 
-def get_changed_locations(sram_diff: dict, old_sram: dict, new_sram: dict) -> list[str]:
+def get_changed_locations(sram_diff: dict, old_sram: dict, new_sram: dict) -> list[int]:
+    """Ids of the locations checked between old_sram and new_sram."""
     locations = []
     for loc_group, diff_data in sram_diff.items():
         for mem_loc, _ in diff_data.items():
@@ -44,11 +45,11 @@ def get_changed_locations(sram_diff: dict, old_sram: dict, new_sram: dict) -> li
                 old_room_data = old_sram[loc_group][mem_loc] | (
                     old_sram[loc_group][mem_loc + 1] << 8
                 )
-                for name, mask in loc_data.location_info_by_room[loc_group][room_id]:
+                for loc_id, mask in loc_data.location_info_by_room[loc_group][room_id]:
                     if ((room_data & mask) != (old_room_data & mask)) and (
                         room_data & mask
                     ) != 0:
-                        locations.append(name)
+                        locations.append(loc_id)
             elif loc_group in ["overworld"]:
                 try:
                     ow_data = new_sram[loc_group][mem_loc]
@@ -56,38 +57,38 @@ def get_changed_locations(sram_diff: dict, old_sram: dict, new_sram: dict) -> li
                     if ((ow_data & 0x40) != (old_ow_data & 0x40)) and (
                         ow_data & 0x40
                     ) != 0:
-                        name = loc_data.location_info_reversed[loc_group][mem_loc]
-                        locations.append(name)
+                        loc_id = loc_data.location_info_reversed[loc_group][mem_loc]
+                        locations.append(loc_id)
                     else:
-                        for name, mask in loc_data.location_info_by_ow_screen[
+                        for loc_id, mask in loc_data.location_info_by_ow_screen[
                             "bonk_prizes"
                         ][mem_loc]:
                             if ((ow_data & mask) != (old_ow_data & mask)) and (
                                 ow_data & mask
                             ) != 0:
-                                locations.append(name)
+                                locations.append(loc_id)
                 except KeyError:
                     logger.error(f"Error getting overworld location: {mem_loc}")
                     continue
             elif loc_group in ["npcs", "bosses"]:
                 npc_data = new_sram[loc_group][0] | (new_sram[loc_group][1] << 8)
                 old_npc_data = old_sram[loc_group][0] | (old_sram[loc_group][1] << 8)
-                for name, mask in loc_data.location_info[loc_group].items():
+                for loc_id, mask in loc_data.location_masks[loc_group]:
                     if ((npc_data & mask) != (old_npc_data & mask)) and (
                         npc_data & mask
                     ) != 0:
-                        locations.append(name)
+                        locations.append(loc_id)
             elif loc_group == "misc":
                 misc_data = new_sram[loc_group][mem_loc]
                 old_misc_data = old_sram[loc_group][mem_loc]
-                for name, mask in loc_data.location_info_by_room[loc_group][mem_loc + 0x3C6]:
+                for loc_id, mask in loc_data.location_info_by_room[loc_group][mem_loc + 0x3C6]:
                     if ((misc_data & mask) != (old_misc_data & mask)) and (
                         misc_data & mask
                     ) != 0:
-                        locations.append(name)
+                        locations.append(loc_id)
             elif loc_group == "shops":
                 shop_data = new_sram[loc_group][mem_loc]
-                name = loc_data.location_info_reversed[loc_group][0x400000 + mem_loc]
+                loc_id = loc_data.location_info_reversed[loc_group][0x400000 + mem_loc]
                 if int(shop_data) > 0:
-                    locations.append(name)
+                    locations.append(loc_id)
     return locations
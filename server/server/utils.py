@@ -1,7 +1,6 @@
 from collections import defaultdict
 import datetime
 
-from asyncio import sleep
 import json
 from fastapi import Depends
 from sqlalchemy.orm import Session
@@ -9,6 +8,7 @@ from typing import Annotated
 
 from . import models, schemas, crud
 from .dependencies import get_db
+from .ws import presence
 
 from .data.data import DUNGEON_IDS
 
@@ -59,27 +59,6 @@ def player_chat(
     )
 
 
-async def countdown(
-    countdown_time: int,
-    session: models.MWSession,
-    db: Annotated[Session, Depends(get_db)],
-):
-    await sleep(0.5)
-    start_time = datetime.datetime.now()
-    for i in range(countdown_time, -1, -1):
-        while True:
-            if datetime.datetime.now() >= start_time + datetime.timedelta(
-                seconds=countdown_time - i
-            ):
-                if i <= 0:
-                    break
-                system_chat(f"{i}", session, db, type="countdown")
-                break
-            else:
-                await sleep(0.010)
-    system_chat("GO!", session, db, type="countdown")
-
-
 def sanitize_chat_message(message: str):
     if message.startswith("/"):
         command = message.split(" ")
@@ -110,17 +89,30 @@ def user_allowed_in_session(session: models.MWSession, user: models.User):
     return user.discord_id in all_allowed_users
 
 
+TIME_TO_IDLE = datetime.timedelta(days=2)
+
+
+def get_session_status(player_datas: list[schemas.PlayerInfo], last_updated: float) -> str:
+    if all([x.goalCompleted for x in player_datas]):
+        return "completed"
+    elif last_updated <= (datetime.datetime.now() - TIME_TO_IDLE).timestamp():
+        return "inactive"
+    return "active"
+
+
 def get_session_players_info_from_db(
     db: Annotated[Session, Depends(get_db)], session: models.MWSession
 ) -> list[schemas.PlayerInfo]:
-    user_session_links = {
-        x.player_id: crud.get_user(db, x.user_id)
-        for x in crud.get_user_session_links(db, session.id)
-    }
-    player_srams = [
-        crud.get_sramstore(db, session.id, x + 1)
-        for x in range(len(session.mwdata["names"][0]))
-    ]
+    user_session_links = crud.get_session_player_users(db, session.id)
+    sramstores = crud.get_sramstores(db, session.id)
+    player_srams = [sramstores.get(x + 1) for x in range(len(session.mwdata["names"][0]))]
+    connected_players = presence.connected_players(db, session.id)
+    receiving_paused_players = crud.get_players_receiving_paused(db, session.id)
+    if len(receiving_paused_players) < len(player_srams):
+        # Players that haven't connected since progress was kept
+        receiving_paused_from_messages = crud.get_players_receiving_paused_from_messages(db, session.id)
+    else:
+        receiving_paused_from_messages = {}
     player_datas = []
     players_tot_cr = defaultdict(int)
     for loc in session.mwdata["locations"]:
@@ -132,7 +124,6 @@ def get_session_players_info_from_db(
         player_id += 1
         cr = 0
         goal_completed = False
-        connected = False
         coords = [0, 0]
         world = "EG1"
         health = 3.0
@@ -142,12 +133,7 @@ def get_session_players_info_from_db(
         userName = None
         colour = None
 
-        conn_events = crud.get_player_connection_events(db, session.id, player_id)
-        if (
-            len(conn_events) > 0
-            and conn_events[0].event_type == models.EventTypes.player_join
-        ):
-            connected = True
+        connected = player_id in connected_players
 
         if player_sram:
             sram = json.loads(player_sram.sram)
@@ -181,7 +167,10 @@ def get_session_players_info_from_db(
             userName = user.username
             colour = user.colour
 
-        receiving_paused = crud.is_player_receiving_paused(db, session.id, player_id)
+        if player_id in receiving_paused_players:
+            receiving_paused = receiving_paused_players[player_id]
+        else:
+            receiving_paused = receiving_paused_from_messages.get(player_id, False)
 
         player_datas.append(
             schemas.PlayerInfo(
@@ -0,0 +1,150 @@
+"""
+Event loop lag watchdog.
+
+A heartbeat coroutine measures how late the loop wakes it up, which is the scheduling lag every socket in the
+worker sees. A thread watches the heartbeat, and when the loop has been stuck for longer than
+WATCHDOG_SLOW_SECONDS it captures the loop thread's stack right then, so the blocking call and the session it
+was made for get logged while they're still running. This works the same under uvloop, where individual
+callbacks can't be timed.
+"""
+
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import deque
+
+from server import metrics
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 0.25
+SLOW_SECONDS = float(os.environ.get("WATCHDOG_SLOW_SECONDS", 0.1))
+STACK_DEPTH = 20
+
+recent_lag: deque[float] = deque(maxlen=2000)
+recent_stalls: deque[dict] = deque(maxlen=50)
+
+_loop_thread_id = None
+_last_beat = time.monotonic()
+
+
+def frame_session(frames) -> str | None:
+    """The ws session and player a stack belongs to, found from the socket handler's locals."""
+    for frame in frames:
+        if frame.f_code.co_name == "websocket_endpoint" and "mw_session_id" in frame.f_locals:
+            session_id = frame.f_locals["mw_session_id"]
+            player_id = frame.f_locals.get("player_id")
+            return f"{session_id}:{player_id}" if player_id is not None else session_id
+    return None
+
+
+def coroutine_frames(coro) -> list:
+    """
+    Frames of a suspended coroutine chain, outermost first. Task.get_stack() only has the task's own coroutine, the
+    ones it is awaiting hang off cr_await (gi_yieldfrom for generator based ones, ag_await for async generators).
+    """
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is not None:
+            frames.append(frame)
+        coro = (
+            getattr(coro, "cr_await", None)
+            or getattr(coro, "gi_yieldfrom", None)
+            or getattr(coro, "ag_await", None)
+        )
+    return frames
+
+
+def thread_frames(thread_id: int) -> list:
+    frame = sys._current_frames().get(thread_id)
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    return frames
+
+
+def _format_frames(frames) -> list[str]:
+    return [
+        f"{frame.f_code.co_filename}:{frame.f_lineno} {frame.f_code.co_name}"
+        for frame in frames[:STACK_DEPTH]
+    ]
+
+
+def _watch(stop: threading.Event):
+    reported_beat = None
+    while not stop.wait(HEARTBEAT_INTERVAL / 2):
+        beat = _last_beat
+        stalled = time.monotonic() - beat - HEARTBEAT_INTERVAL
+        if stalled < SLOW_SECONDS or reported_beat == beat:
+            continue
+        # Report each stall once, with the stack at the moment it was noticed
+        reported_beat = beat
+        frames = thread_frames(_loop_thread_id)
+        session = frame_session(frames) or "none"
+        stack = _format_frames(frames)
+        recent_stalls.append(
+            {"at": time.time(), "stalled": round(stalled, 3), "session": session, "stack": stack}
+        )
+        metrics.SLOW_CALLBACKS.inc(session=session.split(":")[0])
+        logger.warning(
+            "Event loop blocked for at least %.3fs (session %s) at:\n  %s",
+            stalled,
+            session,
+            "\n  ".join(stack[:8]),
+        )
+
+
+async def lag_monitor():
+    global _loop_thread_id, _last_beat
+    _loop_thread_id = threading.get_ident()
+    stop = threading.Event()
+    thread = threading.Thread(target=_watch, args=(stop,), name="loop-watchdog", daemon=True)
+    loop = asyncio.get_running_loop()
+    _last_beat = time.monotonic()
+    thread.start()
+    try:
+        while True:
+            expected = loop.time() + HEARTBEAT_INTERVAL
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            lag = max(0.0, loop.time() - expected)
+            _last_beat = time.monotonic()
+            recent_lag.append(lag)
+            metrics.EVENT_LOOP_LAG_SECONDS.observe(lag)
+    finally:
+        stop.set()
+
+
+def lag_percentiles() -> dict:
+    if len(recent_lag) < 2:
+        return {}
+    cuts = statistics.quantiles(recent_lag, n=100, method="inclusive")
+    return {
+        "samples": len(recent_lag),
+        "p50": cuts[49],
+        "p95": cuts[94],
+        "p99": cuts[98],
+        "max": max(recent_lag),
+    }
+
+
+def task_stacks() -> dict[str, list[dict]]:
+    """Stacks of every task on the running loop, grouped by the ws session they serve."""
+    by_session = {}
+    for task in asyncio.all_tasks():
+        frames = coroutine_frames(task.get_coro()) or task.get_stack(limit=STACK_DEPTH)
+        session = frame_session(frames) or "none"
+        by_session.setdefault(session.split(":")[0], []).append(
+            {
+                "task": task.get_name(),
+                "player": session.split(":")[1] if ":" in session else None,
+                # Innermost frame first, like the stacks of blocked loops
+                "stack": _format_frames(frames[::-1]),
+            }
+        )
+    return by_session
@@ -0,0 +1,85 @@
+"""
+Sockets connected to this worker, by session, and the fan-out of messages to them.
+
+A single after_insert listener builds the message for each new event or session message once and hands the same
+Frame to every socket of the event's session, players and spectators alike. The frame's JSON text is also only
+encoded once, by whichever socket sends it first, so a chat line or a join going to fifty sockets costs one dict and
+one json.dumps. Sockets only do per-recipient work for what they filter out, like other players' private messages.
+
+Each socket subscribes a deliver function, called from the event loop with the frame and the event it was made
+for. Messages that aren't stored as events, like countdown ticks, are delivered with no event. deliver must not
+block.
+"""
+
+import json
+import uuid
+from typing import Callable
+
+from sqlalchemy import event as listen_event
+
+from server import models
+from server.ws import memory
+
+
+class Frame:
+    """A message for one or more sockets, serialized at most once."""
+
+    __slots__ = ("message", "_text")
+
+    def __init__(self, message: dict):
+        self.message = message
+        self._text = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            # Same encoding as WebSocket.send_json
+            self._text = json.dumps(self.message, separators=(",", ":"), ensure_ascii=False)
+        return self._text
+
+    def __repr__(self) -> str:
+        return repr(self.message)
+
+
+Deliver = Callable[[Frame, models.Event | models.SessionMessage | None], None]
+
+_subscribers: dict[uuid.UUID, set[Deliver]] = {}
+
+
+def subscribe(session_id: uuid.UUID, deliver: Deliver):
+    _subscribers.setdefault(session_id, set()).add(deliver)
+
+
+def unsubscribe(session_id: uuid.UUID, deliver: Deliver):
+    subscribers = _subscribers.get(session_id)
+    if subscribers is None:
+        return
+    subscribers.discard(deliver)
+    if not subscribers:
+        del _subscribers[session_id]
+
+
+def broadcast(session_id: uuid.UUID, message: dict) -> int:
+    """Hands message to every socket of the session on this worker and returns how many there were."""
+    subscribers = list(_subscribers.get(session_id, ()))
+    if subscribers:
+        frame = Frame(message)
+        for deliver in subscribers:
+            deliver(frame, None)
+    return len(subscribers)
+
+
+def broadcast_event(target_event: models.Event | models.SessionMessage):
+    """Hands an event to every socket of its session as if it had just been inserted, for events stored off the loop."""
+    subscribers = _subscribers.get(target_event.session_id)
+    if not subscribers:
+        return
+    frame = Frame(memory.event_message(target_event))
+    for deliver in list(subscribers):
+        deliver(frame, target_event)
+
+
+@listen_event.listens_for(models.Event, "after_insert")
+@listen_event.listens_for(models.SessionMessage, "after_insert")
+def _after_insert(mapper, connection, target_event: models.Event | models.SessionMessage):
+    broadcast_event(target_event)
@@ -0,0 +1,67 @@
+"""
+Messages received on one socket, read by their own reader task so the receive loop can see what else is already
+waiting when it gets to a message.
+
+That lets a loop that fell behind catch up on SRAM updates in one step. Within one run of a game's frame time
+location bits only ever get set, so the newest of several waiting update_memory snapshots holds every check of
+the ones before it and only it needs processing. A snapshot whose frame time went backwards (a save scum or
+reset) ends the run and is processed on its own, so the rollback is still seen. That includes the first snapshot
+of the run going back from the last one processed.
+"""
+
+import asyncio
+from collections import deque
+
+from fastapi import WebSocket
+
+from server.ws import memory
+
+
+class Inbox:
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self._messages: deque[dict] = deque()
+        self._error: Exception | None = None
+        self._wakeup = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    async def run(self):
+        """The socket's reader task. Ends at the first receive error, like the client disconnecting."""
+        try:
+            while True:
+                self._messages.append(await self.websocket.receive_json())
+                self._wakeup.set()
+        except Exception as e:
+            # Raised by get once the messages received before it are handled
+            self._error = e
+            self._wakeup.set()
+
+    async def get(self) -> dict:
+        while not self._messages:
+            if self._error is not None:
+                raise self._error
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        return self._messages.popleft()
+
+    def newer_memory_updates(self, sram_data: dict, processed_frame_time: int | None) -> list[dict]:
+        """
+        Takes the SRAM of the update_memory messages waiting right behind the one with sram_data, for as long as
+        the frame time doesn't go backwards. The last one taken supersedes sram_data and the others.
+
+        processed_frame_time is the frame time of the last SRAM processed, if sram_data goes back from it nothing is
+        taken so the rollback is processed on its own.
+        """
+        taken = []
+        last_frame_time = memory.frame_time(sram_data)
+        if processed_frame_time is not None and last_frame_time < processed_frame_time:
+            return taken
+        while self._messages and self._messages[0].get("type") == "update_memory":
+            next_frame_time = memory.frame_time(self._messages[0]["data"])
+            if next_frame_time < last_frame_time:
+                break
+            taken.append(self._messages.popleft()["data"])
+            last_frame_time = next_frame_time
+        return taken
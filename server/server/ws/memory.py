@@ -0,0 +1,310 @@
+"""
+The update_memory pipeline for a connected player: store the SRAM, diff it, decode checked locations, create item
+events and find items the player is missing. It's kept apart from the socket so server.replay can run recorded
+sessions through exactly the same code.
+"""
+
+import json
+import logging
+import os
+import time
+import uuid
+
+from sqlalchemy.orm import Session
+
+from server import crud, models, multidata, schemas, sram
+from server.data import data as loc_data
+from server.logging import log_every
+
+logger = logging.getLogger(__name__)
+
+# Set to a directory to record every update_memory payload, one JSONL file per player, for server.replay
+RECORD_DIR = os.environ.get("SRAM_RECORD_DIR")
+
+STAGES = ("sramstore", "diff", "locations", "rollback", "events", "resend")
+
+
+def location_lookup(document: multidata.Document) -> dict[tuple, tuple]:
+    """
+    (location id, player) -> (item id, item player) for every placement in the multidata. Shared by all sessions
+    of the document, don't change it.
+    """
+    return document.compiled(
+        "location_lookup", lambda data: {tuple(d[0]): tuple(d[1]) for d in data["locations"]}
+    )
+
+
+def _player_locations(data: dict, player_id: int) -> tuple[tuple[int, ...], dict[int, int]]:
+    locations = tuple(sorted({d[0][0] for d in data["locations"] if d[0][1] == player_id}))
+    return locations, {location: 1 << ix for ix, location in enumerate(locations)}
+
+
+def frame_time(sram_data: dict) -> int:
+    return (
+        sram_data["total_time"][2] << 16
+        | sram_data["total_time"][1] << 8
+        | sram_data["total_time"][0]
+    )
+
+
+def item_names(item_id: int, location: int) -> dict:
+    """The names of an item event's item and location. They aren't stored, only added to what is sent."""
+    return {
+        "item_name": loc_data.item_name_by_id[item_id],
+        "location_name": loc_data.location_name_by_id[location],
+    }
+
+
+def event_message(event: models.Event) -> dict:
+    """The message sent to sockets for a freshly inserted event."""
+    message = {
+        "type": event.event_type.name,
+        "data": {
+            "id": event.id,
+            "timestamp": int(time.mktime(event.timestamp.timetuple())),
+            "event_type": event.event_type.name,
+            "from_player": event.from_player,
+            "to_player": event.to_player,
+            "item_id": event.item_id,
+            "location": event.location,
+            "event_data": event.event_data,
+        },
+    }
+    if event.event_type == models.EventTypes.new_item:
+        message["data"]["event_data"] = {
+            **(event.event_data or {}),
+            **item_names(event.item_id, event.location),
+        }
+        if event.to_player != event.from_player:
+            message["data"]["event_idx"] = list(event.to_player_idx.to_bytes(2, "big"))
+    return message
+
+
+def system_chat_message(message: str, type: str = "chat", private: int = -1, **extra) -> dict:
+    """A system chat message in the same shape as a stored one, for messages sent without storing an event."""
+    return {
+        "type": "chat",
+        "data": {
+            "id": None,
+            "timestamp": int(time.time()),
+            "event_type": models.EventTypes.chat.name,
+            "from_player": -1,
+            "to_player": private,
+            "item_id": -1,
+            "location": -1,
+            "event_data": {
+                "message": message,
+                "type": type,
+                "private": private != -1,
+                **extra,
+            },
+        },
+    }
+
+
+def item_event_message(event: models.Event) -> dict:
+    """A new_item message for an item event read back from the database, used when resending items."""
+    names = item_names(event.item_id, event.location)
+    return {
+        "type": "new_item",
+        "data": {
+            "id": event.id,
+            "timestamp": int(time.mktime(event.timestamp.timetuple())),
+            "event_type": event.event_type.name,
+            "from_player": event.from_player,
+            "to_player": event.to_player,
+            "event_idx": list(event.to_player_idx.to_bytes(2, "big")),
+            "item_id": loc_data.item_send_id[event.item_id],
+            "location": event.location,
+            "event_data": names,
+        },
+    }
+
+
+class CheckedLocations:
+    """
+    The player's own locations from the multidata, each one a bit that is set once it has been checked. Bits are
+    never cleared, a location checked before a save scum still counts as checked.
+    """
+
+    def __init__(self, document: multidata.Document, player_id: int):
+        # Compiled once per document and player, shared by the player's sockets in every session of the document
+        self.locations, self.bits = document.compiled(
+            ("player_locations", player_id), lambda data: _player_locations(data, player_id)
+        )
+        self.checked = 0
+
+    def mark(self, location: int):
+        self.checked |= self.bits.get(location, 0)
+
+    def found(self) -> list[int]:
+        return [
+            location
+            for ix, location in enumerate(self.locations)
+            if self.checked >> ix & 1
+        ]
+
+    def missing(self) -> list[int]:
+        return [
+            location
+            for ix, location in enumerate(self.locations)
+            if not self.checked >> ix & 1
+        ]
+
+
+def missing_locations_message(player_id: int, checks: CheckedLocations) -> dict:
+    """The private reply to /missing, the client lists the location names under the message."""
+    names = [loc_data.location_name_by_id[location] for location in checks.missing()]
+    return system_chat_message(
+        f"Missing locations ({len(names)}):",
+        type="missing_locations",
+        private=player_id,
+        locations=names,
+    )
+
+
+class _StageClock:
+    def __init__(self, timings: dict | None):
+        self.timings = timings
+        self.last = time.perf_counter()
+
+    def lap(self, stage: str):
+        now = time.perf_counter()
+        if self.timings is not None:
+            self.timings[stage] = self.timings.get(stage, 0.0) + (now - self.last)
+        self.last = now
+
+
+def process_memory_update(
+    db: Session,
+    session: models.MWSession,
+    player_id: int,
+    player_name: str,
+    sram_data: dict,
+    multidata_locs: dict[tuple, tuple],
+    checked_locations: dict[int, int | None],
+    timings: dict | None = None,
+) -> tuple[dict, list[models.Event]]:
+    """
+    Runs one SRAM update from a player. checked_locations is the connection's location -> frame time state and is
+    updated in place. Returns the new SRAM and the item events the player hasn't received yet. If timings is
+    given, the seconds spent in each of STAGES are added to it.
+    """
+    clock = _StageClock(timings)
+
+    sramstore = schemas.SRAMStoreCreate(
+        session_id=session.id,
+        player=player_id,
+        sram=json.dumps(sram_data),
+    )
+    # NOTE: This sram store could be moved to on disconnect only if we want to save on writes
+    old_sram, new_sram = crud.update_sramstore(db, sramstore)
+    clock.lap("sramstore")
+
+    if old_sram == None:
+        return new_sram, []
+
+    sram_diff = sram.sram_diff(new_sram, old_sram)
+    clock.lap("diff")
+
+    if len(sram_diff) == 0:
+        return new_sram, []
+
+    locations = sram.get_changed_locations(sram_diff, old_sram, new_sram)
+    clock.lap("locations")
+
+    new_frame_time = frame_time(new_sram)
+    if new_frame_time < frame_time(old_sram):
+        logger.debug("%s - Frame time went backwards - Save scum or reset", player_name)
+        for location in crud.clear_events_frametime_after(
+            db, session.id, player_id, new_frame_time
+        ):
+            checked_locations[location] = None
+    clock.lap("rollback")
+
+    for loc_id in locations:
+        if (loc_id, player_id) not in multidata_locs:
+            logger.error(
+                "%s - Location not in multidata_locs: %s [%s]",
+                player_name,
+                loc_data.location_name_by_id[loc_id],
+                loc_id,
+            )
+            continue
+        item_id, item_player = multidata_locs[(loc_id, player_id)]
+
+        if loc_id not in checked_locations or (
+            checked_locations[loc_id] != None
+            and (
+                (checked_locations[loc_id] < new_frame_time) and session.flags["duping"]
+            )
+        ):
+            logger.info(
+                "%s - New Location Checked: %s [%s]",
+                player_name,
+                loc_data.location_name_by_id[loc_id],
+                loc_id,
+            )
+
+            crud.create_event(
+                db,
+                schemas.EventCreate(
+                    session_id=session.id,
+                    event_type=models.EventTypes.new_item,
+                    from_player=player_id,
+                    to_player=item_player,
+                    item_id=item_id,
+                    location=loc_id,
+                    frame_time=new_frame_time,
+                    event_data={},
+                ),
+            )
+            checked_locations[loc_id] = new_frame_time
+    clock.lap("events")
+
+    # Compare all events for the player with their sram to see if they need to be sent any items (save scummed)
+    last_event = int.from_bytes(new_sram["multiinfo"][:2], "big")
+    to_player_events = crud.get_items_for_player_from_others(
+        db, session.id, player_id, gt_idx=last_event
+    )
+    if to_player_events:
+        # A player that is behind gets the same resend on every poll until the items arrive
+        log_every(
+            logger,
+            logging.INFO,
+            (session.id, player_id),
+            10,
+            "%s - Player is missing %s items from others (ids %s-%s). Resending",
+            player_name,
+            len(to_player_events),
+            to_player_events[0].id,
+            to_player_events[-1].id,
+        )
+    clock.lap("resend")
+
+    return new_sram, to_player_events
+
+
+class MemoryRecorder:
+    """Appends a player's update_memory payloads to RECORD_DIR/<session id>/<player id>.jsonl."""
+
+    def __init__(self, session_id: uuid.UUID, player_id: int):
+        directory = os.path.join(RECORD_DIR, str(session_id))
+        os.makedirs(directory, exist_ok=True)
+        self.file = open(os.path.join(directory, f"{player_id}.jsonl"), "a")
+
+    def record(self, sram_data: dict):
+        self.file.write(
+            json.dumps({"t": time.time(), "data": sram_data}, separators=(",", ":"))
+            + "\n"
+        )
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def open_recorder(session_id: uuid.UUID, player_id: int) -> MemoryRecorder | None:
+    if not RECORD_DIR:
+        return None
+    return MemoryRecorder(session_id, player_id)
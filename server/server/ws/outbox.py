@@ -0,0 +1,140 @@
+"""
+Bounded send queue for one socket, drained by its own writer task so a slow client never holds up the socket's
+SRAM processing.
+
+Some messages only matter as the latest of their kind, like a player's receiving status; a newer one replaces one
+still queued. Once more than WS_SEND_QUEUE_SOFT_LIMIT frames are waiting the client is behind, and droppable
+frames, like countdown ticks that would arrive too late anyway, aren't queued. A client more than
+WS_SEND_QUEUE_LIMIT frames behind is closed with 1013 (try again later) and no reason, which the client answers
+by reconnecting. It then catches up from the database, players get their items resent from their SRAM, instead
+of the queue growing without bound.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from fastapi import WebSocket
+
+from server import metrics
+from server.ws.broadcast import Frame
+
+logger = logging.getLogger(__name__)
+
+SOFT_LIMIT = int(os.environ.get("WS_SEND_QUEUE_SOFT_LIMIT", 100))
+LIMIT = int(os.environ.get("WS_SEND_QUEUE_LIMIT", 500))
+
+TRY_AGAIN_LATER = 1013
+
+
+def coalesce_key(message: dict) -> tuple | None:
+    """Key of a message that supersedes any queued message with the same key, or None."""
+    if message["type"] in ("flags", "resume"):
+        return (message["type"],)
+    if message["type"] in ("player_pause_receive", "player_resume_receive"):
+        return ("receiving", message["data"]["from_player"])
+    if message["type"] == "chat" and isinstance(message["data"], dict):
+        event_data = message["data"].get("event_data") or {}
+        if event_data.get("type") in ("ready_response", "unready_response"):
+            return ("ready", event_data.get("player_id"))
+    return None
+
+
+class _Entry:
+    __slots__ = ("frame", "key", "queued_at")
+
+    def __init__(self, frame: Frame, key: tuple | None, queued_at: list[float]):
+        self.frame = frame
+        self.key = key
+        self.queued_at = queued_at
+
+
+class Outbox:
+    def __init__(self, websocket: WebSocket, name: str):
+        self.websocket = websocket
+        self.name = name
+        self._entries: deque[_Entry] = deque()
+        self._keyed: dict[tuple, _Entry] = {}
+        self._pending = 0
+        self._wakeup = asyncio.Event()
+        self.overflowed = False
+        self.closed = False
+
+    def __len__(self) -> int:
+        return self._pending
+
+    def put(
+        self,
+        frame: Frame,
+        key: tuple | None = None,
+        droppable: bool = False,
+        queued_at: list[float] | None = None,
+    ):
+        """
+        Queues a frame without waiting. queued_at are the times the events in the frame were queued by the
+        listener, observed as fan-out latency once it is sent.
+        """
+        if self.closed or self.overflowed:
+            return
+        if droppable and self._pending >= SOFT_LIMIT:
+            metrics.WS_SEND_QUEUE_DROPPED.inc(reason="behind")
+            return
+        if self._pending >= LIMIT:
+            self._overflow()
+            return
+        if key is not None and key in self._keyed:
+            # Leave the superseded entry in place but empty, the writer skips it
+            superseded = self._keyed.pop(key)
+            superseded.frame = None
+            queued_at = superseded.queued_at + (queued_at or [])
+            self._pending -= 1
+            metrics.WS_SEND_QUEUE_DROPPED.inc(reason="coalesced")
+        entry = _Entry(frame, key, queued_at or [])
+        self._entries.append(entry)
+        if key is not None:
+            self._keyed[key] = entry
+        self._pending += 1
+        metrics.WS_SEND_QUEUE_DEPTH.observe(self._pending)
+        self._wakeup.set()
+
+    def _overflow(self):
+        logger.warning(
+            "%s is more than %s frames behind, closing so it reconnects", self.name, LIMIT
+        )
+        metrics.WS_SEND_QUEUE_DROPPED.inc(self._pending, reason="overflow")
+        self.overflowed = True
+        self._entries.clear()
+        self._keyed.clear()
+        self._pending = 0
+        self._wakeup.set()
+
+    async def run(self):
+        """
+        The socket's writer task. Ends when the socket can't be sent to anymore or the queue overflowed, the
+        receive loop then closes the socket.
+        """
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._entries:
+                    entry = self._entries.popleft()
+                    if entry.frame is None:
+                        continue
+                    if entry.key is not None:
+                        del self._keyed[entry.key]
+                    self._pending -= 1
+                    await self.websocket.send_text(entry.frame.text)
+                    if entry.queued_at:
+                        sent_at = time.perf_counter()
+                        for queued_at in entry.queued_at:
+                            metrics.EVENT_FANOUT_SECONDS.observe(sent_at - queued_at)
+                if self.overflowed:
+                    return
+        except Exception as e:
+            # The socket is gone, its receive loop sees the disconnect and cleans up
+            logger.debug("%s - Writer stopped: %r", self.name, e)
+        finally:
+            self.closed = True
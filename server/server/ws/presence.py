@@ -0,0 +1,225 @@
+"""
+Which players are connected, and kicking them.
+
+Every player socket claims its (session id, player id) when it joins and holds a Connection until it closes. The
+socket's receive loop beats the connection's heartbeat at least every couple of seconds, and a connection that
+hasn't beaten for EXPIRE_SECONDS counts as gone, so a crashed or wedged socket stops showing as connected without
+anyone having to write a player_leave for it.
+
+With PRESENCE_BACKEND=memory (the default) this worker's connections are all there is, which is right for a
+single worker. With PRESENCE_BACKEND=database the claims are also kept in the presence table, refreshed by each
+worker's heartbeat() task, so every worker sees players connected to the others.
+
+A kick stores its events and closes the socket right away if it is on this worker. On Postgres the kick also
+sends a NOTIFY in the same transaction, and every worker's listen() task closes the socket if it has it.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Callable
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from server import crud, database
+from server.ws import memory
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_BACKEND = os.environ.get("PRESENCE_BACKEND", "memory")
+HEARTBEAT_SECONDS = 10
+EXPIRE_SECONDS = 30
+WORKER = f"{socket.gethostname()}:{os.getpid()}"
+
+CHANNEL = "webmulti_presence"
+RECONNECT_SECONDS = 5
+
+
+class Connection:
+    def __init__(
+        self, session_id: uuid.UUID, player_id: int, close: Callable[[dict, bool], None]
+    ):
+        self.id = uuid.uuid4()
+        self.session_id = session_id
+        self.player_id = player_id
+        self.close = close
+        self.beat()
+
+    def beat(self):
+        self.heartbeat_at = time.monotonic()
+
+    def alive(self) -> bool:
+        return time.monotonic() - self.heartbeat_at < EXPIRE_SECONDS
+
+
+# session id -> player id -> connection, for the sockets on this worker
+_connections: dict[uuid.UUID, dict[int, Connection]] = {}
+
+
+def _shared() -> bool:
+    return PRESENCE_BACKEND == "database"
+
+
+def claim(
+    db: Session, session_id: uuid.UUID, player_id: int, close: Callable[[dict, bool], None]
+) -> Connection | None:
+    """
+    Claims the player for a new socket, or returns None if they are already connected. On a kick close is called
+    with the player_kicked message to send before the socket is closed and whether the kick already stored the
+    player's leave. It must not block.
+    """
+    local = _connections.get(session_id, {}).get(player_id)
+    if local is not None and local.alive():
+        return None
+    connection = Connection(session_id, player_id, close)
+    if _shared() and not crud.claim_presence(
+        db, session_id, player_id, connection.id, WORKER, EXPIRE_SECONDS
+    ):
+        return None
+    _connections.setdefault(session_id, {})[player_id] = connection
+    return connection
+
+
+def release(db: Session, connection: Connection):
+    players = _connections.get(connection.session_id, {})
+    if players.get(connection.player_id) is connection:
+        del players[connection.player_id]
+        if not players:
+            del _connections[connection.session_id]
+    if _shared():
+        crud.delete_presence(db, connection.id)
+
+
+def connected_players(db: Session, session_id: uuid.UUID) -> set[int]:
+    if _shared():
+        return crud.get_present_players(db, session_id, EXPIRE_SECONDS)
+    return {
+        player_id
+        for player_id, connection in _connections.get(session_id, {}).items()
+        if connection.alive()
+    }
+
+
+def is_connected(db: Session, session_id: uuid.UUID, player_id: int) -> bool:
+    return player_id in connected_players(db, session_id)
+
+
+def _sweep() -> list[uuid.UUID]:
+    """Drops this worker's expired connections and returns the ids of the live ones."""
+    live = []
+    for session_id, players in list(_connections.items()):
+        for player_id, connection in list(players.items()):
+            if connection.alive():
+                live.append(connection.id)
+            else:
+                logger.warning("Connection for player %s in %s expired", player_id, session_id)
+                del players[player_id]
+        if not players:
+            del _connections[session_id]
+    return live
+
+
+def _refresh(live: list[uuid.UUID]):
+    db = database.SessionLocal()
+    try:
+        crud.refresh_presence(db, live, EXPIRE_SECONDS)
+    finally:
+        db.close()
+
+
+async def heartbeat():
+    while True:
+        await asyncio.sleep(HEARTBEAT_SECONDS)
+        try:
+            # The sweep changes this worker's connections so it stays on the loop, only the database write doesn't
+            live = _sweep()
+            if _shared():
+                await asyncio.to_thread(_refresh, live)
+        except Exception:
+            logger.exception("Presence heartbeat failed")
+
+
+def close_local(session_id: uuid.UUID, player_id: int, message: dict, leave_stored: bool) -> bool:
+    connection = _connections.get(session_id, {}).get(player_id)
+    if connection is None:
+        return False
+    connection.close(message, leave_stored)
+    return True
+
+
+def kick(db: Session, session_id: uuid.UUID, kicked_by: int, player_id: int, player_name: str) -> bool:
+    """
+    Kicks a player: the player_kicked event and, if they were connected, their player_leave are committed together,
+    then their socket is closed wherever it is. Returns whether the socket was on this worker.
+    """
+    # With the memory backend a player on another worker isn't seen here, their socket stores the leave instead
+    leave_stored = is_connected(db, session_id, player_id)
+    kicked = crud.create_kick_events(db, session_id, kicked_by, player_id, player_name, leave_stored)
+    message = memory.event_message(kicked)
+    if db.get_bind().dialect.name == "postgresql":
+        payload = {
+            "session_id": str(session_id),
+            "player_id": player_id,
+            "message": message,
+            "leave_stored": leave_stored,
+        }
+        db.execute(select(func.pg_notify(CHANNEL, json.dumps(payload))))
+    db.commit()
+    return close_local(session_id, player_id, message, leave_stored)
+
+
+def _on_notify(payload: str):
+    try:
+        data = json.loads(payload)
+        close_local(
+            uuid.UUID(data["session_id"]), data["player_id"], data["message"], data["leave_stored"]
+        )
+    except Exception:
+        logger.exception("Bad presence notification: %s", payload)
+
+
+async def _listen_once(loop: asyncio.AbstractEventLoop):
+    conn = database.engine.raw_connection()
+    try:
+        dbapi_conn = conn.driver_connection
+        dbapi_conn.autocommit = True
+        with dbapi_conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+        lost = loop.create_future()
+
+        def readable():
+            try:
+                dbapi_conn.poll()
+            except Exception as e:
+                if not lost.done():
+                    lost.set_exception(e)
+                return
+            while dbapi_conn.notifies:
+                _on_notify(dbapi_conn.notifies.pop(0).payload)
+
+        loop.add_reader(dbapi_conn.fileno(), readable)
+        try:
+            await lost
+        finally:
+            loop.remove_reader(dbapi_conn.fileno())
+    finally:
+        # A LISTENing autocommit connection must not go back to the pool
+        conn.invalidate()
+
+
+async def listen():
+    """Closes sockets on this worker for kicks made on other workers. Only needed on Postgres."""
+    if database.engine.dialect.name != "postgresql":
+        return
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await _listen_once(loop)
+        except Exception:
+            logger.exception("Presence listener lost its connection, reconnecting")
+        await asyncio.sleep(RECONNECT_SECONDS)
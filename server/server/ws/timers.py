@@ -0,0 +1,83 @@
+"""
+Session timers run on the event loop. A countdown schedules all of its ticks up front with loop.call_at against
+the loop's monotonic clock, so a busy loop can delay a tick but never pushes the later ones back. Only the first
+number and GO! are stored as chat events; the ticks between them are broadcast straight to the session's sockets.
+The stored ones are sent from the loop as well and written in the default executor, so a tick never waits on the
+database.
+"""
+
+import asyncio
+import datetime
+import logging
+import uuid
+
+from server import crud, models
+from server.database import SessionLocal
+from server.ws import broadcast, memory
+
+logger = logging.getLogger(__name__)
+
+# Gives the /countdown chat message time to reach everyone before the first number
+START_DELAY = 0.5
+
+_countdowns: dict[uuid.UUID, list[asyncio.TimerHandle]] = {}
+
+
+def _write(row: dict):
+    db = SessionLocal()
+    try:
+        # Bulk, so the after_insert listener doesn't send it a second time
+        crud.insert_event_rows(db, [row])
+        db.commit()
+    except Exception:
+        logger.exception("Failed to store countdown message %s", row["event_data"]["message"])
+    finally:
+        db.close()
+
+
+def _store(session_id: uuid.UUID, text: str):
+    row = {
+        "session_id": session_id,
+        "timestamp": datetime.datetime.now(datetime.UTC),
+        "user_id": None,
+        "event_type": models.EventTypes.chat,
+        "from_player": -1,
+        "to_player": -1,
+        "event_data": {"message": text, "type": "countdown", "private": False},
+    }
+    broadcast.broadcast_event(models.SessionMessage(**row))
+    asyncio.get_running_loop().run_in_executor(None, _write, row)
+
+
+def _tick(session_id: uuid.UUID, text: str):
+    broadcast.broadcast(session_id, memory.system_chat_message(text, type="countdown"))
+
+
+def _go(session: models.MWSession):
+    _countdowns.pop(session.id, None)
+    _store(session.id, "GO!")
+
+
+def start_countdown(session: models.MWSession, seconds: int):
+    """Counts down from seconds to GO! for everyone in the session, replacing a countdown already running."""
+    cancel_countdown(session.id)
+    seconds = max(seconds, 0)
+    loop = asyncio.get_running_loop()
+    start = loop.time() + START_DELAY
+    handles = []
+    if seconds > 0:
+        handles.append(loop.call_at(start, _store, session.id, f"{seconds}"))
+    for remaining in range(seconds - 1, 0, -1):
+        handles.append(loop.call_at(start + seconds - remaining, _tick, session.id, f"{remaining}"))
+    handles.append(loop.call_at(start + seconds, _go, session))
+    _countdowns[session.id] = handles
+    logger.debug("Countdown of %ss started for session %s", seconds, session.id)
+
+
+def cancel_countdown(session_id: uuid.UUID) -> bool:
+    handles = _countdowns.pop(session_id, None)
+    if not handles:
+        return False
+    for handle in handles:
+        handle.cancel()
+    return True
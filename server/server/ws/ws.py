@@ -1,6 +1,5 @@
 import asyncio
 import datetime
-import json
 import logging
 import time
 
@@ -16,19 +15,20 @@ from fastapi.websockets import WebSocketState
 
 import server.main as main
 from sqlalchemy.orm import Session
-from sqlalchemy import event as listen_event
 
-from server import crud, models, schemas, sram
-from server.data import data as loc_data
-from server.logging import logging_config
+from server import crud, metrics, models, query_stats, schemas
+from server.logging import configure_logging, log_every
 from server.dependencies import get_db
-from server.utils import system_chat, sanitize_chat_message, countdown, user_allowed_in_session
+from server.ws import broadcast, inbox, memory, outbox, presence, timers
+from server.utils import system_chat, sanitize_chat_message, user_allowed_in_session
 
 logger = logging.getLogger(__name__)
-logging.config.dictConfig(logging_config)
+configure_logging()
 
 router = APIRouter()
 
+PONG = broadcast.Frame({"type": "pong"})
+
 # SPECIAL PLAYER IDS:
 # -1: System
 # -2: User lookup (not a player)
@@ -92,7 +92,8 @@ async def websocket_endpoint(
         await websocket.close(reason="Player info not received", code=4403)
         return
 
-    multidata = session.mwdata
+    document = session.multidata_document
+    multidata = document.data
 
     mw_rom_names = [x[2] for x in multidata["roms"]]
     player_names = [x for x in multidata["names"][0]]
@@ -138,24 +139,24 @@ async def websocket_endpoint(
         player_id = -2
         player_name = user.username
 
-    # Get all events for the session of either join or leave for this player
-    conn_events = crud.get_player_connection_events(db, session.id, player_id)
-    if (
-        user_type == "player"
-        and len(conn_events) > 0
-        and conn_events[0].event_type == models.EventTypes.player_join
-    ):
-        logger.warning(f"{player_name} already joined")
-        await websocket.close(reason="Player already joined", code=4409)
-        return
+    kick_message = None
+    kick_leave_stored = False
+    handler_task = asyncio.current_task()
 
-    # Log join event
-    if user_type == "player":
+    # Called by presence when this player is kicked, from any socket on any worker
+    def close_for_kick(message, leave_stored):
+        nonlocal kick_message, kick_leave_stored
+        if kick_message is None:
+            kick_message = message
+            kick_leave_stored = leave_stored
+            handler_task.cancel()
+
+    def log_leave():
         crud.create_event(
             db,
             schemas.EventCreate(
                 session_id=session.id,
-                event_type=models.EventTypes.player_join,
+                event_type=models.EventTypes.player_leave,
                 from_player=player_id,
                 to_player=-1,
                 item_id=-1,
@@ -163,105 +164,179 @@ async def websocket_endpoint(
                 event_data={"player_id": player_id, "player_name": player_name},
             ),
         )
-    else:
-        crud.create_event(
-            db,
-            schemas.EventCreate(
-                session_id=session.id,
-                event_type=models.EventTypes.user_join_chat,
-                from_player=-2,
-                to_player=-1,
-                item_id=-1,
-                location=-1,
-                event_data={"player_id": player_id, "player_name": player_name},
-            ),
-        )
 
-    multidata_locs = {tuple(d[0]): tuple(d[1]) for d in multidata["locations"]}
+    connection = None
+    if user_type == "player":
+        connection = presence.claim(db, session.id, player_id, close_for_kick)
+        if connection is None:
+            logger.warning("%s already joined", player_name)
+            await websocket.close(reason="Player already joined", code=4409)
+            return
 
-    events_to_send = []
-    should_close = False
-    skip_update = 0
-    processing_sram = False
+    # Anything failing before the receive loop below takes over still has to give the claim back
+    try:
+        if user_type == "player":
+            # A player came back to a finished session, its events need to be live again before their game writes
+            crud.restore_archived_session(db, session.id)
 
-    await websocket.send_json({"type": "flags", "data": session.flags})
+        # Log join event
+        if user_type == "player":
+            crud.create_event(
+                db,
+                schemas.EventCreate(
+                    session_id=session.id,
+                    event_type=models.EventTypes.player_join,
+                    from_player=player_id,
+                    to_player=-1,
+                    item_id=-1,
+                    location=-1,
+                    event_data={"player_id": player_id, "player_name": player_name},
+                ),
+            )
+        else:
+            crud.create_event(
+                db,
+                schemas.EventCreate(
+                    session_id=session.id,
+                    event_type=models.EventTypes.user_join_chat,
+                    from_player=-2,
+                    to_player=-1,
+                    item_id=-1,
+                    location=-1,
+                    event_data={"player_id": player_id, "player_name": player_name},
+                ),
+            )
 
-    if user_type == "player":
-        await websocket.send_json({"type": "init_success"})
+        multidata_locs = memory.location_lookup(document)
 
-    # This listens for new events and sends them to the client, it's never actually called itself
-    def after_event(mapper, connection, target_event):
-        nonlocal should_close
-        nonlocal events_to_send
-        nonlocal skip_update
-        nonlocal websocket
+        events_to_send = []
+        # When each event from the listener was queued, for the fan-out latency metric
+        events_queued_at = []
+        should_close = False
+        skip_update = 0
+        processing_sram = False
+        # Frame time of the last SRAM processed on this socket, for seeing rollbacks
+        processed_frame_time = None
 
-        if target_event.session_id != session.id:
-            return
-        elif target_event.event_type == models.EventTypes.player_forfeit:
-            # On Forfeit we want to skip the next few updates because the forfeit is slow
-            skip_update = 3
-            return
-        elif websocket.client_state != WebSocketState.CONNECTED:
-            should_close = True
-            return
-        new_event = {
-            "type": target_event.event_type.name,
-            "data": {
-                "id": target_event.id,
-                "timestamp": int(time.mktime(target_event.timestamp.timetuple())),
-                "event_type": target_event.event_type.name,
-                "from_player": target_event.from_player,
-                "to_player": target_event.to_player,
-                "item_id": target_event.item_id,
-                "location": target_event.location,
-                "event_data": target_event.event_data,
-            },
-        }
-        if target_event.event_type == models.EventTypes.new_item:
-            if target_event.event_data == None:
-                target_event.event_data = {}
-            target_event.event_data["item_name"] = loc_data.item_table[
-                str(target_event.item_id)
-            ]
-            target_event.event_data["location_name"] = loc_data.lookup_id_to_name[
-                str(target_event.location)
-            ]
-            if target_event.to_player != target_event.from_player:
-                new_event["data"]["event_idx"] = list(
-                    target_event.to_player_idx.to_bytes(2, "big")
-                )
+        await websocket.send_json({"type": "flags", "data": session.flags})
 
-        if target_event.event_type == models.EventTypes.player_kicked:
-            if target_event.to_player == player_id:
-                should_close = True
+        if user_type == "player":
+            await websocket.send_json({"type": "init_success"})
+
+        # Gets every message for the session from broadcast, the frame is shared with the session's other sockets
+        def deliver(frame, target_event):
+            nonlocal should_close
+            nonlocal skip_update
 
-        if target_event.event_type == models.EventTypes.chat:
-            if target_event.event_data["type"] == "countdown":
-                loop = asyncio.get_event_loop()
-                logger.debug(f"Countdown: {datetime.datetime.now()}")
-                loop.create_task(websocket.send_json(new_event))
+            if target_event is None:
+                # Messages for the whole session that aren't stored as events, like countdown ticks
+                send_queue.put(frame, droppable=True)
                 return
-            if target_event.to_player != -1:
-                if target_event.to_player != player_id:
-                    return
 
-        events_to_send.append(new_event)
+            if (
+                target_event.event_type == models.EventTypes.new_item
+                and target_event.from_player == player_id
+            ):
+                checks.mark(target_event.location)
 
-    checked_locations = {}
+            if target_event.event_type == models.EventTypes.player_forfeit:
+                # On Forfeit we want to skip the next few updates because the forfeit is slow
+                skip_update = 3
+                return
+            elif websocket.client_state != WebSocketState.CONNECTED:
+                should_close = True
+                return
 
-    for p_event in crud.get_events_from_player(db, session.id, player_id):
-        if p_event.event_type == models.EventTypes.new_item:
-            checked_locations[p_event.location] = p_event.frame_time
+            if target_event.event_type == models.EventTypes.player_kicked:
+                if target_event.to_player == player_id:
+                    # Presence sends this one itself and closes the socket
+                    return
 
-    # Register the listener after defining it
-    listen_event.listen(models.Event, "after_insert", after_event)
+            if target_event.event_type == models.EventTypes.chat:
+                if target_event.event_data["type"] == "countdown":
+                    logger.debug("Countdown: %s", datetime.datetime.now())
+                    send_queue.put(frame)
+                    return
+                if target_event.to_player != -1:
+                    if target_event.to_player != player_id:
+                        return
+
+            events_to_send.append(frame)
+            events_queued_at.append(time.perf_counter())
+
+        checked_locations = {}
+        recorder = memory.open_recorder(session.id, player_id) if user_type == "player" else None
+
+        checks = memory.CheckedLocations(document, player_id)
+        progress = crud.get_player_progress(db, session.id, player_id) if user_type == "player" else None
+        # Duping compares each check's frame time, which only the events have
+        if user_type == "player" and progress is not None and not session.flags["duping"]:
+            checks.checked = int.from_bytes(progress.checked, "little")
+            for location in checks.found():
+                # Without duping only whether a location was checked matters
+                checked_locations[location] = 0
+        elif user_type == "player":
+            for p_event in crud.get_events_from_player(db, session.id, player_id):
+                if p_event.event_type == models.EventTypes.new_item:
+                    checked_locations[p_event.location] = p_event.frame_time
+                    checks.mark(p_event.location)
+            if progress is None:
+                # A session from before progress was kept, or an imported one
+                progress = crud.update_player_progress(
+                    db,
+                    session.id,
+                    player_id,
+                    checks.checked,
+                    receiving_paused=crud.is_player_receiving_paused(db, session.id, player_id),
+                )
+        saved_progress = None
+        if progress is not None:
+            saved_progress = checks.checked
+            resume = {"token": f"{session.id}.{player_id}.{progress.version}", "resumed": False}
+            if player_info.get("resume_token") == resume["token"]:
+                # Nothing changed since the client's last connection, it still has all of this
+                resume["resumed"] = True
+            else:
+                resume["receiving_paused"] = progress.receiving_paused
+
+        send_queue = outbox.Outbox(websocket, player_name)
+        writer = asyncio.create_task(send_queue.run())
+        received = inbox.Inbox(websocket)
+        reader = asyncio.create_task(received.run())
+        if progress is not None:
+            send_queue.put(broadcast.Frame({"type": "resume", "data": resume}))
+
+        def save_progress(*args, **kwargs):
+            progress = crud.update_player_progress(db, session.id, player_id, *args, **kwargs)
+            # Keeps the client's resume token current, it already has the state that changed
+            message = {
+                "type": "resume",
+                "data": {"token": f"{session.id}.{player_id}.{progress.version}", "resumed": True},
+            }
+            send_queue.put(broadcast.Frame(message), outbox.coalesce_key(message))
+    except BaseException:
+        if connection:
+            presence.release(db, connection)
+        raise
+    broadcast.subscribe(session.id, deliver)
+    metrics.WS_CONNECTED_SOCKETS.inc(session=str(session.id))
 
     try:
         while True:
+            if send_queue.overflowed:
+                # The client fell too far behind, the writer may still be stuck sending to it
+                writer.cancel()
+                if websocket.client_state == WebSocketState.CONNECTED:
+                    await websocket.close(code=outbox.TRY_AGAIN_LATER)
+                raise WebSocketDisconnect
+            if send_queue.closed:
+                # The writer found the socket gone
+                raise WebSocketDisconnect
+            if connection:
+                connection.beat()
             if len(events_to_send) > 0:
-                new_items = [x for x in events_to_send if x["type"] == "new_item"]
-                events_to_send = [x for x in events_to_send if x["type"] != "new_item"]
+                new_items = [x.message for x in events_to_send if x.message["type"] == "new_item"]
+                events_to_send = [x for x in events_to_send if x.message["type"] != "new_item"]
                 if len(new_items) > 0:
                     new_items = sorted(new_items, key=lambda x: x["data"]["id"])
                     # Here we make sure that no item events are missed, to_player_idx should ALWAYS be sequential
@@ -288,7 +363,12 @@ async def websocket_endpoint(
                             != (len(from_others_events) - 1)
                         ) or (lowest_event > (last_event + 1)):
                             logger.error(
-                                f"{player_name} - Missing events between {last_event}, {lowest_event} and {highest_event} ({len(from_others_events)} events found)"
+                                "%s - Missing events between %s, %s and %s (%s events found)",
+                                player_name,
+                                last_event,
+                                lowest_event,
+                                highest_event,
+                                len(from_others_events),
                             )
                             extra_events = crud.get_items_for_player_from_others(
                                 db,
@@ -300,54 +380,35 @@ async def websocket_endpoint(
                             new_items = []
 
                             for event in extra_events:
-                                item_name = loc_data.item_table[str(event.item_id)]
-                                new_items.append(
-                                    {
-                                        "type": "new_item",
-                                        "data": {
-                                            "id": event.id,
-                                            "timestamp": int(
-                                                time.mktime(event.timestamp.timetuple())
-                                            ),
-                                            "event_type": event.event_type.name,
-                                            "from_player": event.from_player,
-                                            "to_player": event.to_player,
-                                            "event_idx": list(
-                                                event.to_player_idx.to_bytes(2, "big")
-                                            ),
-                                            "item_id": loc_data.item_table_reversed[
-                                                item_name
-                                            ],
-                                            "location": event.location,
-                                            "event_data": {
-                                                "item_name": item_name,
-                                                "location_name": loc_data.lookup_id_to_name[
-                                                    str(event.location)
-                                                ],
-                                            },
-                                        },
-                                    }
-                                )
+                                new_items.append(memory.item_event_message(event))
                     events_to_send.append(
-                        {
-                            "type": "new_items",
-                            "data": [x["data"] for x in new_items],
-                        }
+                        broadcast.Frame(
+                            {
+                                "type": "new_items",
+                                "data": [x["data"] for x in new_items],
+                            }
+                        )
                     )
 
-                    items_per_player = {
-                        p: len([x for x in new_items if x["data"]["to_player"] == p])
-                        for p in set([x["data"]["to_player"] for x in new_items])
-                    }
-                    logger.debug(
-                        f"{player_name} - Also sending {len(new_items)} new items ({items_per_player})"
-                    )
+                    if logger.isEnabledFor(logging.DEBUG):
+                        items_per_player = {
+                            p: len([x for x in new_items if x["data"]["to_player"] == p])
+                            for p in set([x["data"]["to_player"] for x in new_items])
+                        }
+                        logger.debug(
+                            "%s - Also sending %s new items (%s)",
+                            player_name,
+                            len(new_items),
+                            items_per_player,
+                        )
 
-                logger.debug(f"{player_name} - Sending {len(events_to_send)} events")
+                logger.debug("%s - Sending %s events", player_name, len(events_to_send))
 
                 # Get all item events
                 item_event_lists = [
-                    event for event in events_to_send if event["type"] == "new_items"
+                    event.message
+                    for event in events_to_send
+                    if event.message["type"] == "new_items"
                 ]
 
                 # Flatten the list of lists
@@ -360,23 +421,37 @@ async def websocket_endpoint(
                 # filter all_items to remove duplicates where event.id is identical
                 all_items = list({event["id"]: event for event in all_items}.values())
 
-                logger.debug(f"{player_name} - {len(all_items)} - {all_items}")
-                logger.debug(
-                    f"{player_name} - {len(events_to_send)} - {events_to_send}"
+                # Full dumps are big, so only one every few seconds per player even at DEBUG
+                log_every(
+                    logger,
+                    logging.DEBUG,
+                    (session.id, player_id),
+                    10,
+                    "%s - %s - %s - %s - %s",
+                    player_name,
+                    len(all_items),
+                    all_items,
+                    len(events_to_send),
+                    events_to_send,
                 )
 
                 non_item_events = [
-                    event for event in events_to_send if event["type"] != "new_items"
+                    event for event in events_to_send if event.message["type"] != "new_items"
                 ]
 
                 events_to_send = non_item_events
                 if len(all_items) > 0:
-                    events_to_send.append({"type": "new_items", "data": all_items})
-
-                for event in events_to_send:
-                    await websocket.send_json(event)
-
+                    events_to_send.append(broadcast.Frame({"type": "new_items", "data": all_items}))
+
+                for ix, event in enumerate(events_to_send):
+                    send_queue.put(
+                        event,
+                        outbox.coalesce_key(event.message),
+                        # Fan-out latency is measured once the whole batch is out
+                        queued_at=events_queued_at if ix == len(events_to_send) - 1 else None,
+                    )
                 events_to_send = []
+                events_queued_at = []
 
                 # We do this at the end, so that we can include the kicked message as an event.
                 # We'll use this on the frontend to close the connection and direct the user away from the session
@@ -386,406 +461,287 @@ async def websocket_endpoint(
 
             # Wait for a message from the client, but only for 1.5 seconds, then we loop back to the top and process events from other players
             try:
-                payload = await asyncio.wait_for(websocket.receive_json(), timeout=1.5)
+                payload = await asyncio.wait_for(received.get(), timeout=1.5)
             except asyncio.TimeoutError:
                 continue
 
-            if payload["type"] == "ping":
-                await websocket.send_json({"type": "pong"})
-                continue
-            elif payload["type"] == "pause_receiving":
-                crud.create_event(
-                    db,
-                    schemas.EventCreate(
-                        session_id=session.id,
-                        event_type=models.EventTypes.player_pause_receive,
-                        from_player=player_id,
-                        to_player=-1,
-                        item_id=-1,
-                        location=-1,
-                        event_data={"player_id": player_id},
-                    ),
-                )
-                continue
-            elif payload["type"] == "resume_receiving":
-                crud.create_event(
-                    db,
-                    schemas.EventCreate(
-                        session_id=session.id,
-                        event_type=models.EventTypes.player_resume_receive,
-                        from_player=player_id,
-                        to_player=-1,
-                        item_id=-1,
-                        location=-1,
-                        event_data={"player_id": player_id},
-                    ),
-                )
-                continue
-            elif payload["type"] == "ready_response":
-                crud.create_event(
-                    db,
-                    schemas.EventCreate(
-                        session_id=session.id,
-                        event_type=models.EventTypes.chat,
-                        from_player=player_id,
-                        to_player=-1,
-                        item_id=-1,
-                        location=-1,
-                        event_data={"message": "", "type": "ready_response", "player_id": player_id, "private": False},
-                    ),
-                )
-                continue
-            elif payload["type"] == "unready_response":
-                crud.create_event(
-                    db,
-                    schemas.EventCreate(
-                        session_id=session.id,
-                        event_type=models.EventTypes.chat,
-                        from_player=player_id,
-                        to_player=-1,
-                        item_id=-1,
-                        location=-1,
-                        event_data={"message": "", "type": "unready_response", "player_id": player_id, "private": False},
-                    ),
-                )
-                continue
-            elif payload["type"] == "chat":
-                ev_data = {"message": sanitize_chat_message(payload["data"]), "type": "chat"}
-                if user_type == "non_player":
-                    ev_data["user_id"] = user.id
-
-                if session.flags["chat"] == False:
-                    if not payload["data"].startswith("/") or payload["data"].split(
-                        " "
-                    )[0] not in [
-                        "/countdown",
-                        "/missing",
-                        "/ready_check",
-                        "/cancel_ready",
-                    ]:  # TODO: Move this to a list variable somewher
-                        system_chat(
-                            "Chat is disabled in this session",
-                            session,
-                            db,
-                            private=player_id,
-                        )
-                        continue
+            message_type = (
+                payload["type"] if payload["type"] in metrics.WS_MESSAGE_TYPES else "unknown"
+            )
+            message_start = time.perf_counter()
+            message_queries, queries_token = query_stats.start()
+            try:
+                if payload["type"] == "ping":
+                    send_queue.put(PONG)
+                    continue
+                elif payload["type"] == "pause_receiving":
+                    crud.create_event(
+                        db,
+                        schemas.EventCreate(
+                            session_id=session.id,
+                            event_type=models.EventTypes.player_pause_receive,
+                            from_player=player_id,
+                            to_player=-1,
+                            item_id=-1,
+                            location=-1,
+                            event_data={"player_id": player_id},
+                        ),
+                    )
+                    if progress is not None:
+                        save_progress(receiving_paused=True)
+                    continue
+                elif payload["type"] == "resume_receiving":
+                    crud.create_event(
+                        db,
+                        schemas.EventCreate(
+                            session_id=session.id,
+                            event_type=models.EventTypes.player_resume_receive,
+                            from_player=player_id,
+                            to_player=-1,
+                            item_id=-1,
+                            location=-1,
+                            event_data={"player_id": player_id},
+                        ),
+                    )
+                    if progress is not None:
+                        save_progress(receiving_paused=False)
+                    continue
+                elif payload["type"] == "ready_response":
+                    crud.create_event(
+                        db,
+                        schemas.EventCreate(
+                            session_id=session.id,
+                            event_type=models.EventTypes.chat,
+                            from_player=player_id,
+                            to_player=-1,
+                            item_id=-1,
+                            location=-1,
+                            event_data={"message": "", "type": "ready_response", "player_id": player_id, "private": False},
+                        ),
+                    )
+                    continue
+                elif payload["type"] == "unready_response":
+                    crud.create_event(
+                        db,
+                        schemas.EventCreate(
+                            session_id=session.id,
+                            event_type=models.EventTypes.chat,
+                            from_player=player_id,
+                            to_player=-1,
+                            item_id=-1,
+                            location=-1,
+                            event_data={"message": "", "type": "unready_response", "player_id": player_id, "private": False},
+                        ),
+                    )
+                    continue
+                elif payload["type"] == "chat":
+                    ev_data = {"message": sanitize_chat_message(payload["data"]), "type": "chat"}
+                    if user_type == "non_player":
+                        ev_data["user_id"] = user.id
+
+                    if session.flags["chat"] == False:
+                        if not payload["data"].startswith("/") or payload["data"].split(
+                            " "
+                        )[0] not in [
+                            "/countdown",
+                            "/missing",
+                            "/ready_check",
+                            "/cancel_ready",
+                        ]:  # TODO: Move this to a list variable somewher
+                            system_chat(
+                                "Chat is disabled in this session",
+                                session,
+                                db,
+                                private=player_id,
+                            )
+                            continue
 
-                # Check for commands
-                ev = crud.create_event(
-                    db,
-                    schemas.EventCreate(
-                        session_id=session.id,
-                        event_type=models.EventTypes.chat,
-                        from_player=player_id,
-                        to_player=-1,
-                        item_id=-1,
-                        location=-1,
-                        event_data=ev_data,
-                    ),
-                )
+                    # Check for commands
+                    ev = crud.create_event(
+                        db,
+                        schemas.EventCreate(
+                            session_id=session.id,
+                            event_type=models.EventTypes.chat,
+                            from_player=player_id,
+                            to_player=-1,
+                            item_id=-1,
+                            location=-1,
+                            event_data=ev_data,
+                        ),
+                    )
                 
-                if payload["data"].startswith("/"):
-                    command = payload["data"].split(" ")
-                    if command[0] == "/countdown":
-                        if len(command) < 2:
-                            countdown_time = 5
-                        else:
-                            try:
-                                countdown_time = int(command[1])
-                                if countdown_time > 60:
+                    if payload["data"].startswith("/"):
+                        command = payload["data"].split(" ")
+                        if command[0] == "/countdown":
+                            if len(command) < 2:
+                                countdown_time = 5
+                            else:
+                                try:
+                                    countdown_time = int(command[1])
+                                    if countdown_time > 60:
+                                        system_chat(
+                                            "Time too high, max is 60 seconds",
+                                            session,
+                                            db,
+                                            private=player_id,
+                                        )
+                                        continue
+                                except ValueError:
                                     system_chat(
-                                        "Time too high, max is 60 seconds",
+                                        "Invalid time value.",
                                         session,
                                         db,
                                         private=player_id,
                                     )
                                     continue
-                            except ValueError:
+                            timers.start_countdown(session, countdown_time)
+                        elif command[0] == "/missing":
+                            if session.flags["missingCmd"] == False:
                                 system_chat(
-                                    "Invalid time value.",
+                                    "The /missing command is disabled in this session",
                                     session,
                                     db,
                                     private=player_id,
                                 )
                                 continue
-                        loop = asyncio.get_event_loop()
-                        loop.create_task(countdown(countdown_time, session, db))
-                    elif command[0] == "/missing":
-                        if session.flags["missingCmd"] == False:
+                            send_queue.put(
+                                broadcast.Frame(memory.missing_locations_message(player_id, checks))
+                            )
+                        elif command[0] == "/ready_check":
+                            system_chat(
+                                "",
+                                session,
+                                db,
+                                type="ready_check",
+                            )
+                        elif command[0] == "/cancel_ready":
+                            system_chat(
+                                "",
+                                session,
+                                db,
+                                type="ready_check_cancel",
+                            )
+                        else:
+                            send_queue.put(
+                                broadcast.Frame({"type": "chat", "data": "Unknown command"})
+                            )
+                elif payload["type"] == "control":
+                    if payload["data"]["type"] == "kick":
+                        if not user.is_superuser and user not in session.owners:
                             system_chat(
-                                "The /missing command is disabled in this session",
+                                "You do not have permission to kick players.",
                                 session,
                                 db,
                                 private=player_id,
                             )
                             continue
-                        all_player_events = crud.get_events_from_player(
-                            db, session.id, player_id
-                        )
-                        all_player_events = [
-                            x
-                            for x in all_player_events
-                            if x.event_type == models.EventTypes.new_item
-                        ]
-                        all_player_locations = set(
-                            [
-                                x[0][0]
-                                for x in multidata["locations"]
-                                if x[0][1] == player_id
-                            ]
-                        )
-                        for event in all_player_events:
-                            if event.location in all_player_locations:
-                                all_player_locations.remove(event.location)
-                        missing_locs = [
-                            loc_data.lookup_id_to_name[str(x)]
-                            for x in all_player_locations
-                        ]
-                        system_chat(
-                            f"Missing locations:",
-                            session,
-                            db,
-                            private=player_id,
-                        )
-                        for loc in missing_locs:
+                        player_to_kick = payload["data"]["player_id"]
+                        if player_to_kick == player_id:
                             system_chat(
-                                f"    {loc}",
+                                "You cannot kick yourself",
                                 session,
                                 db,
                                 private=player_id,
                             )
-                    elif command[0] == "/ready_check":
-                        system_chat(
-                            "",
-                            session,
-                            db,
-                            type="ready_check",
-                        )
-                    elif command[0] == "/cancel_ready":
-                        system_chat(
-                            "",
-                            session,
-                            db,
-                            type="ready_check_cancel",
-                        )
-                    else:
-                        await websocket.send_json(
-                            {"type": "chat", "data": "Unknown command"}
-                        )
-            elif payload["type"] == "control":
-                if payload["data"]["type"] == "kick":
-                    if not user.is_superuser and user not in session.owners:
-                        system_chat(
-                            "You do not have permission to kick players.",
-                            session,
-                            db,
-                            private=player_id,
-                        )
-                        continue
-                    player_to_kick = payload["data"]["player_id"]
-                    if player_to_kick == player_id:
-                        system_chat(
-                            "You cannot kick yourself",
-                            session,
+                            continue
+                        if player_to_kick <= 0 or player_to_kick > len(player_names):
+                            system_chat(
+                                "Could not find player to kick",
+                                session,
+                                db,
+                                private=player_id,
+                            )
+                            continue
+                        presence.kick(
                             db,
-                            private=player_id,
+                            session.id,
+                            player_id,
+                            player_to_kick,
+                            player_names[player_to_kick - 1],
                         )
                         continue
-                    if player_to_kick <= 0 or player_to_kick > len(player_names):
-                        system_chat(
-                            "Could not find player to kick",
-                            session,
-                            db,
-                            private=player_id,
-                        )
+
+                elif payload["type"] == "update_memory":
+                    # Update the memory for the session
+                    if processing_sram:
                         continue
-                    ev = crud.create_event(
-                        db,
-                        schemas.EventCreate(
-                            session_id=session.id,
-                            event_type=models.EventTypes.player_kicked,
-                            from_player=player_id,
-                            to_player=player_to_kick,
-                            item_id=-1,
-                            location=-1,
-                            event_data={"player_id": player_to_kick},
-                        ),
-                    )
-                    await asyncio.sleep(2.0)
-                    conn_events = crud.get_player_connection_events(db, session.id, player_to_kick)
-                    if (
-                        len(conn_events) > 0
-                        and conn_events[0].event_type == models.EventTypes.player_join
-                    ):
-                        ev = crud.create_event(
-                            db,
-                            schemas.EventCreate(
-                                session_id=session.id,
-                                event_type=models.EventTypes.player_leave,
-                                from_player=player_id,
-                                to_player=-1,
-                                item_id=-1,
-                                location=-1,
-                                event_data={"player_id": player_id, "player_name": player_name},
-                            ),
-                        )
-                    continue
+                    processing_sram = True
 
-            elif payload["type"] == "update_memory":
-                # Update the memory for the session
-                if processing_sram:
-                    continue
-                processing_sram = True
+                    # logger.debug(f"Got SRAM update from {player_name}")
+                    if skip_update > 0:
+                        logger.debug("Skipping update for %s", player_name)
+                        skip_update -= 1
+                        processing_sram = False
+                        continue
 
-                # logger.debug(f"Got SRAM update from {player_name}")
-                if skip_update > 0:
-                    logger.debug(f"Skipping update for {player_name}")
-                    skip_update -= 1
-                    processing_sram = False
-                    continue
+                    # Only the newest of the snapshots already waiting needs processing
+                    sram_data = payload["data"]
+                    superseded = [sram_data] + received.newer_memory_updates(sram_data, processed_frame_time)
+                    sram_data = superseded.pop()
+                    if superseded:
+                        logger.debug("%s - Skipping %s stale updates", player_name, len(superseded))
+                        metrics.SRAM_UPDATES_COALESCED.inc(len(superseded))
 
-                sramstore = schemas.SRAMStoreCreate(
-                    session_id=session.id,
-                    player=player_id,
-                    sram=json.dumps(payload["data"]),
-                )
-                # NOTE: This sram store could be moved to on disconnect only if we want to save on writes
-                old_sram, new_sram = crud.update_sramstore(db, sramstore)
+                    if recorder:
+                        for data in superseded + [sram_data]:
+                            recorder.record(data)
 
-                if old_sram == None:
+                    timings = {}
+                    new_sram, to_player_events = memory.process_memory_update(
+                        db,
+                        session,
+                        player_id,
+                        player_name,
+                        sram_data,
+                        multidata_locs,
+                        checked_locations,
+                        timings,
+                    )
+                    processed_frame_time = memory.frame_time(sram_data)
+                    for stage, seconds in timings.items():
+                        metrics.SRAM_STAGE_SECONDS.observe(seconds, stage=stage)
+                    if progress is not None and checks.checked != saved_progress:
+                        save_progress(checks.checked)
+                        saved_progress = checks.checked
+                    for event in to_player_events:
+                        events_to_send.append(broadcast.Frame(memory.item_event_message(event)))
+
+                    # logger.debug(f"{player_name} - Finished processing sram update")
                     processing_sram = False
                     continue
-
-                sram_diff = sram.sram_diff(new_sram, old_sram)
-
-                if len(sram_diff) == 0:
-                    processing_sram = False
+                else:
+                    logger.error("Unknown message: %s", payload)
                     continue
-
-                locations = sram.get_changed_locations(sram_diff, old_sram, new_sram)
-                frame_time = (
-                    new_sram["total_time"][2] << 16
-                    | new_sram["total_time"][1] << 8
-                    | new_sram["total_time"][0]
-                )
-                old_frame_time = (
-                    old_sram["total_time"][2] << 16
-                    | old_sram["total_time"][1] << 8
-                    | old_sram["total_time"][0]
-                )
-
-                if frame_time < old_frame_time:
-                    logger.debug(
-                        f"{player_name} - Frame time went backwards - Save scum or reset"
-                    )
-                    events_to_update = crud.get_events_after_frametime(
-                        db, session.id, player_id, frame_time
-                    )
-                    crud.update_events_frametime(
-                        db, session.id, player_id, events_to_update, None
-                    )
-                    for event in events_to_update:
-                        checked_locations[event.location] = None
-
-                for location in locations:
-                    loc_id = int(loc_data.lookup_name_to_id[location])
-
-                    if (loc_id, player_id) not in multidata_locs:
-                        logger.error(
-                            f"{player_name} - Location not in multidata_locs: {location} [{loc_id}]"
-                        )
-                        continue
-                    item_id, item_player = multidata_locs[(loc_id, player_id)]
-
-                    if loc_id not in checked_locations or (
-                        checked_locations[loc_id] != None
-                        and (
-                            (checked_locations[loc_id] < frame_time)
-                            and session.flags["duping"]
-                        )
-                    ):
-                        logger.info(
-                            f"{player_name} - New Location Checked: {location} [{loc_id}]"
-                        )
-
-                        crud.create_event(
-                            db,
-                            schemas.EventCreate(
-                                session_id=session.id,
-                                event_type=models.EventTypes.new_item,
-                                from_player=player_id,
-                                to_player=item_player,
-                                item_id=item_id,
-                                location=loc_id,
-                                frame_time=frame_time,
-                                event_data={
-                                    "item_name": loc_data.item_table[str(item_id)],
-                                    "location_name": location,
-                                },
-                            ),
-                        )
-                        checked_locations[loc_id] = frame_time
-
-                # Compare all events for the player with their sram to see if they need to be sent any items (save scummed)
-                last_event = int.from_bytes(new_sram["multiinfo"][:2], "big")
-                to_player_events = crud.get_items_for_player_from_others(
-                    db, session.id, player_id, gt_idx=last_event
+            finally:
+                metrics.WS_MESSAGE_SECONDS.observe(
+                    time.perf_counter() - message_start, type=message_type
                 )
-                for event in to_player_events:
-                    item_name = loc_data.item_table[str(event.item_id)]
-                    logger.info(
-                        f"{player_name} - Player doesn't have {item_name} from {event.from_player} id: {event.id}. Resending"
-                    )
-                    events_to_send.append(
-                        {
-                            "type": "new_item",
-                            "data": {
-                                "id": event.id,
-                                "timestamp": int(
-                                    time.mktime(event.timestamp.timetuple())
-                                ),
-                                "event_type": event.event_type.name,
-                                "from_player": event.from_player,
-                                "to_player": event.to_player,
-                                "event_idx": list(
-                                    event.to_player_idx.to_bytes(2, "big")
-                                ),
-                                "item_id": loc_data.item_table_reversed[item_name],
-                                "location": event.location,
-                                "event_data": {
-                                    "item_name": item_name,
-                                    "location_name": loc_data.lookup_id_to_name[
-                                        str(event.location)
-                                    ],
-                                },
-                            },
-                        }
-                    )
-                    last_event = event.id
-
-                # logger.debug(f"{player_name} - Finished processing sram update")
-                processing_sram = False
-                continue
-            else:
-                logger.error(f"Unknown message: {payload}")
-                continue
+                query_stats.finish(queries_token)
+                query_stats.observe(f"ws {message_type}", message_queries)
+                # Cleared so the profiler doesn't attribute event sending to the last message
+                message_type = None
     except WebSocketDisconnect:
         if user_type == "player":
-            # Log leave event
-            crud.create_event(
-                db,
-                schemas.EventCreate(
-                    session_id=session.id,
-                    event_type=models.EventTypes.player_leave,
-                    from_player=player_id,
-                    to_player=-1,
-                    item_id=-1,
-                    location=-1,
-                    event_data={"player_id": player_id, "player_name": player_name},
-                ),
-            )
+            log_leave()
+    except asyncio.CancelledError:
+        if kick_message is None:
+            raise
+        handler_task.uncancel()
+        writer.cancel()
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.send_json(kick_message)
+            await websocket.close(reason="Kicked", code=4400)
+        if not kick_leave_stored:
+            log_leave()
     finally:
-        # Always remove the listener to prevent leak
-        if listen_event.contains(models.Event, "after_insert", after_event):
-            listen_event.remove(models.Event, "after_insert", after_event)
+        # Always unsubscribe to prevent leak
+        broadcast.unsubscribe(session.id, deliver)
+        writer.cancel()
+        reader.cancel()
+        if connection:
+            presence.release(db, connection)
+        metrics.WS_CONNECTED_SOCKETS.dec(session=str(session.id))
+        if metrics.WS_CONNECTED_SOCKETS.get(session=str(session.id)) <= 0:
+            metrics.WS_CONNECTED_SOCKETS.remove(session=str(session.id))
+        if recorder:
+            recorder.close()
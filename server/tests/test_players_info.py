@@ -0,0 +1,82 @@
+import json
+import uuid
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from server import models, query_stats
+from server.utils import get_session_players_info_from_db
+
+# The session, its multidata, users, SRAM, progress and paused messages, however many players there are
+PLAYERS_INFO_QUERIES = 6
+
+SRAM = {"game_mode": [0x09], "lw_dw": [0], "coords": [0, 0, 0, 0], "dungeon_id": [0, 0], "inventory": [0] * 0x1BD}
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    # Events can't be made on SQLite (autoincrement in a composite key) and players info doesn't read them
+    models.Base.metadata.create_all(
+        engine, tables=[table for table in models.Base.metadata.sorted_tables if table.name != "events"]
+    )
+    session = sessionmaker(bind=engine, expire_on_commit=False)()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def make_session(db, players: int) -> uuid.UUID:
+    multidata_hash = uuid.uuid4().hex
+    db.add(
+        models.Multidata(
+            hash=multidata_hash,
+            data={
+                "names": [[f"Player {x}" for x in range(1, players + 1)]],
+                "locations": [[[x, x], [x, x]] for x in range(1, players + 1)],
+            },
+        )
+    )
+    session = models.MWSession(game=models.Game(title="z3"), multidata_hash=multidata_hash)
+    db.add(session)
+    db.flush()
+    for player_id in range(1, players + 1):
+        user = models.User(username=f"{multidata_hash} {player_id}")
+        db.add(user)
+        db.flush()
+        db.add(models.UserSessions(user_id=user.id, session_id=session.id, player_id=player_id))
+        db.add(models.SRAMStore(session_id=session.id, player=player_id, sram=json.dumps(SRAM)))
+        if player_id % 2:
+            db.add(models.PlayerProgress(session_id=session.id, player_id=player_id, checked=b"", receiving_paused=True))
+        else:
+            # Players without progress have their paused state read from their last pause or resume
+            toggles = [models.EventTypes.player_pause_receive]
+            if player_id == 2:
+                toggles.append(models.EventTypes.player_resume_receive)
+            for event_type in toggles:
+                db.add(
+                    models.SessionMessage(
+                        session_id=session.id, event_type=event_type, from_player=player_id, to_player=-1, event_data={}
+                    )
+                )
+                db.flush()
+    db.commit()
+    return session.id
+
+
+@pytest.mark.parametrize("players", [2, 8])
+def test_players_info_queries_dont_grow_with_players(db, players):
+    session_id = make_session(db, players)
+    db.expunge_all()
+
+    with query_stats.assert_max_queries(PLAYERS_INFO_QUERIES) as stats:
+        session = db.get(models.MWSession, session_id)
+        infos = get_session_players_info_from_db(db, session)
+
+    assert stats.count == PLAYERS_INFO_QUERIES
+    assert [info.playerName for info in infos] == [f"Player {x}" for x in range(1, players + 1)]
+    assert [info.receivingPaused for info in infos] == [x != 2 for x in range(1, players + 1)]
@@ -0,0 +1,30 @@
+import asyncio
+
+from server import watchdog
+
+
+async def websocket_endpoint(websocket, mw_session_id: str):
+    player_id = 3
+    await asyncio.Event().wait()
+
+
+async def run_asgi():
+    await websocket_endpoint(None, "session-1")
+
+
+def test_task_stacks_groups_suspended_sockets_by_session():
+    async def main():
+        task = asyncio.create_task(run_asgi())
+        await asyncio.sleep(0)
+        try:
+            return watchdog.task_stacks()
+        finally:
+            task.cancel()
+
+    stacks = asyncio.run(main())
+
+    assert [entry["player"] for entry in stacks["session-1"]] == ["3"]
+    names = [line.rsplit(" ", 1)[1] for line in stacks["session-1"][0]["stack"]]
+    # Innermost frame first, down to the Event the socket is waiting on
+    assert names[0] == "wait"
+    assert names[-2:] == ["websocket_endpoint", "run_asgi"]